@@ -16,6 +16,6 @@ stored_models_dir_path = (
 model_path = stored_models_dir_path + model_name
 
 classifier = EpilepsyClassifier(model_path)
-edf = classifier.classify_on_edf(filename, save_file=save_name, window_size=250)
+edf = classifier.classify_file_streaming(filename, save_file=save_name, window_size=250)
 print(edf.annotations)
 print(f"Saved to {save_name}")
@@ -7,11 +7,12 @@ import pandas as pd
 import numpy as np
 import sys
 import mne
-from tensorflow import keras
 from scipy.signal import resample
 
-from ..transformations import Transforms
-from ..mne_reader.edf_reader import EDFReader
+from .numpy_model import NumpyModel
+from ..transformations import WindowStream, fft_features, window_starts, windows
+from ..mne_reader.edf_reader import EDFReader, standard_electrode_picks
+from ..mne_reader.resample_stream import iter_resampled_blocks, resampled_length
 from ..mne_reader.save_edf import write_edf
 
 
@@ -19,11 +20,26 @@ class EpilepsyClassifier:
     def __init__(self, model_path, sample_rate=500):
         """Loads clasifer model
 
-        model_path: path to saved model
+        model_path: path to saved model, a .npz exported by
+            train_neurogram.export_model runs without TensorFlow
         sample_rate: frequency at which to base classifications
         """
         self.sample_rate = sample_rate
-        self.model = keras.models.load_model(model_path)
+        if model_path.endswith(".npz"):
+            self.model = NumpyModel(model_path)
+        else:
+            # Imported only for Keras models, it takes seconds
+            from tensorflow import keras
+
+            self.model = keras.models.load_model(model_path)
+
+    def warm_up(self, batch_size=1):
+        """Runs the model once on a dummy batch, so the first real batch
+        doesn't pay for building the prediction graph
+        """
+        # (None, #electrodes, window_size, 1)
+        shape = self.model.input_shape[1:]
+        self.model.predict_on_batch(np.zeros((batch_size, *shape)))
 
     def _sliding_window(
         self,
@@ -33,6 +49,7 @@ class EpilepsyClassifier:
         window_size=500,
         step_width=200,
         percent_callback=None,
+        batch_size=256,
     ):
         """Passes a sliding window over the data, passing the window
         into the given model to classify for epileptic discharges.
@@ -43,46 +60,63 @@ class EpilepsyClassifier:
         window_size: size of the window to be passed into the model
             must match the input shape that the model is expecting
         step_width: number of timesteps for the window to travel each iteration
+        batch_size: number of windows transformed and predicted per call
 
         returns: onsets, durations
             where onsets is a list reporting where an annotation starts
             and durations reports duration of index-corresponding annotation
             all in seconds
         """
+        print("Classifying, hold your horses.")
 
-        def i2sec(i):
-            """convert index (a timestamp at some {samplerate}Hz) to seconds"""
-            return float(i / sample_rate)
+        # Strided (#windows)x(#electrodes)x(window_size) view of every
+        # window start in range(0, #timesteps - window_size, step_width)
+        # Nothing is copied until a batch is transformed
+        starts = window_starts(data.shape[1], window_size, step_width)
+        if len(starts) == 0:
+            # Recording shorter than a single window
+            return [], [], []
+        data_windows = windows(data, window_size, step_width)
 
-        print("Classifying, hold your horses.")
-        percent_step = 0.05
+        predictions = np.empty(len(starts))
+        for b in range(0, len(starts), batch_size):
+            predictions[b : b + batch_size] = self._predict_windows(
+                data_windows[b : b + batch_size]
+            )
+            percent = float(min(b + batch_size, len(starts))) / max(len(starts), 1)
+            print(f"{int(percent*100)}%: {b}/{len(starts)} windows")
+            if percent_callback is not None:
+                percent_callback(percent)
 
-        # Slide window across data
         # Collect positive indices and prediction confidence
-        positive_indices = []
-        prediction_confs = []
-        for i in range(0, data.shape[1] - window_size, step_width):
-            percent = float(i) / data.shape[1]
-            if percent >= percent_step:
-                print(f"{int(percent*100)}%: {i}/{data.shape[1]}")
-                if percent_callback is not None:
-                    percent_callback(percent)
-                percent_step += 0.05
-            # Convert window into a "list" (one element) of windows
-            # needs to be in a list for the following transform
-            window = np.array([data[:, i : (i + window_size)]])
-            transformed = Transforms().fourier_transform_all(window)
-            # Reshape for predictor (n_images=1, x_shape, y_shape, channels)
-            s = transformed.shape
-            transformed = transformed.reshape(1, s[1], s[2], 1)
-            # Predict on the "list" of windows
-            prediction_list = self.model.predict(transformed)
-            # Grab the prediction value
-            p = prediction_list[0][0]
+        positive = predictions > positive_threshold
+        positive_indices = starts[positive].tolist()
+        prediction_confs = predictions[positive].tolist()
 
-            if p > positive_threshold:
-                positive_indices.append(i)
-                prediction_confs.append(p)
+        return self._annotations_from_positives(
+            positive_indices, prediction_confs, sample_rate, window_size
+        )
+
+    def _predict_windows(self, windows):
+        """Returns the model's epilepsy probability for each window
+
+        windows: np array of (#windows)x(#electrodes)x(window_size)
+        """
+        transformed = fft_features(np.asarray(windows))
+        # Reshape for predictor (n_images, x_shape, y_shape, channels)
+        s = transformed.shape
+        transformed = transformed.reshape(s[0], s[1], s[2], 1)
+        # One call per batch rather than per window
+        return np.asarray(self.model.predict_on_batch(transformed))[:, 0]
+
+    def _annotations_from_positives(
+        self, positive_indices, prediction_confs, sample_rate, window_size
+    ):
+        """Merges positive window starts into onsets, durations, descriptions"""
+
+        def i2sec(i):
+            """convert index (a timestamp at some {samplerate}Hz) to seconds"""
+            return float(i / sample_rate)
 
         # parse positive indices for onsets and durations
         onsets = []
@@ -117,7 +151,9 @@ class EpilepsyClassifier:
 
         return onsets, durations, descriptions
 
-    def classify_on_edf(self, edf, save_file="", window_size=500, percent_callback=None):
+    def classify_on_edf(
+        self, edf, save_file="", window_size=500, percent_callback=None, batch_size=256
+    ):
         """Passes a sliding window over the data, passing the window
         into the given model to classify for epileptic discharges.
 
@@ -129,7 +165,7 @@ class EpilepsyClassifier:
         # The meat of the classification
         onsets, durations, descriptions = self._sliding_window(
             data, window_size=window_size,
-            percent_callback=percent_callback
+            percent_callback=percent_callback, batch_size=batch_size
         )
         # Save annotations to edf
         annotations = mne.Annotations(onsets, durations, descriptions)
@@ -138,3 +174,86 @@ class EpilepsyClassifier:
             write_edf(raw, save_file, overwrite=True)
 
         return raw
+
+    def stream_predictions(
+        self,
+        raw,
+        window_size=500,
+        step_width=200,
+        batch_size=256,
+        block_seconds=60,
+        percent_callback=None,
+    ):
+        """Generator counterpart of _sliding_window that reads the raw in
+        blocks, resampling each one, and yields (window_start, probability)
+        for every window as soon as its block has been scored.
+
+        Windows are the same as _sliding_window's over the resampled
+        recording; memory is bounded by block_seconds, not file length.
+
+        raw: mne.io.Raw, ideally not preloaded
+        block_seconds: seconds of source data read and resampled at a time
+        """
+        picks = standard_electrode_picks(raw.ch_names)
+        total = resampled_length(raw.n_times, raw.info["sfreq"], self.sample_rate)
+        stream = WindowStream(window_size, step_width, total)
+
+        blocks = iter_resampled_blocks(
+            raw, self.sample_rate, picks=picks, block_seconds=block_seconds
+        )
+        for block_start, block in blocks:
+            # Every window that now fits, sharing samples with the last block's
+            starts, block_windows = stream.feed(block)
+            for b in range(0, len(starts), batch_size):
+                batch_starts = starts[b : b + batch_size]
+                predictions = self._predict_windows(block_windows[b : b + batch_size])
+                for i, p in zip(batch_starts, predictions):
+                    yield int(i), float(p)
+
+            block_end = block_start + block.shape[1]
+            if percent_callback is not None and total > 0:
+                percent_callback(min(float(block_end) / total, 1.0))
+
+    def classify_on_raw_streaming(
+        self,
+        raw,
+        save_file="",
+        positive_threshold=0.5,
+        window_size=500,
+        step_width=200,
+        batch_size=256,
+        block_seconds=60,
+        percent_callback=None,
+    ):
+        """Bounded-memory version of classify_on_edf for an mne Raw,
+        annotations are set on the raw, optionally saved to save_file
+
+        returns: the annotated raw
+        """
+        positive_indices = []
+        prediction_confs = []
+        predictions = self.stream_predictions(
+            raw, window_size=window_size, step_width=step_width,
+            batch_size=batch_size, block_seconds=block_seconds,
+            percent_callback=percent_callback
+        )
+        for i, p in predictions:
+            if p > positive_threshold:
+                positive_indices.append(i)
+                prediction_confs.append(p)
+
+        onsets, durations, descriptions = self._annotations_from_positives(
+            positive_indices, prediction_confs, self.sample_rate, window_size
+        )
+        raw.set_annotations(mne.Annotations(onsets, durations, descriptions))
+        if save_file != "":
+            write_edf(raw, save_file, overwrite=True)
+
+        return raw
+
+    def classify_file_streaming(self, file_path, save_file="", **kwargs):
+        """Opens file_path without preloading and classifies it with
+        classify_on_raw_streaming
+        """
+        raw = mne.io.read_raw(file_path, preload=False)
+        return self.classify_on_raw_streaming(raw, save_file=save_file, **kwargs)
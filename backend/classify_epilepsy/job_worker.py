@@ -0,0 +1,52 @@
+"""Entry point for classification jobs run in a worker process
+
+Kept apart from the webserver so running a job only imports the
+classifier (and TensorFlow). Worker processes are spawned, so they also
+import the server's main module: nothing else under python -m
+backend.webserver, Flask's CLI (and Flask) under flask run. Models are
+kept loaded per process by the model registry so consecutive jobs don't
+reload them.
+"""
+import logging
+
+from .model_registry import model_registry
+
+logger = logging.getLogger(__name__)
+
+
+class JobCancelled(Exception):
+    """Raised inside a job once its cancel event is set"""
+
+
+def warm_worker(model_paths):
+    """Pool initializer, loads and warms up models before the first job"""
+    for model_path in model_paths:
+        try:
+            model_registry.get(model_path)
+        except Exception as e:
+            # Left to fail in the job that asks for it, a failing
+            # initializer would break the whole pool
+            logger.warning(f"Warming up {model_path} failed: {e}")
+
+
+def run_classification_job(job_id, file_path, model_path, progress_queue, cancel_event):
+    """Classifies file_path, reporting progress as (job_id, percent)
+    tuples on progress_queue and stopping at the next block once
+    cancel_event is set
+
+    returns: dict of onsets, durations, descriptions lists
+    """
+    classifier = model_registry.get(model_path)
+
+    def on_percent(percent):
+        if cancel_event.is_set():
+            raise JobCancelled(job_id)
+        progress_queue.put((job_id, percent))
+
+    raw = classifier.classify_file_streaming(file_path, percent_callback=on_percent)
+    annotations = raw.annotations
+    return {
+        "onsets": [float(o) for o in annotations.onset],
+        "durations": [float(d) for d in annotations.duration],
+        "descriptions": [str(d) for d in annotations.description],
+    }
@@ -0,0 +1,50 @@
+"""Classifiers kept loaded in a process, by model path
+
+Loading a Keras model and running its first prediction (which builds
+the TensorFlow graph) takes seconds, so each classification worker
+loads a model once, warms it up with a dummy batch, and keeps it for
+the jobs that follow. Only the most recently used models stay
+resident, older versions are dropped once there are too many.
+"""
+import threading
+from collections import OrderedDict
+
+from .classify_epilepsy import EpilepsyClassifier
+
+# Models resident in a process before the least recently used is dropped
+MAX_RESIDENT_MODELS = 2
+
+
+class ModelRegistry:
+    """Thread-safe LRU of model path -> warmed up EpilepsyClassifier"""
+
+    def __init__(self, max_models=MAX_RESIDENT_MODELS):
+        self.max_models = max_models
+        self._lock = threading.Lock()
+        self._classifiers = OrderedDict()
+
+    def get(self, model_path):
+        """Returns the classifier of model_path, loading and warming it
+        up if it isn't resident
+        """
+        with self._lock:
+            classifier = self._classifiers.get(model_path)
+            if classifier is not None:
+                self._classifiers.move_to_end(model_path)
+                return classifier
+            # Loaded under the lock, two jobs never load the same model twice
+            classifier = EpilepsyClassifier(model_path)
+            classifier.warm_up()
+            self._classifiers[model_path] = classifier
+            while len(self._classifiers) > self.max_models:
+                self._classifiers.popitem(last=False)
+            return classifier
+
+    def resident(self):
+        """Paths of the loaded models, least recently used first"""
+        with self._lock:
+            return list(self._classifiers)
+
+
+# Shared by every job run in this process
+model_registry = ModelRegistry()
@@ -0,0 +1,97 @@
+"""Runs exported Neurogram models with NumPy alone
+
+Neurogram networks are small (a convolution and two dense layers), so
+classifying doesn't need TensorFlow: train_neurogram.export_model saves
+a trained model's layers and weights to a .npz file, and NumpyModel
+runs them with the same arithmetic, in float32 like Keras. Only the
+layers define_model uses, and their common options, are supported.
+"""
+import json
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Layers that only matter while training
+PASSTHROUGH_LAYERS = {"InputLayer", "Dropout"}
+
+
+def _sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+
+def _softmax(x):
+    e = np.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+ACTIVATIONS = {
+    "linear": lambda x: x,
+    "relu": lambda x: np.maximum(x, 0),
+    "sigmoid": _sigmoid,
+    "tanh": np.tanh,
+    "softmax": _softmax,
+}
+
+
+def _conv2d(x, spec, kernel, bias=None):
+    """Conv2D over a (n)x(height)x(width)x(channels) batch"""
+    if spec.get("data_format", "channels_last") != "channels_last":
+        raise ValueError("Only channels_last convolutions are supported")
+    if tuple(spec.get("dilation_rate", (1, 1))) != (1, 1):
+        raise ValueError("Dilated convolutions are not supported")
+    kh, kw = kernel.shape[:2]
+    sh, sw = spec.get("strides", (1, 1))
+    if spec.get("padding", "valid") == "same":
+        # Keras pads the extra row and column at the end
+        ph = max((int(np.ceil(x.shape[1] / sh)) - 1) * sh + kh - x.shape[1], 0)
+        pw = max((int(np.ceil(x.shape[2] / sw)) - 1) * sw + kw - x.shape[2], 0)
+        x = np.pad(x, ((0, 0), (ph // 2, ph - ph // 2), (pw // 2, pw - pw // 2), (0, 0)))
+    # (n)x(out height)x(out width)x(channels)x(kh)x(kw) view, nothing copied
+    windows = sliding_window_view(x, (kh, kw), axis=(1, 2))[:, ::sh, ::sw]
+    out = np.tensordot(windows, kernel.transpose(2, 0, 1, 3), axes=([3, 4, 5], [0, 1, 2]))
+    if bias is not None:
+        out += bias
+    return out
+
+
+class NumpyModel:
+    """An exported Keras Sequential model, with the part of the Keras
+    model interface EpilepsyClassifier uses
+    """
+
+    def __init__(self, path):
+        """path: .npz written by train_neurogram.export_model"""
+        with np.load(path) as npz:
+            spec = json.loads(str(npz["spec"]))
+            self.layers = []
+            for i, layer in enumerate(spec["layers"]):
+                weights = [npz[f"layer{i}_{j}"] for j in range(layer["weights"])]
+                self.layers.append((layer, weights))
+        self.input_shape = (None, *spec["input_shape"])
+
+    def predict_on_batch(self, x):
+        """Outputs of the model for a batch of inputs
+
+        x: np array of (n_images, x_shape, y_shape, channels); cast to
+            float32 like Keras does, complex inputs keep their real part
+        """
+        x = np.real(np.asarray(x)).astype(np.float32)
+        for layer, weights in self.layers:
+            kind = layer["type"]
+            if kind == "Conv2D":
+                x = _conv2d(x, layer, *weights)
+                x = ACTIVATIONS[layer.get("activation", "linear")](x)
+            elif kind == "Dense":
+                x = x @ weights[0]
+                if len(weights) > 1:
+                    x += weights[1]
+                x = ACTIVATIONS[layer.get("activation", "linear")](x)
+            elif kind == "LeakyReLU":
+                x = np.where(x >= 0, x, x * np.float32(layer["alpha"]))
+            elif kind == "Activation":
+                x = ACTIVATIONS[layer["activation"]](x)
+            elif kind == "Flatten":
+                x = x.reshape(len(x), -1)
+            elif kind not in PASSTHROUGH_LAYERS:
+                raise ValueError(f"Unsupported layer {kind}")
+        return x
@@ -1,3 +1,5 @@
 from .edf_reader import EDFReader
 from .fif_reader import FIFReader
+from .montage import Montage
+from .channel_map import ChannelMap
 from .save_edf import write_edf
@@ -0,0 +1,115 @@
+"""Maps a recording's channel names to the electrodes they record
+
+Channel names come in many spellings: "EEG Fp1-REF", "POL FP1",
+"Fp1-LE", "EEG T7" for what older files call T3. Each name is parsed
+once into a canonical electrode name and the mapping is cached per
+channel list, so callers get integer indices to slice sample arrays
+with instead of matching strings on every request.
+"""
+import re
+from functools import lru_cache
+
+import numpy as np
+
+# International standard; 19 electrodes
+KEPT_ELECTRODES = [
+    "Fp1",
+    "F3",
+    "F7",
+    "C3",
+    "T3",
+    "P3",
+    "T5",
+    "O1",
+    "Pz",
+    "Fp2",
+    "Fz",
+    "F4",
+    "F8",
+    "Cz",
+    "C4",
+    "T4",
+    "P4",
+    "T6",
+    "O2",
+]
+# Different labels for the same electrodes (10-10 name -> 10-20 name)
+ELECTRODE_ALIASES = {"T7": "T3", "T8": "T4", "P7": "T5", "P8": "T6"}
+
+# Recording system prefixes, as in "EEG Fp1" or "POL Fp1"
+_PREFIX = re.compile(r"^(EEG|POL)[\s\-_:]*")
+# Reference suffixes, as in "Fp1-REF" or "Fp1-LE"
+_REFERENCE = re.compile(r"[\s\-_](REF\d*|LE|RE|AR|AV|AVG|A1|A2|A1A2|M1|M2|ME)$")
+# What is left of an electrode once prefix and reference are stripped
+_ELECTRODE = re.compile(r"^[A-Z]{1,3}[0-9]{0,2}Z?$")
+
+
+def canonical_electrode(name):
+    """Canonical (upper case, 10-20) electrode name a channel name
+    records, or None if it doesn't look like a single electrode
+    """
+    label = _PREFIX.sub("", str(name).strip().upper())
+    label = _REFERENCE.sub("", label).strip()
+    if not _ELECTRODE.match(label):
+        return None
+    return ELECTRODE_ALIASES.get(label, label)
+
+
+STANDARD_ELECTRODES = frozenset(canonical_electrode(e) for e in KEPT_ELECTRODES)
+
+
+class ChannelMap:
+    """Electrode of every channel of a recording, see module docstring"""
+
+    def __init__(self, ch_names):
+        self.ch_names = list(ch_names)
+        self.electrodes = [canonical_electrode(name) for name in self.ch_names]
+        # Exact names first, then electrodes, each to its first channel
+        self._by_name = {}
+        for i, name in enumerate(self.ch_names):
+            self._by_name.setdefault(name, i)
+        self._by_electrode = {}
+        for i, electrode in enumerate(self.electrodes):
+            if electrode is not None:
+                self._by_electrode.setdefault(electrode, i)
+        self._standard_picks = None
+
+    @classmethod
+    def for_channels(cls, ch_names):
+        """Shared ChannelMap of a channel list, parsed only once"""
+        return _cached_map(tuple(str(name) for name in ch_names))
+
+    def index_of(self, name, match="electrode"):
+        """Index of the channel named name, or None
+
+        match: 'exact' compares whole channel names, 'electrode' also
+            accepts any spelling of the same electrode
+        """
+        if name in self._by_name:
+            return self._by_name[name]
+        if match == "electrode":
+            electrode = canonical_electrode(name)
+            if electrode is not None:
+                return self._by_electrode.get(electrode)
+        return None
+
+    def picks(self, electrodes):
+        """Indices, in file order, of the channels recording any of
+        electrodes (in any spelling)
+        """
+        wanted = {canonical_electrode(e) for e in electrodes}
+        wanted.discard(None)
+        return np.array(
+            [i for i, e in enumerate(self.electrodes) if e in wanted], dtype=int
+        )
+
+    def standard_picks(self):
+        """picks of the international standard electrodes"""
+        if self._standard_picks is None:
+            self._standard_picks = self.picks(STANDARD_ELECTRODES)
+        return self._standard_picks
+
+
+@lru_cache(maxsize=64)
+def _cached_map(ch_names):
+    return ChannelMap(ch_names)
@@ -0,0 +1,107 @@
+"""Display filters applied to ranges of samples on demand
+
+A display filter (high-pass, low-pass and notch) is stored as
+second-order sections and run forwards and backwards over a range, so
+it is zero-phase like mne's default filtering. The range is first
+widened by the filter's impulse response on each side, and trimmed
+back afterwards, so a filtered chunk matches the same samples of the
+whole recording filtered at once. Changing the filter never touches
+the full recording.
+"""
+from functools import lru_cache
+
+import numpy as np
+from scipy import signal
+
+# Butterworth order of the high-pass and low-pass sections
+FILTER_ORDER = 4
+# Quality factor of the notch
+NOTCH_Q = 30
+# Impulse response amplitude, relative to its peak, padding stops at
+PAD_TOLERANCE = 1e-4
+# Longest padding, in seconds, however low the high-pass
+MAX_PAD_SECONDS = 60
+
+
+class DisplayFilter:
+    """High-pass, low-pass and notch frequencies in Hz, None when unset"""
+
+    def __init__(self, highpass=None, lowpass=None, notch=None):
+        self.highpass = highpass
+        self.lowpass = lowpass
+        self.notch = notch
+
+    @property
+    def enabled(self):
+        return any(f is not None for f in (self.highpass, self.lowpass, self.notch))
+
+    def sos(self, sample_rate):
+        """Second-order sections of the filter at sample_rate; cutoffs
+        at or past Nyquist are left out
+        """
+        return self._design(sample_rate)[0]
+
+    def pad_samples(self, sample_rate):
+        """Samples of context needed on each side of a range for its
+        filtered samples to match the whole recording's
+        """
+        return self._design(sample_rate)[1]
+
+    def _design(self, sample_rate):
+        return _design(self.highpass, self.lowpass, self.notch, sample_rate)
+
+    def apply(self, samples, sample_rate, pad_before=0, pad_after=0):
+        """Filters a (#channels)x(#samples) matrix
+
+        pad_before, pad_after: samples of context at either end of
+            samples, trimmed off the result
+        returns: (#channels)x(#samples - pad_before - pad_after)
+        """
+        sos = self.sos(sample_rate)
+        stop = samples.shape[1] - pad_after
+        if sos is None or samples.shape[1] == 0:
+            return samples[:, pad_before:stop]
+        # Reflected at the recording's own ends, where there is no context
+        padlen = min(3 * (2 * len(sos) + 1), samples.shape[1] - 1)
+        filtered = signal.sosfiltfilt(sos, samples, axis=1, padlen=padlen)
+        return filtered[:, pad_before:stop].astype(samples.dtype, copy=False)
+
+    def to_dict(self):
+        return {'highpass': self.highpass, 'lowpass': self.lowpass, 'notch': self.notch}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d.get('highpass'), d.get('lowpass'), d.get('notch'))
+
+
+@lru_cache(maxsize=64)
+def _design(highpass, lowpass, notch, sample_rate):
+    """(sos, pad_samples) of a filter, designed once per sample rate"""
+    nyquist = sample_rate / 2
+    sections = []
+    if highpass is not None and 0 < highpass < nyquist:
+        sections.append(signal.butter(
+            FILTER_ORDER, highpass, 'highpass', fs=sample_rate, output='sos'
+        ))
+    if lowpass is not None and 0 < lowpass < nyquist:
+        sections.append(signal.butter(
+            FILTER_ORDER, lowpass, 'lowpass', fs=sample_rate, output='sos'
+        ))
+    if notch is not None and 0 < notch < nyquist:
+        b, a = signal.iirnotch(notch, NOTCH_Q, fs=sample_rate)
+        sections.append(signal.tf2sos(b, a))
+    if not sections:
+        return None, 0
+    sos = np.concatenate(sections)
+
+    # Samples until the impulse response has (nearly) died out
+    impulse = np.zeros(int(MAX_PAD_SECONDS * sample_rate))
+    impulse[0] = 1
+    response = np.abs(signal.sosfilt(sos, impulse))
+    above = np.nonzero(response > PAD_TOLERANCE * response.max())[0]
+    return sos, int(above[-1]) + 1
+
+
+# What .EEG (Nihon Kohden) recordings are shown with until changed,
+# keeping body motion and line noise out of view
+BODY_MOTION_FILTER = DisplayFilter(highpass=0.57, lowpass=35)
@@ -5,16 +5,24 @@ import mne
 from scipy import signal
 
 from .mne_base_reader import MNEBaseReader
+from .channel_map import ChannelMap, KEPT_ELECTRODES
+
+
+def standard_electrode_picks(ch_names):
+    """Returns indices of the channels holding international standard
+    electrodes, in file order
+    """
+    return ChannelMap.for_channels(ch_names).standard_picks()
 
 
 class EDFReader(MNEBaseReader):
     """Suit of methods for edf files"""
 
-    def __init__(self, file_path):
-        MNEBaseReader.__init__(self, file_path)
+    def __init__(self, file_path, preload=False):
+        MNEBaseReader.__init__(self, file_path, preload=preload)
 
-    def read_raw(self, file_path):
-        return mne.io.read_raw_edf(file_path)
+    def read_raw(self, file_path, preload=False):
+        return mne.io.read_raw_edf(file_path, preload=preload)
 
     ### LEGACY METHODS FOR AI DEVELOPMENT
     def data_to_resampled_matrix(self, new_samplerate):
@@ -31,49 +39,9 @@ class EDFReader(MNEBaseReader):
         """Returns data as a numpy matrix excluding rows from non-standard
         electrodes
         """
-        KEPT_ELECTRODES = [
-            "Fp1",
-            "F3",
-            "F7",
-            "C3",
-            "T3",
-            "P3",
-            "T5",
-            "O1",
-            "Pz",
-            "Fp2",
-            "Fz",
-            "F4",
-            "F8",
-            "Cz",
-            "C4",
-            "T4",
-            "P4",
-            "T6",
-            "O2",
-        ]
-        # Different labels for the same electrodes
-        KEPT_ELECTRODES.extend(["T7", "P7", "T8", "P8"])
-        # # HACK: EXTENDING FOR DANI DELAY
-        # KEPT_ELECTRODES.extend(['A1', 'A2'])
-
-        # Electrodes labels look like "EEG Fp1", apply for string matching
-        kept_e = [el_label.upper() for el_label in KEPT_ELECTRODES]
-
         eeg = self.to_data_frame()
         ## TODO: FIX THE LABEL SLICING PROBLEM
-        # print(eeg)
         # Drop all electrodes aside from international standard
-        # def filter_row(row):
-        #     el_name = row.name.upper()
-        #     # Split on spaces
-        #     electrode = el_name.split(' ')[-1]
-        #     return any(label == electrode for label in kept_e)
-        # eeg = eeg[eeg.apply(filter_row, axis=1)]
-        eeg = eeg[
-            eeg.apply(
-                lambda row: any(label in row.name.upper() for label in kept_e), axis=1
-            )
-        ]
+        eeg = eeg.iloc[standard_electrode_picks(eeg.index)]
         # Would sort alphabetically for consistency, but assuming EDF has its own consistency
         return eeg.to_numpy()
@@ -0,0 +1,161 @@
+"""Decodes an EDF/EDF+ file incrementally, as its bytes arrive
+
+The header is parsed as soon as it is complete, and every data record
+received after that is decoded straight away. Samples come out the way
+mne.io.read_raw_edf would give them: in volts, without the EDF+
+annotation signal.
+
+Only continuous files whose signals share one sample rate, have a
+digital range and whose header states the number of records are
+supported (see EdfRecordDecoder.supported); anything else, EDF+D files
+with gaps between their records among them, has to be read whole with
+mne.
+"""
+import numpy as np
+
+# Signal holding EDF+ annotations rather than samples
+ANNOTATION_LABEL = "EDF Annotations"
+# Physical dimension -> factor to volts, others are left unscaled
+UNIT_SCALINGS = {"V": 1.0, "MV": 1e-3, "UV": 1e-6, "NV": 1e-9}
+
+FIXED_HEADER_BYTES = 256
+# Width of each per-signal header field, in file order
+SIGNAL_FIELDS = [
+    ("label", 16),
+    ("transducer", 80),
+    ("dimension", 8),
+    ("physical_min", 8),
+    ("physical_max", 8),
+    ("digital_min", 8),
+    ("digital_max", 8),
+    ("prefilter", 80),
+    ("samples_per_record", 8),
+    ("reserved", 32),
+]
+
+
+def _field(raw, start, length):
+    return raw[start:start + length].decode("latin-1").strip()
+
+
+def parse_header(raw):
+    """Parses a complete EDF header (fixed part and signal fields)
+
+    raw: bytes of at least the header's length
+    returns: dict of num_records, record_duration, num_signals,
+        discontinuous (EDF+D) and one list per signal field
+    """
+    header = {
+        "header_bytes": int(_field(raw, 184, 8)),
+        "discontinuous": _field(raw, 192, 44).startswith("EDF+D"),
+        "num_records": int(_field(raw, 236, 8)),
+        "record_duration": float(_field(raw, 244, 8)),
+        "num_signals": int(_field(raw, 252, 4)),
+    }
+    ns = header["num_signals"]
+    offset = FIXED_HEADER_BYTES
+    for name, width in SIGNAL_FIELDS:
+        header[name] = [_field(raw, offset + i * width, width) for i in range(ns)]
+        offset += ns * width
+    for name in ("physical_min", "physical_max", "digital_min", "digital_max"):
+        header[name] = [float(v) for v in header[name]]
+    header["samples_per_record"] = [int(v) for v in header["samples_per_record"]]
+    return header
+
+
+class EdfRecordDecoder:
+    """Feed it the bytes of an EDF file in order, get back its samples
+    one batch of complete data records at a time
+    """
+
+    def __init__(self):
+        self.header = None
+        self._buffer = bytearray()
+        # Samples decoded so far, per channel
+        self.num_decoded = 0
+
+    def feed(self, data, digital=False):
+        """Takes the next bytes of the file
+
+        digital: return the stored integers rather than volts, which
+            read as digital * gains[i] + offsets[i] for channel i
+        returns: list of (start, block) where block is a
+            (#channels)x(#samples) float64 matrix in volts and start is
+            the index of its first sample, empty until the header is in
+        """
+        self._buffer += data
+        if self.header is None and not self._parse_header():
+            return []
+        if not self.supported:
+            # Nothing to decode, don't hold on to the bytes either
+            self._buffer.clear()
+            return []
+
+        num_records = len(self._buffer) // self.record_bytes
+        if num_records == 0:
+            return []
+        used = num_records * self.record_bytes
+        records = np.frombuffer(bytes(self._buffer[:used]), dtype="<i2")
+        del self._buffer[:used]
+        records = records.reshape(num_records, -1)
+
+        shape = (len(self.ch_names), num_records * self.samples_per_record)
+        block = np.empty(shape, dtype=np.int16 if digital else np.float64)
+        for row, column in enumerate(self._data_columns):
+            values = records[:, column:column + self.samples_per_record].reshape(-1)
+            block[row] = values if digital else values * self.gains[row] + self.offsets[row]
+
+        start = self.num_decoded
+        self.num_decoded += block.shape[1]
+        return [(start, block)]
+
+    def _parse_header(self):
+        if len(self._buffer) < FIXED_HEADER_BYTES:
+            return False
+        header_bytes = int(_field(bytes(self._buffer), 184, 8))
+        if len(self._buffer) < header_bytes:
+            return False
+        self.header = parse_header(bytes(self._buffer[:header_bytes]))
+        del self._buffer[:header_bytes]
+
+        header = self.header
+        # First column of each signal within a record
+        columns = np.cumsum([0] + header["samples_per_record"][:-1])
+        data_signals = [
+            i for i, label in enumerate(header["label"]) if label != ANNOTATION_LABEL
+        ]
+        self.record_bytes = 2 * sum(header["samples_per_record"])
+        self.ch_names = [header["label"][i] for i in data_signals]
+        self._data_columns = [int(columns[i]) for i in data_signals]
+
+        rates = {header["samples_per_record"][i] for i in data_signals}
+        self.supported = (
+            len(rates) == 1 and header["num_records"] > 0 and header["record_duration"] > 0
+            # Records of EDF+D files aren't back to back in time
+            and not header["discontinuous"]
+            # No gain maps digital values to physical ones otherwise
+            and all(header["digital_max"][i] != header["digital_min"][i] for i in data_signals)
+        )
+        if not self.supported:
+            return True
+        self.samples_per_record = rates.pop()
+        self.sample_rate = self.samples_per_record / header["record_duration"]
+        self.num_samples = header["num_records"] * self.samples_per_record
+
+        # physical = digital * gain + offset, then scaled to volts
+        self.gains = np.empty(len(data_signals))
+        self.offsets = np.empty(len(data_signals))
+        for row, i in enumerate(data_signals):
+            pmin, pmax = header["physical_min"][i], header["physical_max"][i]
+            dmin, dmax = header["digital_min"][i], header["digital_max"][i]
+            dimension = header["dimension"][i].replace("µ", "u").upper()
+            unit = UNIT_SCALINGS.get(dimension, 1.0)
+            gain = (pmax - pmin) / (dmax - dmin)
+            self.gains[row] = gain * unit
+            self.offsets[row] = (pmin - dmin * gain) * unit
+        return True
+
+    @property
+    def complete(self):
+        """Whether every record the header announced has been decoded"""
+        return self.header is not None and self.supported and self.num_decoded >= self.num_samples
@@ -9,5 +9,5 @@ from .mne_base_reader import MNEBaseReader
 class FIFReader(MNEBaseReader):
     """Suit of methods for fif files"""
 
-    def __init__(self, file_path):
-        MNEBaseReader.__init__(self, file_path)
+    def __init__(self, file_path, preload=True):
+        MNEBaseReader.__init__(self, file_path, preload=preload)
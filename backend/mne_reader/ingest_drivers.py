@@ -0,0 +1,105 @@
+"""One ingestion driver per recording format the server accepts
+
+A driver knows how to open a format with mne and how to make the FIF
+copy the rest of the server works with. Conversions run in worker
+processes (see webserver.conversion_jobs), so this module only depends
+on mne, never on the webserver.
+"""
+import time
+
+import mne
+
+from .display_filter import BODY_MOTION_FILTER
+
+
+class IngestDriver:
+    """Reads one recording format; subclasses set extensions and
+    implement read_raw
+    """
+
+    # File extensions of the format, without the dot
+    extensions = ()
+    # Name reported in conversion metrics
+    name = None
+    # DisplayFilter recordings of the format are shown with by default
+    display_filter = None
+
+    def read_raw(self, filepath, preload=False):
+        """Opens filepath as an mne Raw"""
+        raise NotImplementedError
+
+    def fif_path(self, filepath):
+        """Where the FIF copy of filepath goes"""
+        return '.'.join(filepath.split('.')[:-1]) + '_raw.fif'
+
+    def convert_to_fif(self, filepath):
+        """Saves filepath as FIF, returns the path of the copy"""
+        # Saving to another file copies buffer by buffer, no need to preload
+        raw = self.read_raw(filepath, preload=False)
+        fif_path = self.fif_path(filepath)
+        raw.save(fif_path, overwrite=True)
+        return fif_path
+
+
+class EdfDriver(IngestDriver):
+    extensions = ('edf',)
+    name = 'edf'
+
+    def read_raw(self, filepath, preload=False):
+        return mne.io.read_raw_edf(filepath, preload=preload)
+
+
+class NihonKohdenDriver(IngestDriver):
+    extensions = ('EEG',)
+    name = 'nihon_kohden'
+    display_filter = BODY_MOTION_FILTER
+
+    def read_raw(self, filepath, preload=False):
+        return mne.io.read_raw_nihon(filepath, preload=preload)
+
+
+class CntDriver(IngestDriver):
+    extensions = ('cnt',)
+    name = 'cnt'
+
+    def read_raw(self, filepath, preload=False):
+        return mne.io.read_raw_cnt(filepath, preload=preload)
+
+
+class FifDriver(IngestDriver):
+    extensions = ('fif',)
+    name = 'fif'
+
+    def read_raw(self, filepath, preload=False):
+        return mne.io.read_raw_fif(filepath, preload=preload)
+
+
+# Extension -> driver of every supported format
+DRIVERS = {
+    extension: driver
+    for driver in (EdfDriver(), NihonKohdenDriver(), CntDriver(), FifDriver())
+    for extension in driver.extensions
+}
+
+
+def driver_for(filepath):
+    """The driver of filepath's format, by extension
+
+    Raises ValueError for formats without one
+    """
+    extension = filepath.split('.')[-1]
+    try:
+        return DRIVERS[extension]
+    except KeyError:
+        raise ValueError(f"Unsupported recording format .{extension}") from None
+
+
+def run_conversion(filepath):
+    """Entry point of conversion worker processes
+
+    returns: dict of fif_path and when the conversion started and
+        finished, in seconds since the epoch
+    """
+    started = time.time()
+    fif_path = driver_for(filepath).convert_to_fif(filepath)
+    return {'fif_path': fif_path, 'started': started, 'finished': time.time()}
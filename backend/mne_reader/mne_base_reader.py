@@ -2,33 +2,77 @@
 into model interpretable data or act (say, visualize) on the data
 """
 import mne
+import numpy as np
 import pandas as pd
 from scipy import signal
 
+from .montage import Montage
+
 
 class MNEBaseReader:
     """Suit of methods for raw"""
 
-    def __init__(self, file_path):
+    def __init__(self, file_path, preload=True):
+        """file_path: path to the recording
+        preload: read all samples into RAM now; when False samples stay
+            on disk until something needs them
+        """
         self.file_path = file_path
-        self.raw = self.read_raw(file_path)
+        self.raw = self.read_raw(file_path, preload=preload)
         self.info = self.raw.info
         self.sample_rate = self.info["sfreq"]
-        self.df = self.raw.to_data_frame(scalings={"eeg": 1})
+        self.num_samples = self.raw.n_times
+        # Built on first access of self.df, see below
+        self._df = None
         print(f"This file has a sample rate of {self.sample_rate}Hz")
 
-    def read_raw(self, file_path):
+    @property
+    def df(self):
+        """(#timesteps)x(#electrodes) dataframe of the raw, converted
+        lazily since most callers never need it
+        """
+        if self._df is None:
+            self._df = self.raw.to_data_frame(scalings={"eeg": 1})
+        return self._df
+
+    @df.setter
+    def df(self, df):
+        self._df = df
+
+    def read_raw(self, file_path, preload=True):
         """Reads a raw from file and returns"""
         # Note: Passing this preload=True method is a compute-time expensive
         # work-around to the .save() method not allowing save to the same file
         # This loads all data into RAM immediately (thus every time this)
         # class is init'ed) rather than leaving a memory map.
-        return mne.io.read_raw_fif(file_path, preload=True)
+        return mne.io.read_raw_fif(file_path, preload=preload)
 
     def filter_body_motion(self):
         """Applies a 0.57hz lowpass filter to the data"""
+        self.raw.load_data()
         self.raw.filter(0.57, 35)
-        self.df = self.raw.to_data_frame(scalings={"eeg": 1})
+        self._df = None
+
+    def data_blocks(self, block_size, start=0):
+        """Yields (start, matrix) over the recording from sample start on,
+        where matrix is (#electrodes)x(block_size) scaled like
+        to_data_frame, so only one block is ever held in memory
+        """
+        for start in range(start, self.num_samples, block_size):
+            stop = min(start + block_size, self.num_samples)
+            df = self.raw.to_data_frame(scalings={"eeg": 1}, start=start, stop=stop)
+            df = df.drop(columns="time", errors="ignore")
+            yield start, df.to_numpy().T
+
+    def preview_block(self, num_samples):
+        """Returns the first num_samples as a (#electrodes)x(num_samples)
+        matrix scaled like to_data_frame, reading only those samples.
+        """
+        stop = min(self.num_samples, num_samples)
+        if stop == 0:
+            return np.empty((len(self.raw.ch_names), 0))
+        df = self.raw.to_data_frame(scalings={"eeg": 1}, start=0, stop=stop)
+        return df.drop(columns="time", errors="ignore").to_numpy().T
 
     def bipolar_preprocess_DEPRECATE_SOON(self):
         """Applies a standard bipolar montage subtraction to the dataframe
@@ -62,16 +106,11 @@ class MNEBaseReader:
             ['T2','T1'],
         ]
 
-        kept_columns = []
-        for m in montage:
-            if not m[0] in df.columns or not m[1] in df.columns:
-                continue
-            column_name = f'{m[0]}-{m[1]}'
-            kept_columns.append(column_name)
-            # Create the new bipolar columns
-            df[column_name] = df[m[0]] - df[m[1]]
+        # Bipolar columns computed through the shared montage engine
+        engine = Montage.from_pairs(montage, df.columns, match='exact')
+        bipolar = engine.derive(df.iloc[:, engine.picks].to_numpy().T)
         # Keep only bipolar columns
-        self.df = df[kept_columns]
+        self.df = pd.DataFrame(bipolar.T, index=df.index, columns=engine.labels)
 
     def to_data_frame(self):
         """Returns a dataframe of (#electrodes)x(#timesteps)"""
@@ -83,8 +122,11 @@ class MNEBaseReader:
 
     def resample(self, sample_rate):
         """Change the samplerate"""
+        self.raw.load_data()
         self.raw.resample(sample_rate)
         self.sample_rate = self.raw.info["sfreq"]
+        self.num_samples = self.raw.n_times
+        self._df = None
 
     def get_annotations_as_df(self):
         """Grab the annotations stored in the original file as
@@ -106,5 +148,11 @@ class MNEBaseReader:
         annotations = mne.Annotations(onsets, durations, descriptions)
         self.raw.set_annotations(annotations)
 
-    def save(self):
-        self.raw.save(self.file_path, overwrite=True)
\ No newline at end of file
+    def save(self, path=None):
+        """Saves the recording to path, over its own file by default"""
+        if path is None or path == self.file_path:
+            # Saving over the file being read needs the samples in memory
+            self.raw.load_data()
+            path = self.file_path
+        # Saving to another file copies buffer by buffer otherwise
+        self.raw.save(path, overwrite=True)
\ No newline at end of file
@@ -0,0 +1,93 @@
+"""Montages as sparse reference matrices
+
+A montage is a list of derivations, each a weighted sum of recorded
+channels: a bipolar pair [e0, e1] is e0 - e1, a lone electrode is
+itself. Stored as a sparse (#derivations)x(#picked channels) matrix it
+can be applied to any slice of samples on demand, so changing montage
+never touches the full recording.
+"""
+import numpy as np
+from scipy import sparse
+
+from .channel_map import ChannelMap
+
+
+class Montage:
+    """Sparse channel derivations, see module docstring"""
+
+    def __init__(self, labels, picks, rows, cols, weights):
+        """labels: name of each derivation
+        picks: recorded channel indices the montage reads, sorted
+        rows, cols, weights: COO entries, cols index into picks
+        """
+        self.labels = list(labels)
+        self.picks = [int(p) for p in picks]
+        self.matrix = sparse.csr_matrix(
+            (np.asarray(weights, dtype=np.float32), (rows, cols)),
+            shape=(len(self.labels), len(self.picks)),
+        )
+
+    @classmethod
+    def from_pairs(cls, montage, ch_names, match="electrode"):
+        """Builds a montage from the client's list of [e0, e1] pairs
+
+        montage: list of pairs, [e0, ''] or [e0] keep e0 as is
+        ch_names: labels of the recorded channels
+        match: see ChannelMap.index_of
+
+        Derivations referencing an electrode missing from ch_names
+        are dropped.
+        """
+        channel_map = ChannelMap.for_channels(ch_names)
+        labels, entries = [], []
+        for m in montage:
+            electrodes = [el for el in m if el != ""]
+            if len(electrodes) == 0:
+                # Montage is empty, ignore
+                continue
+            found = [channel_map.index_of(el, match) for el in electrodes[:2]]
+            if None in found:
+                # Electrode name is not contained in recording, ignore
+                continue
+            if len(found) == 1:
+                labels.append(electrodes[0])
+                entries.append([(found[0], 1.0)])
+            else:
+                labels.append(f"{electrodes[0]}-{electrodes[1]}")
+                entries.append([(found[0], 1.0), (found[1], -1.0)])
+
+        picks = sorted({ch for row in entries for ch, _ in row})
+        column_of = {ch: j for j, ch in enumerate(picks)}
+        rows, cols, weights = [], [], []
+        for i, row in enumerate(entries):
+            for ch, w in row:
+                rows.append(i)
+                cols.append(column_of[ch])
+                weights.append(w)
+        return cls(labels, picks, rows, cols, weights)
+
+    def derive(self, picked):
+        """Applies the montage to samples of the picked channels only
+
+        picked: (#picks)x(#samples) matrix, rows ordered as self.picks
+        returns (#derivations)x(#samples)
+        """
+        return np.asarray(self.matrix @ picked)
+
+    def apply(self, samples):
+        """Applies the montage to a full (#channels)x(#samples) matrix"""
+        return self.derive(samples[self.picks])
+
+    def to_dict(self):
+        coo = self.matrix.tocoo()
+        return {
+            "labels": self.labels,
+            "picks": self.picks,
+            "rows": coo.row.tolist(),
+            "cols": coo.col.tolist(),
+            "weights": coo.data.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d["labels"], d["picks"], d["rows"], d["cols"], d["weights"])
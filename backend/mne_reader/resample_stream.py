@@ -0,0 +1,60 @@
+"""Reads an mne Raw in bounded blocks, resampled on the fly
+
+Each block is read with some extra samples on both sides, resampled
+with a polyphase filter and trimmed back, so block edges line up
+exactly and don't carry the filter's edge artifacts. Only a block (plus
+padding) is ever in memory, whatever the length of the recording.
+"""
+from fractions import Fraction
+import numpy as np
+from scipy import signal
+
+# Largest denominator accepted when turning the rate ratio into up/down
+MAX_RATE_DENOMINATOR = 1000
+
+
+def resample_ratio(old_samplerate, new_samplerate):
+    """Returns (up, down) such that new = old * up / down"""
+    ratio = Fraction(float(new_samplerate) / float(old_samplerate))
+    ratio = ratio.limit_denominator(MAX_RATE_DENOMINATOR)
+    return ratio.numerator, ratio.denominator
+
+
+def resampled_length(num_samples, old_samplerate, new_samplerate):
+    """Number of samples the whole recording has at new_samplerate"""
+    return int(num_samples * (float(new_samplerate) / float(old_samplerate)))
+
+
+def iter_resampled_blocks(raw, new_samplerate, picks=None, block_seconds=60, pad_seconds=2):
+    """Yields (start, block) over the whole raw, where block is a
+    (#picks)x(#samples) matrix at new_samplerate and start is the index
+    of its first sample in the resampled recording
+
+    raw: mne.io.Raw, preloaded or not
+    picks: channel indices to read, defaults to all
+    block_seconds: length of source data resampled at a time
+    pad_seconds: context read on each side of a block and trimmed off
+    """
+    old_samplerate = raw.info["sfreq"]
+    up, down = resample_ratio(old_samplerate, new_samplerate)
+    num_samples = raw.n_times
+
+    # Block and padding lengths are multiples of down so every trim
+    # point falls exactly on an output sample
+    block = max(int(block_seconds * old_samplerate) // down, 1) * down
+    pad = int(np.ceil(pad_seconds * old_samplerate / down)) * down
+
+    for src_start in range(0, num_samples, block):
+        src_stop = min(src_start + block, num_samples)
+        read_start = max(src_start - pad, 0)
+        read_stop = min(src_stop + pad, num_samples)
+        data = raw.get_data(picks, start=read_start, stop=read_stop)
+
+        if up == down:
+            resampled = data
+        else:
+            resampled = signal.resample_poly(data, up, down, axis=1, padtype="line")
+
+        trim = (src_start - read_start) * up // down
+        keep = -(-(src_stop - src_start) * up // down)
+        yield src_start * up // down, resampled[:, trim : trim + keep]
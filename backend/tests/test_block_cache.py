@@ -0,0 +1,88 @@
+import numpy as np
+
+from backend.webserver.block_cache import BlockCache
+
+
+class Loader:
+    """Recording whose sample i is i, counting the blocks it loads"""
+
+    def __init__(self, num_channels=2):
+        self.num_channels = num_channels
+        self.loads = []
+
+    def __call__(self, b_start, b_end):
+        self.loads.append((b_start, b_end))
+        return np.tile(np.arange(b_start, b_end, dtype=np.float32), (self.num_channels, 1))
+
+
+def _cache(**kwargs):
+    kwargs.setdefault("block_samples", 10)
+    kwargs.setdefault("prefetch_blocks", 0)
+    return BlockCache(**kwargs)
+
+
+def test_reads_across_blocks():
+    cache, load = _cache(), Loader()
+    samples = cache.read_range("rec", "s1", 5, 27, 100, 100, load)
+    np.testing.assert_array_equal(samples[0], np.arange(5, 27))
+    assert load.loads == [(0, 10), (10, 20), (20, 30)]
+    # Copies, callers can't alter cached blocks
+    samples[:] = -1
+    np.testing.assert_array_equal(cache.read_range("rec", "s1", 5, 27, 100, 100, load)[0], np.arange(5, 27))
+    assert len(load.loads) == 3 and cache.stats()["hits"] == 3
+
+
+def test_lru_bounded_by_bytes():
+    # Two channels of 10 float32 samples: 80 bytes a block
+    cache, load = _cache(max_bytes=240), Loader()
+    for block in range(4):
+        cache.read_range("rec", "s1", block * 10, block * 10 + 10, 100, 100, load)
+    stats = cache.stats()
+    assert stats["blocks"] == 3 and stats["bytes"] == 240 and stats["evictions"] == 1
+    # Block 0 was least recently used
+    cache.read_range("rec", "s1", 0, 10, 100, 100, load)
+    assert load.loads[-1] == (0, 10)
+    # Blocks larger than the whole cache are never kept
+    big = _cache(max_bytes=40)
+    big.read_range("rec", "s1", 0, 10, 100, 100, load)
+    assert big.stats()["blocks"] == 0
+
+
+def test_pending_blocks_not_cached():
+    cache, load = _cache(), Loader()
+    cache.read_range("rec", "s1", 0, 20, 100, 15, load)
+    assert cache.stats()["blocks"] == 1
+
+
+def test_sessions_share_stored_blocks_only():
+    cache, load = _cache(), Loader()
+    cache.read_range("rec", "s1", 0, 10, 100, 100, load)
+    cache.read_range("rec", "s2", 0, 10, 100, 100, load)
+    assert len(load.loads) == 1
+    cache.read_range("rec", "s2", 0, 10, 100, 100, load, derived=True)
+    assert len(load.loads) == 2
+    # A session's montage changing leaves blocks as stored alone
+    cache.invalidate("s2")
+    cache.read_range("rec", "s1", 0, 10, 100, 100, load)
+    cache.read_range("rec", "s2", 0, 10, 100, 100, load, derived=True)
+    assert len(load.loads) == 3
+
+
+def test_invalidate_during_load_skips_the_block():
+    cache, load = _cache(), Loader()
+
+    def racing(b_start, b_end):
+        cache.invalidate("s1")
+        return load(b_start, b_end)
+    cache.read_range("rec", "s1", 0, 10, 100, 100, racing, derived=True)
+    assert cache.stats()["blocks"] == 0
+    cache.forget_store("rec")
+    assert cache.stats()["bytes"] == 0
+
+
+def test_prefetch_follows_scrolling():
+    cache, load = _cache(prefetch_blocks=2), Loader()
+    cache.read_range("rec", "s1", 50, 60, 100, 100, load)
+    cache._prefetcher.shutdown(wait=True)
+    assert sorted(load.loads) == [(50, 60), (60, 70), (70, 80)]
+    assert cache.stats()["prefetched"] == 2
@@ -0,0 +1,33 @@
+import numpy as np
+
+from backend.mne_reader.channel_map import ChannelMap, canonical_electrode
+
+
+def test_canonical_electrode():
+    assert canonical_electrode("EEG Fp1-REF") == "FP1"
+    assert canonical_electrode("POL FP1") == "FP1"
+    assert canonical_electrode("Fp1-LE") == "FP1"
+    assert canonical_electrode("EEG T7") == "T3"
+    assert canonical_electrode("EKG1 - something long") is None
+
+
+def test_picks_in_file_order():
+    channel_map = ChannelMap(["EEG T7-REF", "EEG FP1-REF", "ECG", "EEG C3-REF"])
+    np.testing.assert_array_equal(channel_map.picks(["C3", "T3", "Fp1"]), [0, 1, 3])
+    np.testing.assert_array_equal(channel_map.picks(["O2"]), [])
+
+
+def test_standard_picks_skip_other_channels():
+    names = ["EEG FP1-REF", "EEG EKG1-REF", "EEG T8-REF", "Photic", "EEG PZ-REF"]
+    np.testing.assert_array_equal(ChannelMap(names).standard_picks(), [0, 2, 4])
+
+
+def test_index_of():
+    channel_map = ChannelMap(["EEG FP1-REF", "Fp1"])
+    assert channel_map.index_of("Fp1") == 1
+    assert channel_map.index_of("FP1") == 0
+    assert channel_map.index_of("FP1", match="exact") is None
+
+
+def test_for_channels_is_cached():
+    assert ChannelMap.for_channels(["a", "b"]) is ChannelMap.for_channels(("a", "b"))
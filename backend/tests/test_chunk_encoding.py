@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from backend.webserver.chunk_encoding import MAGIC, decode_chunk, encode_chunk
+
+
+def test_float32_round_trip():
+    samples = np.random.default_rng(0).normal(size=(3, 100))
+    body = encode_chunk(samples, ["Fp1", "F3", "C3"], 256, 40)
+    header, decoded = decode_chunk(body)
+    assert body[:4] == MAGIC
+    assert header["channels"] == ["Fp1", "F3", "C3"]
+    assert header["sample_rate"] == 256.0
+    assert (header["i_start"], header["i_end"], header["num_samples"]) == (40, 140, 100)
+    np.testing.assert_array_equal(decoded, samples.astype(np.float32))
+
+
+def test_payload_is_aligned():
+    for name in ("a", "ab", "abc", "abcd"):
+        body = encode_chunk(np.zeros((1, 5)), [name], 256, 0)
+        header_len = int.from_bytes(body[4:8], "little")
+        assert (8 + header_len) % 4 == 0
+
+
+def test_int16_within_one_step():
+    samples = np.random.default_rng(1).normal(scale=1e-4, size=(2, 500))
+    header, decoded = decode_chunk(encode_chunk(samples, ["a", "b"], 256, 0, encoding="int16"))
+    steps = np.asarray(header["scales"])[:, None]
+    assert np.all(np.abs(decoded - samples) <= steps / 2 + 1e-12)
+
+
+def test_int16_flat_and_empty_channels():
+    flat = np.full((1, 10), 3e-5)
+    _, decoded = decode_chunk(encode_chunk(flat, ["a"], 256, 0, encoding="int16"))
+    np.testing.assert_allclose(decoded, flat)
+    header, decoded = decode_chunk(encode_chunk(np.empty((2, 0)), ["a", "b"], 256, 7, encoding="int16"))
+    assert decoded.shape == (2, 0) and header["i_end"] == 7
+
+
+def test_envelope_range():
+    header, _ = decode_chunk(encode_chunk(np.zeros((1, 8)), ["a"], 256, 64, decimation=16))
+    # 4 bins of 16 samples each, min and max interleaved
+    assert header["i_end"] == 64 + 4 * 16
+
+
+def test_rejects_unknown_input():
+    with pytest.raises(ValueError):
+        encode_chunk(np.zeros((1, 1)), ["a"], 256, 0, encoding="int8")
+    with pytest.raises(ValueError):
+        decode_chunk(b"XXXX" + bytes(8))
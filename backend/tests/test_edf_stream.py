@@ -0,0 +1,85 @@
+import mne
+import numpy as np
+import pytest
+
+from backend.mne_reader.edf_stream import EdfRecordDecoder
+
+pyedflib = pytest.importorskip("pyedflib")
+
+
+@pytest.fixture(scope="module")
+def edf_path(tmp_path_factory):
+    """20 s of 3 channels at 256 Hz, in uV, with an annotation signal"""
+    samples = np.random.default_rng(0).normal(scale=50, size=(3, 256 * 20))
+    path = str(tmp_path_factory.mktemp("edf") / "rec.edf")
+    writer = pyedflib.EdfWriter(path, 3, file_type=pyedflib.FILETYPE_EDFPLUS)
+    writer.setSignalHeaders([
+        {
+            "label": label, "dimension": "uV", "sample_frequency": 256,
+            "physical_min": -400.0 - i, "physical_max": 400.0 + i,
+            "digital_min": -32768, "digital_max": 32767,
+            "transducer": "", "prefilter": "",
+        }
+        for i, label in enumerate(["Fp1", "F3", "C3"])
+    ])
+    writer.writeSamples(list(samples))
+    writer.writeAnnotation(1.0, 0.5, "spike")
+    writer.close()
+    return path
+
+
+def _decode(data, piece=1000, digital=False):
+    decoder = EdfRecordDecoder()
+    blocks = []
+    for offset in range(0, len(data), piece):
+        blocks += decoder.feed(data[offset:offset + piece], digital=digital)
+    return decoder, blocks
+
+
+def test_matches_mne(edf_path):
+    with open(edf_path, "rb") as f:
+        data = f.read()
+    decoder, blocks = _decode(data)
+    raw = mne.io.read_raw_edf(edf_path, preload=True, verbose=False)
+    assert decoder.supported and decoder.complete
+    assert decoder.ch_names == raw.ch_names
+    assert decoder.sample_rate == raw.info["sfreq"]
+    assert [start for start, _ in blocks] == list(
+        np.cumsum([0] + [b.shape[1] for _, b in blocks[:-1]])
+    )
+    decoded = np.concatenate([b for _, b in blocks], axis=1)
+    np.testing.assert_allclose(decoded, raw.get_data(), rtol=0, atol=1e-12)
+
+
+def test_digital_with_gains(edf_path):
+    with open(edf_path, "rb") as f:
+        data = f.read()
+    decoder, blocks = _decode(data, digital=True)
+    _, volts = _decode(data)
+    digital = np.concatenate([b for _, b in blocks], axis=1)
+    assert digital.dtype == np.int16
+    np.testing.assert_allclose(
+        digital * decoder.gains[:, None] + decoder.offsets[:, None],
+        np.concatenate([b for _, b in volts], axis=1),
+    )
+
+
+def _signal_field_offset(data, index):
+    """Byte offset of per-signal field index (0 = label) of signal 0"""
+    num_signals = int(data[252:256])
+    widths = [16, 80, 8, 8, 8, 8, 8, 80, 8, 32]
+    return 256 + num_signals * sum(widths[:index])
+
+
+def test_unsupported_files_are_left_to_mne(edf_path):
+    with open(edf_path, "rb") as f:
+        data = bytearray(f.read())
+    discontinuous = bytearray(data)
+    discontinuous[192:197] = b"EDF+D"
+    assert not _decode(bytes(discontinuous))[0].supported
+
+    flat = bytearray(data)
+    digital_min, digital_max = _signal_field_offset(data, 5), _signal_field_offset(data, 6)
+    flat[digital_max:digital_max + 8] = flat[digital_min:digital_min + 8]
+    decoder, blocks = _decode(bytes(flat))
+    assert not decoder.supported and blocks == []
@@ -0,0 +1,56 @@
+import numpy as np
+
+from backend.webserver.envelope_pyramid import FACTOR, EnvelopePyramid, envelope_from_samples
+from backend.webserver.sample_store import SampleStore
+
+
+def _reference(samples, decimation):
+    """Min and max of every decimation samples, the last bin partial"""
+    bins = range(0, samples.shape[1], decimation)
+    return (
+        np.stack([samples[:, b:b + decimation].min(axis=1) for b in bins], axis=1),
+        np.stack([samples[:, b:b + decimation].max(axis=1) for b in bins], axis=1),
+    )
+
+
+def test_envelope_from_samples_interleaves_min_max():
+    samples = np.random.default_rng(0).normal(size=(2, 103))
+    envelope = envelope_from_samples(samples, 10)
+    lo, hi = _reference(samples, 10)
+    np.testing.assert_array_equal(envelope[:, 0::2], lo)
+    np.testing.assert_array_equal(envelope[:, 1::2], hi)
+
+
+def test_levels_match_raw_min_max(tmp_path):
+    store = SampleStore(directory=str(tmp_path) + "/")
+    samples = np.random.default_rng(1).normal(size=(3, 70000)).astype(np.float32)
+    samples[1, 12345] = 50.0
+    writer = store.create("k", ["a", "b", "c"], 256, samples.shape[1])
+    writer.write(0, samples)
+    writer.close()
+
+    pyramid = EnvelopePyramid(store)
+    pyramid.build("k")
+    levels = pyramid.read_meta("k")["levels"]
+    assert [level["decimation"] for level in levels] == [FACTOR ** (i + 1) for i in range(len(levels))]
+    for level in levels:
+        envelope, start = pyramid.envelope("k", level, 0, samples.shape[1])
+        lo, hi = _reference(samples, level["decimation"])
+        assert start == 0
+        np.testing.assert_array_equal(envelope[:, 0::2], lo)
+        np.testing.assert_array_equal(envelope[:, 1::2], hi)
+        # A single spike survives every level
+        assert envelope[1].max() == 50.0
+
+
+def test_choose_level(tmp_path):
+    store = SampleStore(directory=str(tmp_path) + "/")
+    writer = store.create("k", ["a"], 256, 40000)
+    writer.write(0, np.zeros((1, 40000)))
+    writer.close()
+    pyramid = EnvelopePyramid(store)
+    pyramid.build("k")
+    assert pyramid.choose_level("k", 40000, max_points=40000) is None
+    assert pyramid.choose_level("k", 40000, max_points=1000)["decimation"] == 16
+    assert pyramid.choose_level("k", 40000, decimation=100)["decimation"] == 64
+    assert pyramid.choose_level("missing", 40000, max_points=10) is None
@@ -0,0 +1,44 @@
+import numpy as np
+
+from backend.mne_reader.montage import Montage
+
+CH_NAMES = ["EEG FP1-REF", "EEG F3-REF", "EEG C3-REF", "EEG P3-REF", "EEG O1-REF"]
+
+
+def _dense(montage, ch_names):
+    """The montage as a dense (#derivations)x(#channels) matrix"""
+    index = {name.split()[1].split("-")[0].upper(): i for i, name in enumerate(ch_names)}
+    matrix = np.zeros((len(montage), len(ch_names)))
+    for row, pair in enumerate(montage):
+        matrix[row, index[pair[0].upper()]] = 1.0
+        if len(pair) > 1 and pair[1]:
+            matrix[row, index[pair[1].upper()]] -= 1.0
+    return matrix
+
+
+def test_matches_dense_matrix():
+    pairs = [["Fp1", "F3"], ["F3", "C3"], ["C3", "P3"], ["P3", "O1"], ["Fp1", ""], ["C3"]]
+    montage = Montage.from_pairs(pairs, CH_NAMES)
+    samples = np.random.default_rng(0).normal(size=(len(CH_NAMES), 300))
+    assert montage.labels == ["Fp1-F3", "F3-C3", "C3-P3", "P3-O1", "Fp1", "C3"]
+    np.testing.assert_allclose(montage.apply(samples), _dense(pairs, CH_NAMES) @ samples, rtol=1e-6)
+
+
+def test_reads_only_the_picked_channels():
+    montage = Montage.from_pairs([["C3", "P3"]], CH_NAMES)
+    samples = np.random.default_rng(1).normal(size=(len(CH_NAMES), 50))
+    assert montage.picks == [2, 3]
+    np.testing.assert_allclose(montage.derive(samples[montage.picks]), samples[[2]] - samples[[3]], rtol=1e-6)
+
+
+def test_drops_missing_electrodes():
+    montage = Montage.from_pairs([["Fp1", "T4"], [""], ["O1", "F3"]], CH_NAMES)
+    assert montage.labels == ["O1-F3"]
+
+
+def test_dict_round_trip():
+    montage = Montage.from_pairs([["Fp1", "F3"], ["O1"]], CH_NAMES)
+    copy = Montage.from_dict(montage.to_dict())
+    samples = np.random.default_rng(2).normal(size=(len(CH_NAMES), 20))
+    assert copy.labels == montage.labels and copy.picks == montage.picks
+    np.testing.assert_array_equal(copy.apply(samples), montage.apply(samples))
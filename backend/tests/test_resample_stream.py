@@ -0,0 +1,49 @@
+import mne
+import numpy as np
+import pytest
+from scipy import signal
+
+from backend.mne_reader.resample_stream import (
+    iter_resampled_blocks, resample_ratio, resampled_length
+)
+
+
+def _raw(num_samples, sfreq):
+    t = np.arange(num_samples) / sfreq
+    data = np.stack([np.sin(2 * np.pi * 3 * t), np.cos(2 * np.pi * 7 * t)])
+    return mne.io.RawArray(data, mne.create_info(["a", "b"], sfreq, "eeg"), verbose=False)
+
+
+def test_resample_ratio():
+    assert resample_ratio(256, 128) == (1, 2)
+    assert resample_ratio(500, 256) == (64, 125)
+    assert resample_ratio(200, 200) == (1, 1)
+
+
+@pytest.mark.parametrize("sfreq,new,num_samples", [
+    (256, 128, 256 * 30 + 3),
+    (500, 256, 500 * 25 + 1),
+    (200, 200, 2000),
+    (250, 256, 250 * 13),
+])
+def test_blocks_cover_resampled_length(sfreq, new, num_samples):
+    raw = _raw(num_samples, sfreq)
+    blocks = list(iter_resampled_blocks(raw, new, block_seconds=4, pad_seconds=1))
+    position = 0
+    for start, block in blocks:
+        assert start == position
+        position += block.shape[1]
+    up, down = resample_ratio(sfreq, new)
+    # Every output sample of the source, as resample_poly would give
+    assert position == -(-num_samples * up // down)
+    assert abs(position - resampled_length(num_samples, sfreq, new)) <= 1
+
+
+def test_blocks_match_whole_resample():
+    raw = _raw(256 * 40, 256)
+    blocked = np.concatenate(
+        [b for _, b in iter_resampled_blocks(raw, 128, block_seconds=5, pad_seconds=2)], axis=1
+    )
+    whole = signal.resample_poly(raw.get_data(), 1, 2, axis=1, padtype="line")
+    # Padding hides block edges, apart from the filter's own tails
+    np.testing.assert_allclose(blocked[:, 64:-64], whole[:, 64:-64], atol=1e-3)
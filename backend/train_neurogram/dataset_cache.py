@@ -0,0 +1,227 @@
+"""Precomputed training features, cached per source file
+
+Building the training set means parsing every .csv and .edf, resampling,
+chopping into windows and transforming them. Here that is done once per
+file: the features of each file's windows are saved as a .npy shard
+named after a hash of the file's contents and of the parameters the
+features were made with. Later builds only process files that are new
+or changed, and training memory-maps the shards instead of reloading
+the sources.
+
+A manifest next to the shards records the label and content hash of
+every source file, so unchanged files aren't even hashed again.
+
+Build, or bring up to date, the cache of the training folders with
+    python -m backend.train_neurogram.dataset_cache
+and add a patient folder kept anywhere else with
+    python -m backend.train_neurogram.dataset_cache <folder> <label>
+"""
+import hashlib
+import json
+import os
+import sys
+
+import numpy as np
+
+from ..transformations import fft_features
+from .load_data import (
+    DESIRED_SAMPLE_RATE,
+    EXPECTED_SHAPE,
+    E_NEGATIVE_DIR,
+    E_POSITIVE_DIR,
+    ValidationError,
+    folder_files,
+    load_files,
+)
+
+# Relative to this module, like the training data
+CACHE_DIR = "../data/dataset_cache/"
+# Bump whenever windows or features are made differently, so every
+# shard is rebuilt
+FORMAT_VERSION = 1
+# Feature name -> function of a (#windows)x(#electrodes)x(#timesteps) array
+FEATURES = {"fft": fft_features, "raw": lambda windows: windows}
+# Bytes read at a time when hashing a source file
+HASH_READ_BYTES = 1 << 20
+
+
+def _module_path(path):
+    this_file_path = "/".join((os.path.abspath(__file__)).split("/")[:-1])
+    return os.path.join(this_file_path, path)
+
+
+class DatasetCache:
+    """Feature shards of the source files of a training set"""
+
+    def __init__(self, directory=CACHE_DIR, feature="fft"):
+        """directory: where shards go, relative to this module or
+            absolute, ending in a slash
+        feature: name of the transform applied to windows, see FEATURES
+        """
+        self.directory = _module_path(directory)
+        self.feature = feature
+        self.params = {
+            "version": FORMAT_VERSION,
+            "feature": feature,
+            "sample_rate": DESIRED_SAMPLE_RATE,
+            "shape": list(EXPECTED_SHAPE),
+        }
+        os.makedirs(self.directory, exist_ok=True)
+        self.manifest = self._read_manifest()
+
+    @property
+    def manifest_path(self):
+        return self.directory + "manifest.json"
+
+    def _read_manifest(self):
+        try:
+            with open(self.manifest_path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"files": {}}
+
+    def _write_manifest(self):
+        # Replaced whole so an interrupted build never leaves it half written
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    def file_hash(self, file_path):
+        """sha256 of a file's contents, reused while its size and
+        modification time don't change
+        """
+        stat = os.stat(file_path)
+        entry = self.manifest["files"].get(file_path)
+        if (
+            entry is not None
+            and entry["size"] == stat.st_size
+            and entry["mtime_ns"] == stat.st_mtime_ns
+        ):
+            return entry["sha256"]
+
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(HASH_READ_BYTES), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def shard_key(self, file_hash):
+        """Name of the shard of a file's contents under these params"""
+        params = json.dumps(self.params, sort_keys=True)
+        return hashlib.sha256((file_hash + params).encode()).hexdigest()[:32]
+
+    def shard_path(self, key):
+        return self.directory + key + ".npy"
+
+    def _list_file(self, file_path, samplerate, label):
+        """Records a source file in the manifest, returns its shard key"""
+        stat = os.stat(file_path)
+        file_hash = self.file_hash(file_path)
+        self.manifest["files"][file_path] = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": file_hash,
+            "samplerate": samplerate,
+            "label": label,
+        }
+        return self.shard_key(file_hash)
+
+    def _write_shard(self, key, data_list):
+        if len(data_list) > 0:
+            windows = np.asarray(data_list)
+        else:
+            windows = np.empty((0, *EXPECTED_SHAPE))
+        features = FEATURES[self.feature](windows)
+        tmp_path = self.shard_path(key) + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, features)
+        os.replace(tmp_path, self.shard_path(key))
+
+    def add_files(self, files, label, workers=1):
+        """Makes sure every (file path, samplerate) of files, see
+        load_data.folder_files, is listed and has its shard, processing
+        only new or changed files, on workers processes
+
+        returns: number of files processed
+        """
+        missing = []
+        for file_path, samplerate in files:
+            file_path = os.path.abspath(file_path)
+            key = self._list_file(file_path, samplerate, label)
+            if not os.path.isfile(self.shard_path(key)):
+                missing.append((file_path, samplerate, key))
+        # Files listed without a shard are processed on the next build
+        self._write_manifest()
+
+        loaded = load_files([(p, samplerate) for p, samplerate, _ in missing], workers)
+        for (_, data_list, error), (_, _, key) in zip(loaded, missing):
+            if error is None or isinstance(error, ValidationError):
+                # Malformed files get an empty shard so they aren't read again,
+                # other failures are retried next time
+                self._write_shard(key, data_list)
+        return len(missing)
+
+    def add_folder(self, folder_path, label, workers=1):
+        """Adds every file of the patient subdirectories of a folder,
+        see add_files
+
+        returns: number of files processed
+        """
+        return self.add_files(folder_files(folder_path), label, workers)
+
+    def build(self, workers=1):
+        """Brings the cache up to date with the training folders
+
+        workers: processes loading files in parallel
+        returns: number of files processed
+        """
+        processed = self.add_folder(E_POSITIVE_DIR, 1, workers)
+        processed += self.add_folder(E_NEGATIVE_DIR, 0, workers)
+        # Deleted source files leave the training set
+        files = self.manifest["files"]
+        for file_path in [p for p in files if not os.path.isfile(p)]:
+            del files[file_path]
+        self._write_manifest()
+        return processed
+
+    def prune(self):
+        """Removes shards no listed file uses under these params, which
+        includes every shard made with other params
+        """
+        files = self.manifest["files"]
+        keys = {self.shard_key(entry["sha256"]) for entry in files.values()}
+        for name in os.listdir(self.directory):
+            if name.endswith(".npy") and name[: -len(".npy")] not in keys:
+                os.remove(self.directory + name)
+
+    def shards(self):
+        """Returns (memory-mapped features, label) of every listed file
+        whose shard exists, in a stable order
+        """
+        shards = []
+        for file_path in sorted(self.manifest["files"]):
+            entry = self.manifest["files"][file_path]
+            path = self.shard_path(self.shard_key(entry["sha256"]))
+            if os.path.isfile(path):
+                shards.append((np.load(path, mmap_mode="r"), entry["label"]))
+        return shards
+
+    def load(self):
+        """Returns features, labels of every cached window as np arrays"""
+        shards = [(f, label) for f, label in self.shards() if len(f) > 0]
+        if len(shards) == 0:
+            return np.empty((0, *EXPECTED_SHAPE)), np.empty(0, dtype=int)
+        features = np.concatenate([f for f, _ in shards])
+        labels = np.concatenate([np.full(len(f), label) for f, label in shards])
+        return features, labels
+
+
+if __name__ == "__main__":
+    cache = DatasetCache()
+    if len(sys.argv) > 2:
+        cache.add_folder(os.path.abspath(sys.argv[1]), int(sys.argv[2]), os.cpu_count())
+    else:
+        cache.build(os.cpu_count())
+    features, labels = cache.load()
+    print(f"Cached features, labels: {features.shape}, {labels.shape}")
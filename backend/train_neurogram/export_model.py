@@ -0,0 +1,70 @@
+"""Exports trained Keras models for classify_epilepsy.numpy_model
+
+The layers of a model, the layer options inference depends on and the
+weights go into a single compressed .npz next to the model, which the
+webserver classifies with instead of loading TensorFlow.
+
+Export a stored model with
+    python -m backend.train_neurogram.export_model <model.h5>
+"""
+import json
+import sys
+
+import numpy as np
+
+# Layer type -> config entries inference needs
+EXPORTED_CONFIG = {
+    "Conv2D": ["strides", "padding", "data_format", "dilation_rate", "activation"],
+    "Dense": ["activation"],
+    "LeakyReLU": [],
+    "Activation": ["activation"],
+    "Flatten": [],
+    "Dropout": [],
+    "InputLayer": [],
+}
+
+
+def export_model(model, path):
+    """Writes the layers and weights of a Keras Sequential model to a
+    .npz file at path
+    """
+    layers = []
+    arrays = {}
+    for i, layer in enumerate(model.layers):
+        kind = type(layer).__name__
+        if kind not in EXPORTED_CONFIG:
+            raise ValueError(f"Can't export layer {layer.name} of type {kind}")
+        config = layer.get_config()
+        spec = {"type": kind}
+        for key in EXPORTED_CONFIG[kind]:
+            if key in config:
+                spec[key] = config[key]
+        if kind == "LeakyReLU":
+            # Renamed negative_slope by Keras 3
+            spec["alpha"] = float(config.get("alpha", config.get("negative_slope", 0.3)))
+
+        weights = layer.get_weights()
+        spec["weights"] = len(weights)
+        for j, weight in enumerate(weights):
+            arrays[f"layer{i}_{j}"] = np.asarray(weight, dtype=np.float32)
+        layers.append(spec)
+
+    spec = {"input_shape": list(model.input_shape[1:]), "layers": layers}
+    np.savez_compressed(path, spec=np.array(json.dumps(spec)), **arrays)
+
+
+def export_stored_model(model_path):
+    """Exports a saved .h5 model to the .npz of the same name
+
+    returns: path of the .npz
+    """
+    from tensorflow import keras
+
+    npz_path = model_path.rsplit(".", 1)[0] + ".npz"
+    export_model(keras.models.load_model(model_path), npz_path)
+    return npz_path
+
+
+if __name__ == "__main__":
+    for model_path in sys.argv[1:]:
+        print(f"Exported {export_stored_model(model_path)}")
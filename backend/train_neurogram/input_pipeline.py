@@ -0,0 +1,121 @@
+"""Training batches read from feature shards on disk
+
+The windows of a training set are never held in memory all at once.
+Every window is addressed by its index into the shards of a
+DatasetCache, so balancing, shuffling and splitting into training and
+testing sets only ever move arrays of indices around. Batches are
+gathered from the memory-mapped shards as they are needed.
+"""
+import numpy as np
+
+
+class ShardedDataset:
+    """Windows and labels of a list of feature shards, by index"""
+
+    def __init__(self, shards):
+        """shards: list of (features, label), features being an array
+        (memory-mapped, ideally) of (#windows)x(#electrodes)x(#timesteps)
+        as returned by DatasetCache.shards
+        """
+        self.shards = [f for f, _ in shards if len(f) > 0]
+        labels = [label for f, label in shards if len(f) > 0]
+        lengths = [len(f) for f in self.shards]
+        # Index of the first window of each shard
+        self.offsets = np.cumsum([0] + lengths)
+        self.labels = np.repeat(np.asarray(labels, dtype=int), lengths)
+        if self.shards:
+            self.window_shape = self.shards[0].shape[1:]
+            self.dtype = self.shards[0].dtype
+        else:
+            self.window_shape, self.dtype = (0, 0), np.float64
+
+    def __len__(self):
+        return len(self.labels)
+
+    def balanced_indices(self, indices=None, seed=None):
+        """Indices keeping every epileptic window and as many
+        non-epileptic ones, picked at random
+
+        indices: to pick from, defaults to every window
+        """
+        indices = np.arange(len(self)) if indices is None else np.asarray(indices)
+        rng = np.random.default_rng(seed)
+        positive = indices[self.labels[indices] == 1]
+        negative = indices[self.labels[indices] == 0]
+        negative = rng.choice(negative, min(len(positive), len(negative)), replace=False)
+        return np.sort(np.concatenate([positive, negative]))
+
+    def split(self, ratio, indices=None, seed=None):
+        """Shuffles indices and splits them into (training, testing),
+        ratio of them going to training
+
+        indices: to split, defaults to every window
+        """
+        indices = np.arange(len(self)) if indices is None else np.asarray(indices)
+        indices = np.random.default_rng(seed).permutation(indices)
+        split = int(ratio * len(indices))
+        return indices[:split], indices[split:]
+
+    def class_weight(self, indices):
+        """Keras class_weight balancing the labels of indices
+
+        Raises ValueError when either label is missing from indices,
+        there being nothing to balance against
+        """
+        counts = np.bincount(self.labels[indices], minlength=2)
+        if counts[0] == 0 or counts[1] == 0:
+            raise ValueError(
+                f"Can't balance {counts[0]} non-epileptic and {counts[1]} epileptic windows"
+            )
+        return {0: float(counts[1] / counts[0]), 1: 1.0}
+
+    def take(self, indices):
+        """Returns features, labels of indices, in their order, reading
+        only those windows from disk
+
+        Features are shaped (n_images, x_shape, y_shape, channels) for
+        the model.
+        """
+        indices = np.asarray(indices, dtype=int)
+        features = np.empty((len(indices), *self.window_shape), dtype=self.dtype)
+        shard_of = np.searchsorted(self.offsets, indices, side="right") - 1
+        for s in np.unique(shard_of):
+            rows = np.nonzero(shard_of == s)[0]
+            # Sorted reads keep the memory map sequential
+            order = np.argsort(indices[rows])
+            local = indices[rows][order] - self.offsets[s]
+            features[rows[order]] = self.shards[s][local]
+        return features[..., np.newaxis], self.labels[indices]
+
+    def batches(self, indices, batch_size=32, shuffle=False, seed=None):
+        """Generator of (features, labels) batches of indices, see take
+
+        shuffle: visit indices in a random order, drawn from seed
+        """
+        indices = np.asarray(indices, dtype=int)
+        if shuffle:
+            indices = np.random.default_rng(seed).permutation(indices)
+        # One pass per call, the way tf.data expects
+        for b in range(0, len(indices), batch_size):
+            yield self.take(indices[b : b + batch_size])
+
+    def tf_dataset(self, indices, batch_size=32, shuffle=False, seed=None):
+        """tf.data.Dataset of the batches of indices, reshuffled every
+        epoch when shuffle is set, read ahead while the model trains
+        """
+        import tensorflow as tf
+
+        rng = np.random.default_rng(seed)
+        signature = (
+            tf.TensorSpec(shape=(None, *self.window_shape, 1), dtype=tf.as_dtype(self.dtype)),
+            tf.TensorSpec(shape=(None,), dtype=tf.int64),
+        )
+
+        def generator():
+            # A new seed every epoch, each epoch shuffled differently
+            epoch_seed = rng.integers(1 << 31)
+            for features, labels in self.batches(indices, batch_size, shuffle, epoch_seed):
+                yield features, labels.astype(np.int64)
+
+        dataset = tf.data.Dataset.from_generator(generator, output_signature=signature)
+        return dataset.prefetch(tf.data.AUTOTUNE)
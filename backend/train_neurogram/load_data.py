@@ -12,58 +12,40 @@ Expected file structure
 ./<PATIENT_NAME>_<E, NE>/<*>.csv"""
 import os
 import random
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
 from scipy import signal
 
-from ..edf_reader import EDFReader
+from ..mne_reader.edf_reader import EDFReader
+from ..mne_reader.channel_map import ChannelMap
 
 # International standard; 19 electrodes
 # Expecting 1 second epoch at 500hz
 DESIRED_SAMPLE_RATE = 500
 EXPECTED_SHAPE = (19, 500)
 
+# Relative to this module
+DATA_DIR = "../data/data_training/"
+E_POSITIVE_DIR = DATA_DIR + "epileptic"
+E_NEGATIVE_DIR = DATA_DIR + "non_epileptic"
+
+
+class ValidationError(ValueError):
+    """Raised when a file doesn't hold the expected electrodes"""
+
 
 def eeg_to_matrix(eeg):
     """Excludes non-standard electrodes, leaving 19,
     Trims the expected unnecessary columns from a loaded eeg .csv
     and returns as a numpy matrix shape (19 X width)
     """
-    KEPT_ELECTRODES = [
-        "Fp1",
-        "F3",
-        "F7",
-        "C3",
-        "T3",
-        "P3",
-        "T5",
-        "O1",
-        "Pz",
-        "Fp2",
-        "Fz",
-        "F4",
-        "F8",
-        "Cz",
-        "C4",
-        "T4",
-        "P4",
-        "T6",
-        "O2",
-    ]
-    # Different labels for the same electrodes
-    KEPT_ELECTRODES.extend(["T7", "P7", "T8", "P8"])
-    # Electrodes labels look like "EEG Fp1", apply for string matching
-    kept_labels = [el_label.upper() for el_label in KEPT_ELECTRODES]
-
     # Drop all electrodes aside from international standard
     # WARNING: Not safe to assume Time is a column on all .edf imports
     if "Time" in eeg:
-        eeg = eeg[
-            eeg.apply(
-                lambda row: any(label in row[0].upper() for label in kept_labels),
-                axis=1,
-            )
-        ]
+        # Electrodes labels look like "EEG Fp1", first column holds them
+        picks = ChannelMap.for_channels(eeg.iloc[:, 0]).standard_picks()
+        eeg = eeg.iloc[picks]
 
         # Sort alphabetically by electrode label (just for consistent ordering)
         ## Disabled since behavior is not replicated in EDFs
@@ -128,18 +110,18 @@ def chop_into_windows(data, window_width):
 def data_from_csv(file_path, csv_sample_rate):
     """Loads .csv into a list of .5 second chunks
     Upsamples the data to 500Hz before cutting
-    Returns a list of matrices
+    Returns a list of matrices, raises ValidationError if malformed
     """
     eeg = pd.read_csv(file_path, engine="python")
     data_matrix = eeg_to_matrix(eeg)
 
     def validation_err():
-        print(f"Validation failed: {file_path}", end=" || ")
-        print(f"Expected shape: ({EXPECTED_SHAPE[0]}, _), got {data_matrix.shape}")
+        # Reported, and the file skipped, by load_files
+        raise ValidationError(
+            f"Expected shape: ({EXPECTED_SHAPE[0]}, _), got {data_matrix.shape}"
+        )
 
-    if not validate_matrix(data_matrix, validation_err):
-        # Return a dead list to be ignored if malformed data
-        return []
+    validate_matrix(data_matrix, validation_err)
 
     if csv_sample_rate != 500:
         # Resample to 500hz
@@ -162,10 +144,22 @@ def data_from_edf(file_path):
     return data_list
 
 
-def load_from_folder(folder_path, label):
-    """Loads data from a given folder, marking each the same label
-    Handles .csv and .edf separately
-    Loads in the shape of standard EEG matrices [(19eX250)]
+def data_from_file(file_path, samplerate):
+    """Loads a .csv or .edf into a list of .5 second chunks,
+    an empty list for any other file
+
+    samplerate: sample rate of .csv files, see folder_files
+    """
+    if file_path.endswith(".csv"):
+        return data_from_csv(file_path, samplerate)
+    elif file_path.endswith(".edf"):
+        return data_from_edf(file_path)
+    return []
+
+
+def folder_files(folder_path):
+    """Returns (file path, samplerate) of every file in the patient
+    subdirectories of a folder, in the order they are loaded
 
     Determines whether to resample by the number in the directory path
         THIS CAN POSE A PROBLEM IF THERE'S A "500" STRING ANYWHERE
@@ -173,59 +167,111 @@ def load_from_folder(folder_path, label):
     If detects a 500, leaves samplerate alone
     If detects a 200, upsamples to 500hz
 
-    Returns a tuple of two lists: a list of standard EEG matrics,
-            a list of the same length containing the data's label,
+    folder_path: relative to this module, or absolute
     """
-    matrix_list = []
+    files = []
     # Get path to current file so this can be called from anywhere
     this_file_path = "/".join((os.path.abspath(__file__)).split("/")[:-1])
-    curr_dir_path = this_file_path + "/" + folder_path
+    curr_dir_path = os.path.join(this_file_path, folder_path)
     # grab subdirectory paths in the current directory
     # [1:] excludes the current './' directory
-    directory_names = [x[0] for x in os.walk(curr_dir_path)][1:]
+    # Sorted so data loads in the same order on every machine
+    directory_names = sorted(x[0] for x in os.walk(curr_dir_path))[1:]
     for directory in directory_names:
         # Set samplerate to 200 if 500 isn't found in the directory name
         samplerate = 200
         if "500" in directory:
             samplerate = 500
 
-        for file_name in os.listdir(directory):
+        for file_name in sorted(os.listdir(directory)):
             # sees every file in the parent folder
-            file_path = directory + "/" + file_name
-
-            loaded_data = []
-            if file_name.endswith(".csv"):
-                loaded_data = data_from_csv(file_path, samplerate)
-            elif file_name.endswith(".edf"):
-                loaded_data = data_from_edf(file_path)
-            matrix_list.extend(loaded_data)
+            files.append((directory + "/" + file_name, samplerate))
+    return files
+
+
+def _load_file(file_path, samplerate):
+    """data_from_file that returns, rather than raises, its exception"""
+    try:
+        return data_from_file(file_path, samplerate), None
+    except Exception as e:
+        return [], e
+
+
+def load_files(files, workers=1):
+    """Loads (file path, samplerate) files, see folder_files, on workers
+    processes, printing progress along the way
+
+    A file that fails to load is reported and skipped, the others load.
+    Yields (file path, list of matrices, exception or None) in the order of
+        files, whatever order the workers finish in
+    """
+    pool = None
+    if workers <= 1:
+        results = (_load_file(*f) for f in files)
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers)
+        futures = [pool.submit(_load_file, *f) for f in files]
+        results = (future.result() for future in futures)
+    try:
+        for i, ((file_path, _), (data_list, error)) in enumerate(zip(files, results)):
+            if error is not None:
+                print(f"Loading failed: {file_path} || {type(error).__name__}: {error}")
+            print(f"{i + 1}/{len(files)} files loaded", end="\r")
+            yield file_path, data_list, error
+    finally:
+        if pool is not None:
+            # Stopped early, don't load what nobody will read
+            for future in futures:
+                future.cancel()
+            pool.shutdown()
+
+
+def load_from_folder(folder_path, label, workers=1, errors=None):
+    """Loads data from a given folder, marking each the same label
+    Handles .csv and .edf separately, see folder_files for sample rates
+    Loads in the shape of standard EEG matrices [(19eX250)]
+
+    workers: processes loading files in parallel, see load_files
+    errors: optional list extended with (file path, exception) of the
+        files that failed to load
+
+    Returns a tuple of two lists: a list of standard EEG matrics,
+            a list of the same length containing the data's label,
+    """
+    matrix_list = []
+    for file_path, data_list, error in load_files(folder_files(folder_path), workers):
+        matrix_list.extend(data_list)
+        if error is not None and errors is not None:
+            errors.append((file_path, error))
     # Generate labels and return
     label_list = [label] * len(matrix_list)
     return matrix_list, label_list
 
 
-def load_training_data(shuffle_data=True, balance_data=True):
+def load_training_data(shuffle_data=True, balance_data=True, workers=1):
     """Returns a tuple of two values: a list of EEG matrices, a list of Epilepsy labels
     Data is gathered by loading every .csv in each subdirectory to this one
     Labels are gathered by looked at the suffix of the subdirectory
 
     if balance_data is True, will throw out most non-epileptic events
     at random, keeping only as many as there are epileptic event
-    """
-    data_dir = "../data/data_training/"
-    e_positive_dir = data_dir + "epileptic"
-    e_negative_dir = data_dir + "non_epileptic"
 
+    workers: processes loading files in parallel, os.cpu_count() uses
+    every core; the data comes out the same whatever the number
+    """
     print("====== Loading data ======")
-    print(f"Loading from ./{data_dir}")
+    print(f"Loading from ./{DATA_DIR}")
     print(f"Shuffle data: {shuffle_data}")
     print("Chill for a sec, this'll take a bit.")
 
-    pos_matrices, pos_labels = load_from_folder(e_positive_dir, 1)
-    neg_matrices, neg_labels = load_from_folder(e_negative_dir, 0)
+    errors = []
+    pos_matrices, pos_labels = load_from_folder(E_POSITIVE_DIR, 1, workers, errors)
+    neg_matrices, neg_labels = load_from_folder(E_NEGATIVE_DIR, 0, workers, errors)
 
     print("")
     print("Loaded.")
+    if errors:
+        print(f"Skipped {len(errors)} files that failed to load")
     print(f"Count epileptic: {len(pos_labels)}")
     print(f"Count non-epileptic: {len(neg_labels)}")
 
@@ -254,4 +300,4 @@ def load_training_data(shuffle_data=True, balance_data=True):
 
 
 if __name__ == "__main__":
-    m, l = load_training_data()
+    m, l = load_training_data(workers=os.cpu_count())
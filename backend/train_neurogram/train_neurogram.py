@@ -9,9 +9,11 @@ from tensorflow.keras.callbacks import ModelCheckpoint
 import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
+import os
 
-from ..transformations import Transforms
-from .load_data import load_training_data
+from .dataset_cache import DatasetCache
+from .input_pipeline import ShardedDataset
+from .export_model import export_model
 
 # Neurogram trains on .5 second chunks at 500hz
 # across 19 standard electrodes
@@ -19,39 +21,31 @@ EEG_SHAPE = (19, 500)
 FILE_NAME = "neurogram_1.0.3"
 NUM_EPOCHS = 250
 
-data, labels = load_training_data(balance_data=False)
+BATCH_SIZE = 32
 
-# Fourier Transform all data
-trans = Transforms()
-data = trans.fourier_transform_all(data)
+# Fourier Transformed windows, the same features the classifier computes,
+# only files new since the last run are processed
+cache = DatasetCache(feature="fft")
+cache.build(workers=os.cpu_count())
+# Read from disk batch by batch, never held in memory as a whole
+dataset = ShardedDataset(cache.shards())
 
 # Split data, (SPLIT_RATIO) training set, (1 - SPLIT_RATIO) testing set
 SPLIT_RATIO = 0.8
-split = int(SPLIT_RATIO * len(labels))
+train_indices, test_indices = dataset.split(SPLIT_RATIO)
 
-train_data, test_data = data[:split], data[split:]
-train_labels, test_labels = labels[:split], labels[split:]
-
-# Reshape to (n_images, x_shape, y_shape, channels)
-s = train_data.shape
-train_data = train_data.reshape(s[0], s[1], s[2], 1)
-s = test_data.shape
-test_data = test_data.reshape(s[0], s[1], s[2], 1)
+train_data = dataset.tf_dataset(train_indices, BATCH_SIZE, shuffle=True)
+test_data = dataset.tf_dataset(test_indices, BATCH_SIZE)
 
 # balance class weights
-_, counts = np.unique(train_labels, return_counts=True)
-class_weight = {0: float(counts[1]) / counts[0], 1: 1.0}
+class_weight = dataset.class_weight(train_indices)
 print(f"Weights: {class_weight}")
 
 # Values are bounded between 1, -1 (as far as I've seen)
 # no need to normalize
 
-print("Train shapes: data, labels")
-print(train_data.shape)
-print(train_labels.shape)
-print("Test shapes: data, labels")
-print(test_data.shape)
-print(test_labels.shape)
+print(f"Window shape: {dataset.window_shape}")
+print(f"Train, test windows: {len(train_indices)}, {len(test_indices)}")
 
 
 def define_model():
@@ -80,8 +74,11 @@ def define_model():
     return model
 
 
-def train_model(model, train_X, train_Y, test_X, test_Y):
-    """Compiles then fits model to data"""
+def train_model(model, train_batches, test_batches):
+    """Compiles then fits model to data
+
+    train_batches, test_batches: tf.data.Datasets of (features, labels)
+    """
     other_metrics = [
         metrics.AUC(),
         metrics.Precision(),
@@ -101,12 +98,11 @@ def train_model(model, train_X, train_Y, test_X, test_Y):
         metrics=["accuracy", *other_metrics],
     )
     model_history = model.fit(
-        train_X,
-        train_Y,
+        train_batches,
         class_weight=class_weight,
         epochs=NUM_EPOCHS,
         callbacks=callbacks,
-        validation_data=(test_X, test_Y),
+        validation_data=test_batches,
     )
     return model_history
 
@@ -123,11 +119,11 @@ def plot_history(history):
 
 
 CNN_model = define_model()
-history = train_model(CNN_model, train_data, train_labels, test_data, test_labels)
+history = train_model(CNN_model, train_data, test_data)
 plot_history(history)
 
 print("====== Evaluating ======")
-eval_metrics = CNN_model.evaluate(test_data, test_labels, verbose=2)
+eval_metrics = CNN_model.evaluate(test_data, verbose=2)
 print(eval_metrics)
 accuracy = int(eval_metrics[1] * 100)
 
@@ -135,3 +131,7 @@ print("====== Saving ======")
 save_file = f"../stored_models/{FILE_NAME}.{accuracy}acc.h5"
 CNN_model.save(save_file)
 print(f"Saving to {save_file}")
+# For classifying without TensorFlow
+export_file = f"../stored_models/{FILE_NAME}.{accuracy}acc.npz"
+export_model(CNN_model, export_file)
+print(f"Exporting to {export_file}")
@@ -1 +1,9 @@
 from .transformations import Transforms
+from .feature_engine import (
+    WindowStream,
+    entropy_features,
+    fft_features,
+    spectrogram_features,
+    window_starts,
+    windows,
+)
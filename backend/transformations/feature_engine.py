@@ -0,0 +1,129 @@
+"""Vectorised rolling-window features of (#channels)x(#samples) EEG data
+
+Training and classification both cut a recording into windows of
+window_size samples every step samples and transform each window. Here
+the windows are strided views of the recording, so overlapping windows
+share their samples instead of being copied, and every window of a
+batch is transformed in one call. Spectra come from a real FFT mirrored
+to the full length, which is exactly what scipy.fftpack.fft returns for
+real input, so features match the per-window loops of Transforms.
+
+Window starts follow the convention of the rest of the code base:
+range(0, #samples - window_size, step), the last possible window is
+left out.
+"""
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+import scipy.fft
+import scipy.stats
+
+# Electrodes C3, Cz, C4 (assuming 26 electrode EEG)
+SPECTROGRAM_ELECTRODES = [4, 17, 5]
+
+
+def window_starts(num_samples, window_size, step):
+    """Index of the first sample of every window"""
+    return np.arange(0, max(num_samples - window_size, 0), step)
+
+
+def windows(data, window_size, step):
+    """Strided (#windows)x(#channels)x(window_size) view of every window
+    of data, nothing is copied
+
+    data: np matrix of (#channels)x(#samples), or any array whose last
+        axis is time, in which case windows are taken along that axis
+        and stacked on a new axis before the channel axes
+    """
+    num_windows = len(window_starts(data.shape[-1], window_size, step))
+    view = sliding_window_view(data, window_size, axis=-1)
+    view = view[..., 0 : num_windows * step : step, :]
+    # Window axis first, right before the channel axes
+    return np.moveaxis(view, -2, 0)
+
+
+def fft_features(windows):
+    """Full complex spectrum of every row of windows, along the last axis
+
+    Equal to scipy.fftpack.fft(windows, axis=-1) for real input, at
+    about half the cost since only the non-redundant half is computed.
+    """
+    n = windows.shape[-1]
+    half = scipy.fft.rfft(windows, axis=-1)
+    # Negative frequencies are the conjugates of the positive ones
+    mirrored = np.conj(half[..., 1 : (n + 1) // 2][..., ::-1])
+    return np.concatenate([half, mirrored], axis=-1)
+
+
+def entropy_features(windows):
+    """Shannon entropy of every row of windows, along the last axis,
+    as scipy.stats.entropy would give it for each row
+    """
+    return scipy.stats.entropy(windows, axis=-1)
+
+
+def spectrogram_features(
+    scans, window_size=64, step=14, electrodes=SPECTROGRAM_ELECTRODES
+):
+    """Sliding-window spectra of a few electrodes of every scan
+
+    The spectra of the windows of each electrode are stacked as rows,
+    and the electrodes stacked on top of each other.
+
+    scans: np array of (#scans)x(#electrodes)x(#timesteps)
+    returns: np array of
+        (#scans)x(len(electrodes) * #windows)x(window_size)
+    """
+    scans = np.asarray(scans)[:, electrodes]
+    # (#windows)x(#scans)x(#electrodes)x(window_size)
+    spectra = fft_features(windows(scans, window_size, step))
+    spectra = spectra.transpose(1, 2, 0, 3)
+    return spectra.reshape(spectra.shape[0], -1, window_size)
+
+
+class WindowStream:
+    """Cuts a recording that arrives in consecutive blocks into windows
+
+    Samples shared by the windows on both sides of a block boundary are
+    carried over to the next block rather than read again, and only the
+    samples a later window still needs are kept.
+    """
+
+    def __init__(self, window_size, step, num_samples):
+        """num_samples: length of the whole recording, which decides
+        where the last window starts
+        """
+        self.window_size = window_size
+        self.step = step
+        self.last_start = num_samples - window_size
+        self._buffer = None
+        self._buffer_start = 0
+        self._next_start = 0
+
+    def feed(self, block):
+        """Takes the next (#channels)x(#samples) block of the recording
+
+        returns: (starts, windows) of every window that now fits, where
+            windows is a (#windows)x(#channels)x(window_size) view
+        """
+        if self._buffer is None:
+            self._buffer = block
+        else:
+            self._buffer = np.concatenate([self._buffer, block], axis=1)
+        buffer_end = self._buffer_start + self._buffer.shape[1]
+
+        stop = min(buffer_end - self.window_size + 1, self.last_start)
+        starts = np.arange(self._next_start, max(stop, self._next_start), self.step)
+        if len(starts) == 0:
+            empty = np.empty((0, self._buffer.shape[0], self.window_size))
+            return starts, empty
+
+        offset = int(starts[0]) - self._buffer_start
+        view = sliding_window_view(self._buffer, self.window_size, axis=1)
+        view = view[:, offset : offset + len(starts) * self.step : self.step]
+        self._next_start = int(starts[-1]) + self.step
+
+        # Drop samples no later window will need, the view keeps its own
+        drop = min(self._next_start - self._buffer_start, self._buffer.shape[1])
+        self._buffer = self._buffer[:, drop:]
+        self._buffer_start += drop
+        return starts, view.transpose(1, 0, 2)
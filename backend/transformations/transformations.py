@@ -6,6 +6,8 @@ import scipy.fftpack
 import scipy.stats
 import scipy.signal as signal
 
+from . import feature_engine
+
 
 class Transforms:
     """Data transformation methods"""
@@ -14,18 +16,10 @@ class Transforms:
         """Extract entropy data from EEG recordings
 
         data: list of eeg scan matrices
+        returns: np array of (#scans)x(#electrodes), the entropy of
+            every electrode of every scan
         """
-        transformed = []
-        for d in data:
-            d_transformed = []
-            for e in range(d.shape[0]):
-                x = d[e]
-                yf = scipy.stats.entropy(x)
-                d_transformed.append(yf)
-            d_transformed = np.asarray(d_transformed)
-            transformed.append(yf)
-        transformed = np.asarray(transformed)
-        return transformed
+        return feature_engine.entropy_features(np.asarray(data))
 
     def fourier_transform_1e(self, data, electrode=17):
         """Decomposes timeseries data from a single electrode
@@ -45,21 +39,10 @@ class Transforms:
     def fourier_transform_all(self, data):
         """Decomposes timeseries data from all electrodes into 2d array
 
-        data: list of eeg scan matrices
+        data: list of eeg scan matrices, or an np array of
+            (#scans)x(#electrodes)x(#timesteps)
         """
-        transformed = []
-        for d in data:
-            d_transformed = []
-            for e in range(d.shape[0]):
-                # Grab data from electrode e
-                x = d[e]
-                # transform
-                yf = scipy.fftpack.fft(x)
-                d_transformed.append(yf)
-            d_transformed = np.asarray(d_transformed)
-            transformed.append(d_transformed)
-        transformed = np.asarray(transformed)
-        return transformed
+        return feature_engine.fft_features(np.asarray(data))
 
     def hellohello_transform(self, data, window_size=64, step=14):
         """Transform based on notes provided by Daniele in Telegram post
@@ -72,30 +55,9 @@ class Transforms:
 
         data: list of eeg scan matrices
         """
-        # Electrodes C3, CZ, C4 (assuming 26 electrode EEG)
-        electrodes = [4, 17, 5]
-        transformed = []
-        for d in data:
-            d_transformed = []
-            for e in electrodes:
-                # Grab data from electrode e
-                x = d[e]
-                pseudo_filters = []
-                for i in range(0, len(x) - window_size, step):
-                    # Sliding window
-                    window = x[i : i + window_size]
-                    f_window = scipy.fftpack.fft(window)
-                    pseudo_filters.append(f_window)
-                # arrange matrix of window_size x num_windows
-                pseudo_filters = np.asarray(pseudo_filters)
-                # stack the electrodes on top
-                d_transformed.append(pseudo_filters)
-            # stack the electrodes vertically
-            d_transformed = np.asarray(d_transformed)
-            d_transformed = np.reshape(d_transformed, (96, 64))
-            transformed.append(d_transformed)
-        transformed = np.asarray(transformed)
-        return transformed
+        return feature_engine.spectrogram_features(
+            data, window_size=window_size, step=step
+        )
 
     def resample(self, data, samplerate, new_samplerate):
         """Applied Scipy's use of fourier transforms to resample data
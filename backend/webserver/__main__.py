@@ -1,11 +1,19 @@
-from .webserver import socketio, app
+from .webserver import socketio, app, warm_classifier
+from .chunked_upload import discard_unfinished_ingests
 
-log_string = "In backend/webserver/__main__.py"
-print(log_string)
-app.logger.info(log_string)
+# Guarded so worker processes (spawned for classification jobs)
+# can import this module without starting another server
+if __name__ == '__main__':
+    log_string = "In backend/webserver/__main__.py"
+    print(log_string)
+    app.logger.info(log_string)
+    # Ingestions cut short by the last shutdown are never finished
+    discard_unfinished_ingests()
+    # Load the default model before the first classification asks for it
+    warm_classifier()
 
-## VERIFY THIS BEFORE COMMITTING
-# For development
-socketio.run(app, host='127.0.0.1', port='5000', debug=True)
-# For live
-# socketio.run(app, host='0.0.0.0', port='8080')
\ No newline at end of file
+    ## VERIFY THIS BEFORE COMMITTING
+    # For development
+    socketio.run(app, host='127.0.0.1', port='5000', debug=True)
+    # For live
+    # socketio.run(app, host='0.0.0.0', port='8080')
\ No newline at end of file
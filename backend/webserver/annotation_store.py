@@ -0,0 +1,254 @@
+"""Keeps each session's annotations in SQLite rather than in the recording
+
+Saving annotations into a FIF means rewriting every sample of it, so
+edits only touch a small table here. They are written out once, when
+the recording is downloaded (see materialize), into a FIF copy of the
+session's own: recordings are shared by every session that uploaded
+the same file (see ingest_index) and are never written to, and may not
+be converted to FIF yet.
+"""
+import os
+import shutil
+import sqlite3
+from contextlib import closing, contextmanager
+
+import mne
+import pandas as pd
+
+from .eeg_reader import AgnosticReader
+from ..mne_reader.ingest_drivers import driver_for
+
+# Shared by every session, lives next to the cached recordings
+ANNOTATION_DB_FILENAME = '/tmp/ng_annotations.sqlite'
+# Sessions' annotated copies of their recordings, a directory per session
+DOWNLOAD_DIR = '/tmp/ng_downloads/'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS annotation_sessions (
+    sid TEXT PRIMARY KEY,
+    filepath TEXT NOT NULL,
+    dirty INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS annotations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    sid TEXT NOT NULL,
+    onset REAL NOT NULL,
+    duration REAL NOT NULL,
+    description TEXT NOT NULL,
+    -- What added the annotation ('classifier'...), NULL for the file
+    -- and the user
+    source TEXT
+);
+CREATE INDEX IF NOT EXISTS annotations_by_sid ON annotations (sid, onset);
+"""
+
+
+class AnnotationStore:
+    """Annotations of each session's recording, in seconds from its start"""
+
+    def __init__(self, path=ANNOTATION_DB_FILENAME):
+        self.path = path
+        with self._connect() as db:
+            db.executescript(_SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        """A connection per call, so any request thread can use the
+        store. Commits on exit, rolls back on an exception, and closes.
+        """
+        with closing(sqlite3.connect(self.path, timeout=10)) as db:
+            with db:
+                yield db
+
+    def load_from_file(self, sid, filepath):
+        """(Re)starts a session's annotations from those stored in filepath,
+        without reading any samples
+        """
+        try:
+            annotations = mne.read_annotations(filepath)
+            rows = zip(annotations.onset, annotations.duration, annotations.description)
+        except (OSError, ValueError):
+            # No annotations existed
+            rows = []
+        # Annotated for the annotations being replaced
+        self._delete_copy(sid)
+        with self._connect() as db:
+            db.execute("DELETE FROM annotations WHERE sid = ?", (sid,))
+            db.execute(
+                "INSERT OR REPLACE INTO annotation_sessions (sid, filepath, dirty) "
+                "VALUES (?, ?, 0)", (sid, filepath)
+            )
+            self._insert(db, sid, rows)
+
+    def forget(self, sid):
+        """Drops the session, its annotations and its annotated copy"""
+        self._delete_copy(sid)
+        with self._connect() as db:
+            db.execute("DELETE FROM annotations WHERE sid = ?", (sid,))
+            db.execute("DELETE FROM annotation_sessions WHERE sid = ?", (sid,))
+
+    def session_filepath(self, sid):
+        """The file the session's annotations belong to, None if unknown"""
+        with self._connect() as db:
+            row = db.execute(
+                "SELECT filepath FROM annotation_sessions WHERE sid = ?", (sid,)
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def is_loaded(self, sid, filepath):
+        """Whether the session's annotations were loaded from filepath"""
+        return self.session_filepath(sid) == filepath
+
+    def relocate(self, sid, filepath):
+        """Points the session's annotations at a converted copy of its
+        file, keeping any edits. Without edits they are reloaded from the
+        copy, which may carry annotations the original's reader couldn't.
+        """
+        if not self.is_dirty(sid):
+            self.load_from_file(sid, filepath)
+            return
+        with self._connect() as db:
+            db.execute(
+                "UPDATE annotation_sessions SET filepath = ? WHERE sid = ?", (filepath, sid)
+            )
+
+    def _insert(self, db, sid, rows, source=None):
+        ids = []
+        for onset, duration, description in rows:
+            cursor = db.execute(
+                "INSERT INTO annotations (sid, onset, duration, description, source) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (sid, float(onset), float(duration), str(description), source)
+            )
+            ids.append(cursor.lastrowid)
+        return ids
+
+    def _mark_dirty(self, db, sid):
+        db.execute("UPDATE annotation_sessions SET dirty = 1 WHERE sid = ?", (sid,))
+
+    def add(self, sid, onsets, durations, descriptions):
+        """Adds annotations to the session, returns their ids"""
+        with self._connect() as db:
+            ids = self._insert(db, sid, zip(onsets, durations, descriptions))
+            self._mark_dirty(db, sid)
+        return ids
+
+    def replace(self, sid, onsets, durations, descriptions):
+        """Replaces all of the session's annotations, returns their ids"""
+        with self._connect() as db:
+            db.execute("DELETE FROM annotations WHERE sid = ?", (sid,))
+            ids = self._insert(db, sid, zip(onsets, durations, descriptions))
+            self._mark_dirty(db, sid)
+        return ids
+
+    def replace_source(self, sid, source, onsets, durations, descriptions):
+        """Replaces the session's annotations added by source with these,
+        keeping every other one, returns the ids of the new ones
+        """
+        with self._connect() as db:
+            db.execute("DELETE FROM annotations WHERE sid = ? AND source = ?", (sid, source))
+            ids = self._insert(db, sid, zip(onsets, durations, descriptions), source)
+            self._mark_dirty(db, sid)
+        return ids
+
+    def update(self, sid, annotation_id, onset=None, duration=None, description=None):
+        """Changes the given fields of one annotation, which is the
+        user's from then on (see replace_source)
+
+        returns: whether the annotation existed
+        """
+        fields = {'onset': onset, 'duration': duration, 'description': description}
+        fields = {k: v for k, v in fields.items() if v is not None}
+        if not fields:
+            return self.get(sid, annotation_id) is not None
+        assignments = ", ".join(f"{k} = ?" for k in fields) + ", source = NULL"
+        with self._connect() as db:
+            cursor = db.execute(
+                f"UPDATE annotations SET {assignments} WHERE sid = ? AND id = ?",
+                (*fields.values(), sid, annotation_id)
+            )
+            self._mark_dirty(db, sid)
+        return cursor.rowcount > 0
+
+    def delete(self, sid, annotation_id):
+        """Removes one annotation, returns whether it existed"""
+        with self._connect() as db:
+            cursor = db.execute(
+                "DELETE FROM annotations WHERE sid = ? AND id = ?", (sid, annotation_id)
+            )
+            self._mark_dirty(db, sid)
+        return cursor.rowcount > 0
+
+    def get(self, sid, annotation_id):
+        """Returns (onset, duration, description) of one annotation or None"""
+        with self._connect() as db:
+            return db.execute(
+                "SELECT onset, duration, description FROM annotations "
+                "WHERE sid = ? AND id = ?", (sid, annotation_id)
+            ).fetchone()
+
+    def as_data_frame(self, sid):
+        """The session's annotations as a dataframe of id, onset,
+        duration, description sorted by onset. Onsets are timestamps
+        from the epoch, the way FIFReader.get_annotations_as_df returns
+        them for recordings without a measurement date
+        """
+        with self._connect() as db:
+            df = pd.read_sql_query(
+                "SELECT id, onset, duration, description FROM annotations "
+                "WHERE sid = ? ORDER BY onset, id", db, params=(sid,)
+            )
+        df['onset'] = pd.to_datetime(df['onset'], unit='s')
+        return df
+
+    def is_dirty(self, sid):
+        """Whether the session has edits its recording doesn't have yet"""
+        with self._connect() as db:
+            row = db.execute(
+                "SELECT dirty FROM annotation_sessions WHERE sid = ?", (sid,)
+            ).fetchone()
+        return row is not None and bool(row[0])
+
+    def copy_path(self, sid, filepath):
+        """Where the session's annotated copy of filepath goes, a FIF
+        whatever the format of filepath
+        """
+        if not filepath.endswith('.fif'):
+            filepath = driver_for(filepath).fif_path(filepath)
+        return DOWNLOAD_DIR + sid + '/' + os.path.basename(filepath)
+
+    def _delete_copy(self, sid):
+        shutil.rmtree(DOWNLOAD_DIR + sid, ignore_errors=True)
+
+    def materialize(self, sid, filepath):
+        """Writes the recording at filepath, of any format eeg_reader
+        reads, with the session's annotations to the session's copy of
+        it (see copy_path), if the copy is out of date. This copies the
+        whole recording; filepath is left as it is.
+
+        returns: path of the session's copy, None if the session never
+            edited its annotations and filepath is up to date
+        """
+        path = self.copy_path(sid, filepath)
+        if not self.is_dirty(sid):
+            return path if os.path.isfile(path) else None
+        # Samples are copied buffer by buffer, never all in memory
+        reader = AgnosticReader(filepath, preload=False)
+        with self._connect() as db:
+            rows = db.execute(
+                "SELECT onset, duration, description FROM annotations "
+                "WHERE sid = ? ORDER BY onset, id", (sid,)
+            ).fetchall()
+        onsets, durations, descriptions = (list(c) for c in zip(*rows)) if rows else ([], [], [])
+        reader.set_annotations(onsets, durations, descriptions)
+        # A copy of an older file of the session is of no use anymore
+        self._delete_copy(sid)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        reader.save(path)
+        with self._connect() as db:
+            db.execute("UPDATE annotation_sessions SET dirty = 0 WHERE sid = ?", (sid,))
+        return path
+
+
+# Shared by every request handled by this server process
+annotation_store = AnnotationStore()
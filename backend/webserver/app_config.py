@@ -11,7 +11,10 @@ cache = Cache()
 app = Flask("backend", static_folder="../react/build", template_folder="../react/build")
 config = {
     "SECRET_KEY": "dev",
-    "DEBUG": True
+    "DEBUG": True,
+    # Whether requests sent with an X-Profile header get profiled, see
+    # request_metrics. Profiling slows every request it samples down.
+    "PROFILE_REQUESTS": False
 }
 app.config.from_mapping(config)
 cache.init_app(app, config={'CACHE_TYPE': 'simple'})
@@ -0,0 +1,236 @@
+"""In-memory LRU cache of aligned sample blocks, shared by all sessions
+
+Chunks are assembled from fixed-size blocks of BLOCK_SAMPLES samples,
+so adjacent requests of a scrolling viewer reuse the blocks they share.
+The cache is bounded by the bytes it holds rather than by a count of
+blocks, and after every request the next blocks in the direction the
+session is scrolling are loaded ahead on a worker thread.
+
+Blocks are keyed by the store key of the recording they come from (see
+ingest_index), so sessions reading the same recording share its blocks
+as stored. Blocks derived with a session's montage or display filter
+are the session's own, and are dropped whenever these change (see
+invalidate), so they are always derived the way the session currently
+is. Blocks loaded while their store or session was invalidated are
+never cached.
+"""
+import itertools
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .sample_store import BLOCK_SAMPLES
+
+# Upper bound on the bytes of cached blocks
+MAX_CACHE_BYTES = 256 * 1024 * 1024
+# Blocks loaded ahead of a request in the scroll direction
+PREFETCH_BLOCKS = 2
+
+
+class BlockCache:
+    """Byte-bounded LRU of (store key, sid or None, generation, block
+    index) -> samples
+    """
+
+    def __init__(self, max_bytes=MAX_CACHE_BYTES, block_samples=BLOCK_SAMPLES,
+                 prefetch_blocks=PREFETCH_BLOCKS):
+        self.max_bytes = max_bytes
+        self.block_samples = block_samples
+        self.prefetch_blocks = prefetch_blocks
+        self._lock = threading.Lock()
+        self._blocks = OrderedDict()
+        self._bytes = 0
+        # ('store', store key) or ('session', sid) -> generation, a new
+        # one on every invalidate
+        self._generations = {}
+        self._counter = itertools.count()
+        # sid -> first block of the session's last request
+        self._last_block = {}
+        # Keys loaded by prefetch and not read since, or being loaded
+        self._prefetched = set()
+        self._in_flight = set()
+        self._prefetcher = ThreadPoolExecutor(max_workers=1)
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "prefetched": 0,
+            "prefetch_hits": 0,
+            "evictions": 0,
+        }
+
+    def _generation(self, scope):
+        """Generation of a store's or session's blocks, under the lock"""
+        if scope not in self._generations:
+            self._generations[scope] = next(self._counter)
+        return self._generations[scope]
+
+    def _key(self, store_key, sid, block):
+        """Key of a block of store_key, derived for session sid or as
+        stored when sid is None, under the lock
+        """
+        generation = self._generation(('store', store_key))
+        if sid is not None:
+            generation = (generation, self._generation(('session', sid)))
+        return store_key, sid, generation, block
+
+    def _current(self, key):
+        """Whether a block loaded for key can still be cached, its store
+        and session being neither invalidated nor forgotten since, under
+        the lock
+        """
+        store_key, sid, generation, _ = key
+        current = self._generations.get(('store', store_key))
+        if sid is not None:
+            current = (current, self._generations.get(('session', sid)))
+        return current == generation
+
+    def _get(self, key):
+        """Returns a cached block or None, under the lock"""
+        block = self._blocks.get(key)
+        if block is None:
+            self._stats["misses"] += 1
+            return None
+        self._blocks.move_to_end(key)
+        self._stats["hits"] += 1
+        if key in self._prefetched:
+            self._prefetched.discard(key)
+            self._stats["prefetch_hits"] += 1
+        return block
+
+    def _put(self, key, block):
+        """Caches a block and evicts the least recently used, under the lock
+
+        returns: whether the block was added
+        """
+        if key in self._blocks or block.nbytes > self.max_bytes:
+            return False
+        self._blocks[key] = block
+        self._bytes += block.nbytes
+        while self._bytes > self.max_bytes:
+            old_key, old_block = self._blocks.popitem(last=False)
+            self._bytes -= old_block.nbytes
+            self._prefetched.discard(old_key)
+            self._stats["evictions"] += 1
+        return True
+
+    def read_range(self, store_key, sid, i_start, i_end, num_samples, available_samples,
+                   load, derived=False):
+        """Returns samples i_start up to i_end of a session, assembled from
+        cached blocks, loading and caching those missing
+
+        store_key: of the session's recording
+        num_samples: length of the session's recording
+        available_samples: samples from the start that are final; blocks
+            reaching past them are returned but not cached
+        load: function (b_start, b_end) -> (#channels)x(b_end - b_start)
+            samples, called for missing blocks here and on the prefetch thread
+        derived: whether load derives samples with the session's montage
+            or filter, whose blocks are then the session's own
+        """
+        variant = sid if derived else None
+        b = self.block_samples
+        first, last = i_start // b, max(i_end - 1, i_start) // b
+        parts = []
+        for block in range(first, last + 1):
+            b_start, b_end = block * b, min((block + 1) * b, num_samples)
+            with self._lock:
+                key = self._key(store_key, variant, block)
+                samples = self._get(key)
+            if samples is None:
+                samples = load(b_start, b_end)
+                if b_end <= available_samples:
+                    with self._lock:
+                        if self._current(key):
+                            self._put(key, samples)
+            parts.append(samples)
+
+        self._prefetch(store_key, sid, variant, first, last, num_samples, available_samples, load)
+        if len(parts) == 1:
+            samples = parts[0]
+        else:
+            samples = np.concatenate(parts, axis=1)
+        offset = first * b
+        # Copied so callers never hold (or modify) a cached block
+        return np.array(samples[:, i_start - offset:i_end - offset])
+
+    def _prefetch(self, store_key, sid, variant, first, last, num_samples,
+                  available_samples, load):
+        """Queues the blocks after (or before, when scrolling back) a
+        session's request for loading on the prefetch thread
+        """
+        with self._lock:
+            backwards = first < self._last_block.get(sid, first)
+            self._last_block[sid] = first
+            if backwards:
+                blocks = range(first - 1, first - 1 - self.prefetch_blocks, -1)
+            else:
+                blocks = range(last + 1, last + 1 + self.prefetch_blocks)
+            b = self.block_samples
+            keys = [
+                self._key(store_key, variant, block) for block in blocks
+                if block >= 0 and min((block + 1) * b, num_samples) <= available_samples
+                and block * b < num_samples
+            ]
+            keys = [k for k in keys if k not in self._blocks and k not in self._in_flight]
+            self._in_flight.update(keys)
+        for key in keys:
+            self._prefetcher.submit(self._load_ahead, key, num_samples, load)
+
+    def _load_ahead(self, key, num_samples, load):
+        b = self.block_samples
+        block = key[3]
+        try:
+            samples = load(block * b, min((block + 1) * b, num_samples))
+        finally:
+            with self._lock:
+                self._in_flight.discard(key)
+        with self._lock:
+            if self._current(key) and self._put(key, samples):
+                self._prefetched.add(key)
+                self._stats["prefetched"] += 1
+
+    def invalidate(self, sid):
+        """Drops the blocks derived for a session"""
+        with self._lock:
+            self._generations[('session', sid)] = next(self._counter)
+            self._last_block.pop(sid, None)
+            self._drop(lambda key: key[1] == sid)
+
+    def forget(self, sid):
+        """Drops the blocks derived for a session that ended, and what
+        was kept to track it
+        """
+        with self._lock:
+            self._generations.pop(('session', sid), None)
+            self._last_block.pop(sid, None)
+            self._drop(lambda key: key[1] == sid)
+
+    def forget_store(self, store_key):
+        """Drops every block of a deleted store"""
+        with self._lock:
+            self._generations.pop(('store', store_key), None)
+            self._drop(lambda key: key[0] == store_key)
+
+    def _drop(self, dropped):
+        """Drops the blocks whose key dropped(key) is true of, under the lock"""
+        for key in [k for k in self._blocks if dropped(k)]:
+            self._bytes -= self._blocks.pop(key).nbytes
+            self._prefetched.discard(key)
+
+    def stats(self):
+        """Counters, hit rate and memory use, for tuning"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["blocks"] = len(self._blocks)
+            stats["bytes"] = self._bytes
+        stats["max_bytes"] = self.max_bytes
+        stats["block_samples"] = self.block_samples
+        requests = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / requests if requests else None
+        return stats
+
+
+# Shared by every request handled by this server process
+block_cache = BlockCache()
@@ -0,0 +1,105 @@
+"""Binary wire format for /eeg-chunk responses
+
+Layout (all little-endian):
+    bytes 0-3   magic b"NGCH"
+    bytes 4-7   uint32 length of the JSON header in bytes
+    bytes 8-    utf-8 JSON header, space padded to a multiple of 4 bytes
+    then        samples, channel-major, one run of num_samples per channel
+
+The header carries the channel names, sample rate, index range and
+encoding. With the "int16" encoding each channel also gets a scale and
+offset: value = sample * scale + offset. The padding keeps the payload
+aligned so the client can view it directly as a Float32Array/Int16Array.
+
+Envelope chunks (decimation > 1 in the header) interleave the min and
+max of each bin, so num_samples is twice the number of bins and i_start
+is the sample index where the first bin begins.
+"""
+import json
+import struct
+import numpy as np
+
+MAGIC = b"NGCH"
+VERSION = 1
+ENCODINGS = ("float32", "int16")
+# Symmetric int16 range so the offset sits exactly on zero
+INT16_LIMIT = 32767
+
+
+def _quantize_int16(samples):
+    """Returns int16 samples with a per-channel scale and offset"""
+    if samples.shape[1] == 0:
+        zeros = np.zeros(samples.shape[0])
+        return samples.astype("<i2"), np.ones(samples.shape[0]), zeros
+    lo = samples.min(axis=1)
+    hi = samples.max(axis=1)
+    offsets = (hi + lo) / 2.0
+    scales = (hi - lo) / (2.0 * INT16_LIMIT)
+    # Flat channels would divide by zero; any scale reproduces them
+    scales[scales == 0] = 1.0
+    quantized = np.rint((samples - offsets[:, None]) / scales[:, None])
+    quantized = np.clip(quantized, -INT16_LIMIT, INT16_LIMIT).astype("<i2")
+    return quantized, scales, offsets
+
+
+def encode_chunk(samples, ch_names, sample_rate, i_start, encoding="float32", decimation=1):
+    """Packs a (#channels)x(#samples) matrix into the binary wire format
+
+    samples: np matrix, rows are channels
+    ch_names: labels of the rows of samples
+    sample_rate: sample rate of the recording in Hz
+    i_start: index of the first sample in the recording
+    encoding: "float32" or "int16"
+    decimation: samples per envelope bin, 1 for raw samples
+    """
+    if encoding not in ENCODINGS:
+        raise ValueError(f"Unknown chunk encoding {encoding}, use one of {ENCODINGS}")
+    samples = np.asarray(samples, dtype=np.float64)
+    header = {
+        "version": VERSION,
+        "encoding": encoding,
+        "channels": list(ch_names),
+        "sample_rate": float(sample_rate),
+        "i_start": int(i_start),
+        "num_samples": int(samples.shape[1]),
+        "decimation": int(decimation),
+    }
+    if decimation == 1:
+        header["i_end"] = int(i_start + samples.shape[1])
+    else:
+        header["i_end"] = int(i_start + decimation * (samples.shape[1] // 2))
+
+    if encoding == "int16":
+        payload, scales, offsets = _quantize_int16(samples)
+        header["scales"] = scales.tolist()
+        header["offsets"] = offsets.tolist()
+    else:
+        payload = samples.astype("<f4")
+
+    header_bytes = json.dumps(header).encode("utf-8")
+    header_bytes += b" " * (-len(header_bytes) % 4)
+    return b"".join([
+        MAGIC,
+        struct.pack("<I", len(header_bytes)),
+        header_bytes,
+        np.ascontiguousarray(payload).tobytes(),
+    ])
+
+
+def decode_chunk(buffer):
+    """Inverse of encode_chunk, returns (header, float samples)"""
+    if buffer[:4] != MAGIC:
+        raise ValueError("Not an encoded EEG chunk")
+    (header_len,) = struct.unpack("<I", buffer[4:8])
+    header = json.loads(buffer[8 : 8 + header_len].decode("utf-8"))
+    shape = (len(header["channels"]), header["num_samples"])
+
+    if header["encoding"] == "int16":
+        payload = np.frombuffer(buffer, dtype="<i2", offset=8 + header_len)
+        payload = payload.reshape(shape).astype(np.float64)
+        scales = np.asarray(header["scales"])[:, None]
+        offsets = np.asarray(header["offsets"])[:, None]
+        return header, payload * scales + offsets
+
+    payload = np.frombuffer(buffer, dtype="<f4", offset=8 + header_len)
+    return header, payload.reshape(shape)
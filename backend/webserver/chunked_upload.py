@@ -0,0 +1,470 @@
+"""Resumable, chunked uploads and the conversion of uploaded files
+
+A file is sent as a series of chunks at increasing byte offsets. Each
+chunk goes straight to disk, so an interrupted upload resumes from the
+last byte received. EDF files are decoded record by record while they
+arrive, so their samples can be read while the upload is still going.
+Other formats are cached once complete, by a job on the ingestion pool
+(see conversion_jobs) that publishes the first screen of samples before
+the rest. Either way the FIF copy the rest of the server works with is
+made by a conversion job, whose id is handed back to the client.
+
+Chunked uploads are hashed as they arrive, others by a job of the pool.
+A recording that was ingested before, by any session, isn't cached or
+converted again: the session is pointed at what exists already (see
+ingest_index).
+
+Progress is reported over the 'loading' socket event, with a 'stage' of
+'upload', 'convert' or 'cache'.
+"""
+import hashlib
+import os
+import threading
+import time
+import uuid
+
+from werkzeug.utils import secure_filename
+
+from .app_config import socketio, logger
+from .annotation_store import annotation_store
+from .eeg_chunker import EegChunker
+from .conversion_jobs import conversion_jobs, IngestQueueFull
+from .ingest_index import ingest_index
+from .session_manager import saveFilenameToSession, filenameInUse
+from .request_metrics import stage
+from .socket_interface import SocketInterface
+from ..mne_reader.edf_stream import EdfRecordDecoder
+
+# Bytes read from a request at a time
+READ_BLOCK_SIZE = 1 << 20
+# Each upload gets a directory of its own here, so uploads of files of
+# the same name never write over each other
+UPLOAD_DIR = '/tmp/ng_uploads/'
+# Smallest change in upload progress worth an event
+PROGRESS_STEP = 0.01
+# Uploads no chunk arrived for in this long are dropped
+UPLOAD_TTL_SECONDS = 60 * 60
+# Longest wait for another session to start caching a shared recording
+SHARED_CACHE_TIMEOUT_SECONDS = 60
+# How often a request waiting on another session's caching checks on it,
+# in seconds. Waits go through socketio.sleep so, under eventlet, other
+# requests are served meanwhile
+CACHE_POLL_SECONDS = 0.1
+
+
+class UploadOffsetError(Exception):
+    """Raised when a chunk doesn't start where the upload left off"""
+
+    def __init__(self, received):
+        super().__init__(f"Upload continues at byte {received}")
+        self.received = received
+
+
+def _session_ready(sid, filepath):
+    """Points the session at filepath and starts its annotations"""
+    saveFilenameToSession(sid, filepath)
+    # Start from the annotations the uploaded file came with
+    annotation_store.load_from_file(sid, filepath)
+
+
+def remove_file(path):
+    """Deletes path, and the directory of the upload it came from once
+    that is empty
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    directory = os.path.dirname(path)
+    if directory.startswith(UPLOAD_DIR):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            # Still holds the upload's FIF, or another file
+            pass
+
+
+def _remove_unused(paths):
+    """Deletes the files no session points at anymore"""
+    for path in paths:
+        if path is None or filenameInUse(path):
+            continue
+        remove_file(path)
+
+
+def _attach(chunker, sid, key, filepath):
+    """Points the session at the samples of key, from filepath, deleting
+    the recording it leaves behind if nobody else uses it
+    """
+    previous = chunker.attach_session(sid, key, filepath)
+    if previous is not None:
+        _remove_unused([previous['filepath'], previous['fif_path']])
+
+
+def _convert_to_fif(content_hash, key, filepath):
+    """Queues the FIF copy of a recording, its sessions moving to it
+    once it is written
+
+    returns: the conversion job id, None if it couldn't be queued
+    """
+    sockface = SocketInterface()
+    for sid in ingest_index.sessions_of(key):
+        sockface.emit_percentage(sid, 0, 'convert')
+
+    def on_converted(result):
+        fif_path = result['fif_path']
+        ingest_index.update(content_hash, fif_path=fif_path)
+        for sid in ingest_index.sessions_of(key):
+            saveFilenameToSession(sid, fif_path)
+            annotation_store.relocate(sid, fif_path)
+            sockface.emit_percentage(sid, 1, 'convert')
+
+    try:
+        return conversion_jobs.submit('convert', filepath, on_complete=on_converted)
+    except Exception as e:
+        logger.error(f"Converting {filepath} failed: {e}")
+        return None
+
+
+def _cache_samples(sid, content_hash, key, filepath, kind='cache'):
+    """Queues the caching of a recording's samples under key or, with
+    kind 'pyramid', the pyramid of samples decoded already. The
+    recording is ready once the job is done.
+
+    returns: the job id, None if a pyramid couldn't be queued
+    """
+    sockface = SocketInterface()
+    sockface.emit_percentage(sid, 0, 'cache')
+
+    def on_cached(result):
+        ingest_index.update(content_hash, ready=True)
+        sockface.emit_percentage(sid, 1, 'cache')
+
+    def on_failed(error):
+        if kind == 'cache':
+            ingest_index.forget(content_hash)
+        else:
+            # Every sample is there, zoomed-out views reduce them instead
+            on_cached(None)
+
+    try:
+        return conversion_jobs.submit(
+            kind, filepath, key, on_complete=on_cached, on_failure=on_failed
+        )
+    except IngestQueueFull as e:
+        # Filled up since the caller checked for room
+        on_failed(e)
+        if kind == 'cache':
+            raise
+        return None
+
+
+def _hash(filepath):
+    """Content hash of filepath, read by a job of the ingestion pool"""
+    job_id = conversion_jobs.submit('hash', filepath)
+    with stage('hash'):
+        return conversion_jobs.wait(job_id)['content_hash']
+
+
+def discard_unfinished_ingests():
+    """Deletes the samples of recordings a previous server process was
+    still caching when it stopped, called once when the server starts
+    """
+    chunker = EegChunker()
+    for key, recording in ingest_index.discard_unfinished():
+        logger.info(f"Discarding the unfinished ingestion of {recording['filepath']}")
+        chunker.delete_samples(key)
+        _remove_unused([recording['filepath'], recording['fif_path']])
+
+
+def _usable(chunker, recording):
+    """Whether a recording's files are all still there"""
+    if recording['fif_path'] is not None and not os.path.isfile(recording['fif_path']):
+        return False
+    if not os.path.isfile(recording['filepath']) and recording['fif_path'] is None:
+        return False
+    # Still being cached by this process otherwise, see discard_unfinished_ingests
+    return chunker.store.exists(recording['store_key']) or not recording['ready']
+
+
+def _reuse_recording(sid, filepath, recording):
+    """Points the session at a recording ingested before, returning once
+    its samples can be read
+
+    returns: the chunker holding the session's samples
+    """
+    chunker = EegChunker()
+    key = recording['store_key']
+    _session_ready(sid, recording['fif_path'] or recording['filepath'])
+    _attach(chunker, sid, key, recording['filepath'])
+    # The upload is a copy of a file kept already
+    if filepath not in (recording['filepath'], recording['fif_path']):
+        _remove_unused([filepath])
+
+    # Another session may only just have started caching it
+    deadline = time.time() + SHARED_CACHE_TIMEOUT_SECONDS
+    while not chunker.store.exists(key):
+        if ingest_index.recording_of(key) is None or time.time() > deadline:
+            raise RuntimeError(f"Caching {recording['filepath']} failed")
+        socketio.sleep(CACHE_POLL_SECONDS)
+    logger.info(f"Reusing the cached {recording['filepath']} for {filepath}")
+    return chunker
+
+
+def _claim(filepath, content_hash, key):
+    """ingest_index.claim, discarding a recording whose files are gone"""
+    recording, created = ingest_index.claim(content_hash, key, filepath)
+    if not created and not _usable(EegChunker(), recording):
+        ingest_index.forget(content_hash)
+        recording, created = ingest_index.claim(content_hash, key, filepath)
+    return recording, created
+
+
+def ingest_file(sid, filepath, content_hash=None):
+    """Queues the caching of a complete upload's samples and its
+    conversion to FIF, returning as soon as the first screen of samples
+    is readable. The rest is cached by the ingestion pool meanwhile.
+
+    A recording ingested before is reused instead, see _reuse_recording.
+
+    content_hash: of filepath, when already known; hashed on the pool
+        otherwise
+    Raises IngestQueueFull when the pool has no room for the jobs
+    returns: the chunker holding the session's samples, the conversion
+        job id (None when nothing is converted)
+    """
+    if content_hash is None:
+        content_hash = _hash(filepath)
+    key = content_hash[:32]
+    recording, created = _claim(filepath, content_hash, key)
+    if not created:
+        return _reuse_recording(sid, filepath, recording), None
+    try:
+        # Caching and converting, before the session leaves its last recording
+        conversion_jobs.check_room(2)
+    except IngestQueueFull:
+        ingest_index.forget(content_hash)
+        raise
+
+    # Annotations work off the upload until its FIF copy is ready
+    _session_ready(sid, filepath)
+
+    chunker = EegChunker()
+    # Attached first, so the FIF conversion finds the session
+    _attach(chunker, sid, key, filepath)
+    # Cached as recorded, filters are applied when chunks are read
+    cache_job = _cache_samples(sid, content_hash, key, filepath)
+    # Converted alongside the caching, reading the file on its own
+    job_id = _convert_to_fif(content_hash, key, filepath)
+    with stage('first_screen'):
+        # Raises if the caching fails first
+        conversion_jobs.wait(cache_job, until=lambda: chunker.first_screen_available(key))
+    return chunker, job_id
+
+
+class ChunkedUpload:
+    """One file being uploaded to /tmp/, possibly decoded as it arrives"""
+
+    def __init__(self, upload_id, sid, filename, size, token=None):
+        """filename: as sent by the client, made safe here
+        token: the client's, to resume the upload from another socket
+        """
+        self.upload_id = upload_id
+        self.sid = sid
+        self.filename = secure_filename(filename)
+        if not self.filename:
+            raise ValueError(f"Invalid file name {filename!r}")
+        self.size = size
+        self.token = token
+        # Path contains '/tmp/'
+        os.makedirs(UPLOAD_DIR + upload_id, exist_ok=True)
+        self.filepath = UPLOAD_DIR + upload_id + '/' + self.filename
+        self.received = 0
+        self._reported = 0
+        # When the client last sent anything, see ChunkedUploads.expire
+        self.last_active = time.time()
+        self.lock = threading.Lock()
+        open(self.filepath, 'wb').close()
+        # Of the bytes received, to find out if the file is known
+        self.digest = hashlib.sha256()
+        # Where samples are decoded to until the upload is complete
+        self.store_key = 'upload_' + upload_id
+
+        # Only EDFs can be decoded before they are complete
+        self.chunker = EegChunker()
+        self.decoder = EdfRecordDecoder() if filename.endswith('.edf') else None
+        self.writer = None
+
+    def write(self, offset, stream):
+        """Appends the chunk read from stream if it starts at offset
+
+        Bytes already received, from a retried chunk, are skipped.
+        returns: bytes received so far
+        """
+        with self.lock:
+            self.last_active = time.time()
+            if offset > self.received:
+                raise UploadOffsetError(self.received)
+            skip = self.received - offset
+            with open(self.filepath, 'ab') as f:
+                for block in iter(lambda: stream.read(READ_BLOCK_SIZE), b''):
+                    if skip >= len(block):
+                        skip -= len(block)
+                        continue
+                    block, skip = block[skip:], 0
+                    f.write(block)
+                    self.digest.update(block)
+                    self.received += len(block)
+                    self._decode(block)
+            self._report()
+            return self.received
+
+    def move_to(self, sid):
+        """Hands the upload, and the samples decoded so far, to another
+        session, e.g. the client's new socket
+        """
+        with self.lock:
+            self.last_active = time.time()
+            if sid == self.sid:
+                return
+            if self.writer is not None:
+                _attach(self.chunker, sid, self.store_key, self.filepath)
+                ingest_index.release(self.sid)
+            self.sid = sid
+
+    def abort(self):
+        """Drops the partial file and the samples decoded from it"""
+        with self.lock:
+            if self.writer is not None:
+                self.writer.discard()
+                self.writer = None
+            # Sessions only ever reading the upload have nothing left to read
+            for sid in ingest_index.sessions_of(self.store_key):
+                self.chunker.delete_cache(sid)
+            self.chunker.delete_samples(self.store_key)
+            remove_file(self.filepath)
+
+    def _decode(self, block):
+        if self.decoder is None:
+            return
+        for start, samples in self.decoder.feed(block, digital=True):
+            if self.writer is None:
+                # Kept as the integers the file holds
+                self.writer = self.chunker.create_edf_cache(self.store_key, self.decoder)
+                _attach(self.chunker, self.sid, self.store_key, self.filepath)
+            self.writer.write(start, samples)
+        if self.writer is not None:
+            # Decoded records are readable right away
+            self.writer.publish()
+        if self.decoder.header is not None and not self.decoder.supported:
+            logger.info(f"{self.filename} can't be decoded while uploading")
+            self.decoder = None
+
+    def _report(self):
+        percent = self.received / self.size if self.size else 1
+        if percent - self._reported >= PROGRESS_STEP or percent >= 1:
+            SocketInterface().emit_percentage(self.sid, percent, 'upload')
+            self._reported = percent
+
+    @property
+    def complete(self):
+        return self.received >= self.size
+
+    def finish(self):
+        """Makes the uploaded file's samples available to the session
+
+        returns: see ingest_file
+        """
+        with self.lock:
+            content_hash = self.digest.hexdigest()
+            if self.writer is None:
+                # Nothing could be decoded, fall back on caching the whole file
+                return ingest_file(self.sid, self.filepath, content_hash)
+
+            recording, created = _claim(self.filepath, content_hash, self.store_key)
+            if not created:
+                # Samples decoded here are dropped with the upload's store key
+                self.writer.close()
+                self.writer = None
+                return _reuse_recording(self.sid, self.filepath, recording), None
+            try:
+                # The pyramid and the conversion, before anything changes
+                conversion_jobs.check_room(2)
+            except IngestQueueFull:
+                ingest_index.forget(content_hash)
+                raise
+
+            # A truncated EDF is kept as far as it was decoded, like cache_edf does
+            writer, self.writer = self.writer, None
+            writer.close()
+            # Annotations and downloads work off the EDF until its FIF is ready
+            _session_ready(self.sid, self.filepath)
+            _attach(self.chunker, self.sid, self.store_key, self.filepath)
+            _cache_samples(self.sid, content_hash, self.store_key, self.filepath, 'pyramid')
+            job_id = _convert_to_fif(content_hash, self.store_key, self.filepath)
+            return self.chunker, job_id
+
+class ChunkedUploads:
+    """Uploads in progress, by upload id"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._uploads = {}
+
+    def start(self, sid, filename, size, token=None):
+        """Starts an upload, or resumes the session's unfinished one of
+        the same file. An upload started with a token is resumed by
+        whoever sends the token again, possibly from a new socket.
+
+        Raises ValueError for a file name that can't be stored
+        returns: the ChunkedUpload
+        """
+        with self._lock:
+            for upload in self._uploads.values():
+                if upload.filename != secure_filename(filename) or upload.size != size:
+                    continue
+                if token is not None and upload.token == token:
+                    upload.move_to(sid)
+                    return upload
+                if token is None and upload.token is None and upload.sid == sid:
+                    upload.last_active = time.time()
+                    return upload
+            upload = ChunkedUpload(uuid.uuid4().hex, sid, filename, size, token)
+            self._uploads[upload.upload_id] = upload
+            return upload
+
+    def get(self, upload_id):
+        """Returns the upload or raises KeyError"""
+        with self._lock:
+            return self._uploads[upload_id]
+
+    def finish(self, upload_id):
+        """Completes an upload, see ChunkedUpload.finish"""
+        upload = self.get(upload_id)
+        chunker, job_id = upload.finish()
+        with self._lock:
+            self._uploads.pop(upload_id, None)
+        return upload, chunker, job_id
+
+    def abort(self, upload_id):
+        """Drops an upload, see ChunkedUpload.abort"""
+        with self._lock:
+            upload = self._uploads.pop(upload_id, None)
+        if upload is not None:
+            upload.abort()
+
+    def expire(self, ttl=UPLOAD_TTL_SECONDS):
+        """Aborts the uploads no chunk arrived for in ttl seconds
+
+        returns: their upload ids
+        """
+        now = time.time()
+        with self._lock:
+            idle = [u.upload_id for u in self._uploads.values() if now - u.last_active > ttl]
+        for upload_id in idle:
+            self.abort(upload_id)
+        return idle
+
+
+# Shared by every request handled by this server process
+chunked_uploads = ChunkedUploads()
@@ -0,0 +1,200 @@
+"""Background classification jobs for the webserver
+
+Jobs run in a small pool of worker processes so TensorFlow never blocks
+the Flask/SocketIO loop. Workers keep the models they load (see
+classify_epilepsy.model_registry), and can load them before any job.
+Progress is relayed from the workers to the client over the 'loading'
+socket event, jobs of a session are cancelled when its socket
+disconnects, and results are cached by file content hash and model
+version so re-uploading the same recording returns instantly.
+"""
+import hashlib
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+from .app_config import socketio, logger
+from .ingest_index import ingest_index
+
+# Worker processes; each holds its models in memory
+MAX_WORKERS = 1
+# Jobs queued or running before new submissions are refused
+MAX_PENDING = 8
+# Where finished annotations are cached
+CACHE_DIR = '/tmp/ng_annotation_cache/'
+# How often the relay polls workers for progress, in seconds
+PROGRESS_POLL_SECONDS = 0.25
+
+
+class JobQueueFull(Exception):
+    """Raised when MAX_PENDING jobs are already queued or running"""
+
+
+def file_content_hash(filepath, block_size=1 << 20):
+    """sha256 hex digest of a file, read in blocks"""
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ClassificationJobs:
+    """Bounded process pool of classification jobs, keyed by job id"""
+
+    def __init__(self, max_workers=MAX_WORKERS, max_pending=MAX_PENDING):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        # job_id -> {sid, future, cancel_event, cache_key, status}
+        self._jobs = {}
+        self._executor = None
+        self._manager = None
+        self._progress = None
+        # Model paths every worker loads as it starts
+        self._warm_models = []
+
+    def _start(self):
+        """Spawns the pool and the progress relay on first use"""
+        if self._executor is not None:
+            return
+        from ..classify_epilepsy.job_worker import warm_worker
+
+        # spawn rather than fork: the server process holds sockets and threads
+        context = multiprocessing.get_context('spawn')
+        self._manager = context.Manager()
+        self._progress = self._manager.Queue()
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.max_workers, mp_context=context,
+            initializer=warm_worker, initargs=(list(self._warm_models),)
+        )
+        socketio.start_background_task(self._relay_progress)
+
+    def warm(self, model_paths):
+        """Starts the workers now, loading and warming up model_paths,
+        so the first classification doesn't wait for them
+        """
+        from ..classify_epilepsy.job_worker import warm_worker
+
+        with self._lock:
+            self._warm_models = list(model_paths)
+            self._start()
+        # Workers are spawned, and run the initializer, on first submit;
+        # a pool started earlier gets the models warmed by this task
+        self._executor.submit(warm_worker, list(model_paths))
+
+    def _relay_progress(self):
+        """Forwards worker progress to the owning session's socket"""
+        while True:
+            try:
+                job_id, percent = self._progress.get_nowait()
+            except queue.Empty:
+                socketio.sleep(PROGRESS_POLL_SECONDS)
+                continue
+            job = self._jobs.get(job_id)
+            if job is not None:
+                socketio.emit('loading', {'percent': percent}, room=job['sid'])
+
+    def cache_path(self, cache_key):
+        return CACHE_DIR + cache_key + '.json'
+
+    def _read_cache(self, cache_key):
+        try:
+            with open(self.cache_path(cache_key), 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _write_cache(self, cache_key, annotations):
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = self.cache_path(cache_key) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(annotations, f)
+        os.replace(tmp_path, self.cache_path(cache_key))
+
+    def content_hash(self, sid, filepath):
+        """Content hash of the recording the session is reading from
+        filepath, as ingest_index recorded it when the file was uploaded
+
+        Raises KeyError if the session has no such recording
+        """
+        recording = ingest_index.recording_of(ingest_index.store_key(sid))
+        if recording is None or filepath not in (recording['filepath'], recording['fif_path']):
+            raise KeyError(f"Session {sid} has no recording ingested from {filepath}")
+        return recording['content_hash']
+
+    def submit(self, sid, filepath, model_name, model_path, on_complete):
+        """Queues classification of filepath for a session
+
+        on_complete: called with the annotations dict (onsets, durations,
+            descriptions) once the job finishes or the cache is hit
+
+        returns: job_id, status ('cached' or 'queued')
+        """
+        cache_key = self.content_hash(sid, filepath) + '_' + model_name
+        cached = self._read_cache(cache_key)
+        if cached is not None:
+            on_complete(cached)
+            return None, 'cached'
+
+        # Deferred so TensorFlow is only ever imported by the workers
+        from ..classify_epilepsy.job_worker import run_classification_job
+
+        with self._lock:
+            pending = [j for j in self._jobs.values() if not j['future'].done()]
+            if len(pending) >= self.max_pending:
+                raise JobQueueFull(f"{len(pending)} classification jobs pending")
+            self._start()
+            job_id = uuid.uuid4().hex
+            cancel_event = self._manager.Event()
+            future = self._executor.submit(
+                run_classification_job,
+                job_id, filepath, model_path, self._progress, cancel_event
+            )
+            self._jobs[job_id] = {
+                'sid': sid,
+                'future': future,
+                'cancel_event': cancel_event,
+                'cache_key': cache_key,
+            }
+
+        def on_done(future):
+            job = self._jobs.pop(job_id, None)
+            if future.cancelled() or job is None or job['cancel_event'].is_set():
+                logger.info(f"Classification job {job_id} cancelled")
+                return
+            if future.exception() is not None:
+                logger.error(f"Classification job {job_id} failed: {future.exception()}")
+                return
+            annotations = future.result()
+            self._write_cache(cache_key, annotations)
+            on_complete(annotations)
+
+        future.add_done_callback(on_done)
+        return job_id, 'queued'
+
+    def cancel_sid(self, sid):
+        """Cancels every queued or running job of a session"""
+        with self._lock:
+            jobs = [j for j in self._jobs.values() if j['sid'] == sid]
+        for job in jobs:
+            # Queued jobs never start, running ones stop at their next block
+            job['future'].cancel()
+            job['cancel_event'].set()
+        return len(jobs)
+
+    def status(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is None:
+            return 'unknown'
+        if job['future'].running():
+            return 'running'
+        return 'queued'
+
+
+# Shared by every request handled by this server process
+classification_jobs = ClassificationJobs()
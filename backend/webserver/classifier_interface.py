@@ -2,69 +2,123 @@
 with the client while handling methods in the edf classification task,
 including classification, file transfer, data transfer, etc.
 """
-# TODO: CURRENTLY BROKEN AFTER MIGRATION TO SOCKET INTERFACE AND SESSION MANAGER
-
 import os
-import random
-import string
 
-from .app_config import socketio
-from ..classify_epilepsy import EpilepsyClassifier
-from ..mne_reader.edf_reader import EDFReader
+from .app_config import socketio, logger
+from .classification_jobs import classification_jobs
+from .annotation_store import annotation_store
 
 
+class UnknownModel(Exception):
+    """Raised when no stored model matches a requested name or version"""
 
 
-def classify_on_edf(filepath, edf, percent_callback=None):
-    """Runs the (long) method to classify epileptic
-    discharges on EDF dta
-    Returns savepath of associated file
-    """
-    savepath = filepath[:-4] + "_ng-annotated.edf"
+def stored_models_dir():
     # Get path to current module so this can be called from anywhere
     parent_folder_path = "/".join((os.path.abspath(__file__)).split("/")[:-2])
-    classifier = EpilepsyClassifier(
-        parent_folder_path + "/stored_models/" + MODEL_NAME
-    )
-    # Classifies and saves file to path: savepath
-    classifier.classify_on_edf(edf, save_file=savepath, percent_callback=percent_callback)
-    return savepath
+    return parent_folder_path + "/stored_models/"
+
+
+# Stored model formats, preferred first; exported .npz models
+# classify without importing TensorFlow
+MODEL_EXTENSIONS = ['.npz', '.h5']
+
+
+def stored_models():
+    """File names of the models classifications can use, sorted"""
+    try:
+        names = os.listdir(stored_models_dir())
+    except FileNotFoundError:
+        return []
+    return sorted(n for n in names if os.path.splitext(n)[1] in MODEL_EXTENSIONS)
+
+
+def _version_key(stem):
+    """Sort key of a model stem by its version, numerically: 1.0.10
+    comes after 1.0.9
+    """
+    version = stem.split('_', 1)[-1]
+    return tuple(int(p) if p.isdigit() else -1 for p in version.split('.')), stem
+
+
+def resolve_model(model=None):
+    """File name of the stored model asked for, the exported .npz of a
+    model when there is one
+
+    model: a file name ('neurogram_1.0.3.h5'), the same without its
+        extension, or a version ('1.0.3', matching the latest stored
+        'neurogram_1.0.3*'); None for the default model
+    """
+    names = stored_models()
+    stems = sorted({os.path.splitext(n)[0] for n in names})
+    if model is None:
+        model = ClassifierInterface.MODEL_NAME
+        if model not in stems:
+            # Left to fail when a job loads it, as it always has
+            return model + '.h5'
+    if model in names:
+        return model
+    if model not in stems:
+        versions = [
+            s for s in stems
+            if s == f'neurogram_{model}' or s.startswith(f'neurogram_{model}.')
+        ]
+        if not versions:
+            raise UnknownModel(f"No stored model {model}")
+        model = max(versions, key=_version_key)
+    for extension in MODEL_EXTENSIONS:
+        if model + extension in names:
+            return model + extension
 
 
 class ClassifierInterface:
     """This class interfaces the webserver and classifier to handle
     connection-specific events to the client
     """
-    # The Neurogram model version to classify with
-    MODEL_NAME = 'neurogram_1.0.3.h5'
+    # The Neurogram model version to classify with by default
+    MODEL_NAME = 'neurogram_1.0.3'
 
-    def __init__(self, sid):
+    def __init__(self, sid, model=None):
+        """model: name or version of the model to classify with, see
+        resolve_model
+        """
         self.sid = sid
+        self.model_name = resolve_model(model)
+
+    def model_path(self):
+        return stored_models_dir() + self.model_name
 
     def initiate_classifier(self, filepath):
-        # Read edf and register to interface
-        edf = EDFReader(filepath)
-
-        def on_percent(perc):
-            """Callback to emit percent-done"""
-            # TODO: move to sessionmanager
-            socketio.emit('loading', {'percent': perc}, room=self.sid)
-
-        # Classify on the saved file and grab where its save name
-        save_file = classify_on_edf(filepath, edf, percent_callback=on_percent)
-        # Generate key and store in keymap file for later retrieval
-        file_key = generate_key(save_file)
-        # Read data and annotations from edf
-        edf = EDFReader(save_file)
-        # Return response data (will be jsonified)
-        return {
-            "file_key": file_key,
-            ## Might break, was f.filename
-            "file_name": save_file,
-            # "eeg_annotations": edf.get_annotations_as_df().to_json()
-        }
-
-    def file_by_key(self, filekey):
-        """Returns a file saved in /tmp/ if associated with keymap"""
-        # TODO: move to sessionmanager method
-        return retrieve_filename(filekey, trim_tmp=True)
+        """Queues classification of the session's file. Progress arrives
+        over the 'loading' event, the result over 'classification complete'
+
+        returns: job_id, status
+        """
+        def on_complete(annotations):
+            """Stores and emits the classifier's annotations"""
+            self.save_annotations(filepath, annotations)
+            socketio.emit('classification complete', annotations, room=self.sid)
+
+        return classification_jobs.submit(
+            self.sid, filepath, self.model_name, self.model_path(), on_complete
+        )
+
+    def save_annotations(self, filepath, annotations):
+        """Replaces the session's classifier annotations with these,
+        keeping the others. They reach the file itself when it is
+        downloaded
+        """
+        # The session may have moved on to a converted copy of filepath
+        if annotation_store.session_filepath(self.sid) is None:
+            annotation_store.load_from_file(self.sid, filepath)
+        # A classification repeated (or answered from the cache) doesn't
+        # add its annotations twice
+        annotation_store.replace_source(
+            self.sid, 'classifier',
+            annotations['onsets'], annotations['durations'], annotations['descriptions']
+        )
+        logger.info(f"Saved {len(annotations['onsets'])} classifier annotations")
+
+    def cancel(self):
+        """Cancels this session's classification jobs"""
+        return classification_jobs.cancel_sid(self.sid)
@@ -0,0 +1,218 @@
+"""Background ingestion of uploaded recordings
+
+Ingesting a recording reads all of it, more than once: to hash it, to
+cache its samples and build their pyramid, and to convert it to FIF.
+Any of these would hold up every other request handled by the server,
+so they are queued as jobs on a small pool of worker processes
+instead, at most MAX_WORKERS at a time (see ingest_worker). The sample
+store is on disk and published as it grows, so samples a worker is
+still caching can already be read. Each format is read and converted
+by its ingestion driver (see mne_reader.ingest_drivers).
+
+At most MAX_PENDING jobs are queued or running. Past that, uploads are
+refused with IngestQueueFull until the queue drains, instead of waiting
+behind every upload before them.
+
+How deep the queue is and how long jobs wait and run, per kind of job
+and format, is kept for GET /ingest-stats.
+"""
+import multiprocessing
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from .app_config import socketio, logger
+from .ingest_worker import hash_file, cache_samples, build_pyramid
+from .request_metrics import request_metrics, BACKGROUND
+from ..mne_reader.ingest_drivers import driver_for, run_conversion
+
+# Jobs running at once, each in its own process
+MAX_WORKERS = 2
+# Jobs queued or running before new ones are refused
+MAX_PENDING = 8
+# Finished jobs kept around for status requests
+MAX_FINISHED_JOBS = 256
+# How often a request waiting on a job checks on it, in seconds
+WAIT_POLL_SECONDS = 0.1
+# Kind of job -> worker entry point, called with the recording's path
+# and the job's arguments
+ENTRY_POINTS = {
+    'hash': hash_file,
+    'cache': cache_samples,
+    'pyramid': build_pyramid,
+    'convert': run_conversion,
+}
+
+
+class IngestQueueFull(Exception):
+    """Raised when MAX_PENDING jobs are already queued or running"""
+
+
+class ConversionJobs:
+    """Process pool of ingestion jobs, keyed by job id"""
+
+    def __init__(self, max_workers=MAX_WORKERS, max_pending=MAX_PENDING):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        # job_id -> {kind, filepath, format, future, submitted, started,
+        #            finished, result, error}
+        self._jobs = {}
+        # Ids of finished jobs, oldest first
+        self._finished = deque()
+        # kind -> format -> {completed, failed, wait_seconds, run_seconds}
+        self._totals = {}
+        self._refused = 0
+        self._executor = None
+
+    def _start(self):
+        """Spawns the pool on first use"""
+        if self._executor is None:
+            # spawn rather than fork: the server process holds sockets and threads
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+
+    def _pending(self):
+        """Jobs queued or running, under the lock"""
+        return [j for j in self._jobs.values() if not j['future'].done()]
+
+    def _check_room(self, jobs):
+        """check_room, under the lock"""
+        if len(self._pending()) + jobs > self.max_pending:
+            self._refused += 1
+            raise IngestQueueFull(f"{self.max_pending} ingestion jobs are pending already, try again later")
+
+    def check_room(self, jobs=1):
+        """Raises IngestQueueFull unless jobs more can be queued"""
+        with self._lock:
+            self._check_room(jobs)
+
+    def submit(self, kind, filepath, *args, on_complete=None, on_failure=None):
+        """Queues a job of kind (see ENTRY_POINTS) on filepath
+
+        on_complete: called with the job's result dict once it is done,
+            from a thread of the pool
+        on_failure: called with the job's exception if it fails
+        Raises ValueError for unsupported formats and IngestQueueFull
+        returns: job_id
+        """
+        # Unsupported formats are refused before anything is queued
+        fmt = driver_for(filepath).name
+        with self._lock:
+            self._check_room(1)
+            self._start()
+            job_id = uuid.uuid4().hex
+            job = {
+                'kind': kind, 'filepath': filepath, 'format': fmt,
+                'submitted': time.time(), 'started': None, 'finished': None,
+                'result': None, 'error': None,
+            }
+            job['future'] = self._executor.submit(ENTRY_POINTS[kind], filepath, *args)
+            self._jobs[job_id] = job
+
+        def on_done(future):
+            with self._lock:
+                totals = self._totals.setdefault(kind, {}).setdefault(
+                    fmt, {'completed': 0, 'failed': 0, 'wait_seconds': 0.0, 'run_seconds': 0.0}
+                )
+                if future.exception() is not None:
+                    job['error'] = str(future.exception())
+                    job['finished'] = time.time()
+                    totals['failed'] += 1
+                else:
+                    result = future.result()
+                    job.update(result=result, started=result['started'], finished=result['finished'])
+                    totals['completed'] += 1
+                    totals['wait_seconds'] += result['started'] - job['submitted']
+                    totals['run_seconds'] += result['finished'] - result['started']
+                    request_metrics.observe(
+                        BACKGROUND, kind + '_queue', result['started'] - job['submitted']
+                    )
+                    request_metrics.observe(
+                        BACKGROUND, kind, result['finished'] - result['started']
+                    )
+                self._finished.append(job_id)
+                while len(self._finished) > MAX_FINISHED_JOBS:
+                    self._jobs.pop(self._finished.popleft(), None)
+
+            if job['error'] is not None:
+                logger.error(f"Job {kind} of {filepath} failed: {job['error']}")
+                if on_failure is not None:
+                    on_failure(future.exception())
+            elif on_complete is not None:
+                on_complete(job['result'])
+
+        job['future'].add_done_callback(on_done)
+        return job_id
+
+    def wait(self, job_id, until=None):
+        """Waits for a job to finish, or for until() to be true. Waits
+        go through socketio.sleep so, under eventlet, other requests are
+        served meanwhile.
+
+        Raises the job's exception if it failed
+        returns: the job's result, None if until() came true first
+        """
+        with self._lock:
+            future = self._jobs[job_id]['future']
+        while not future.done():
+            if until is not None and until():
+                return None
+            socketio.sleep(WAIT_POLL_SECONDS)
+        return future.result()
+
+    def status(self, job_id):
+        """State of a job: its kind, status ('queued', 'running', 'done',
+        'failed' or 'unknown'), fif_path for conversions and error
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return {'status': 'unknown'}
+            if job['error'] is not None:
+                status = 'failed'
+            elif job['result'] is not None:
+                status = 'done'
+            elif job['future'].running():
+                status = 'running'
+            else:
+                status = 'queued'
+            return {
+                'kind': job['kind'], 'status': status, 'format': job['format'],
+                'fif_path': (job['result'] or {}).get('fif_path'), 'error': job['error'],
+            }
+
+    def stats(self):
+        """Queue depth and refusals, and per kind of job and format the
+        number of jobs and their mean wait and run times, in seconds
+        """
+        with self._lock:
+            pending = self._pending()
+            running = sum(j['future'].running() for j in pending)
+            jobs = {}
+            for kind, formats in self._totals.items():
+                jobs[kind] = {}
+                for fmt, totals in formats.items():
+                    count = totals['completed']
+                    jobs[kind][fmt] = {
+                        'completed': count,
+                        'failed': totals['failed'],
+                        'mean_wait_seconds': totals['wait_seconds'] / count if count else None,
+                        'mean_run_seconds': totals['run_seconds'] / count if count else None,
+                    }
+            return {
+                'max_workers': self.max_workers,
+                'max_pending': self.max_pending,
+                'queued': len(pending) - running,
+                'running': running,
+                'refused': self._refused,
+                'jobs': jobs,
+            }
+
+
+# Shared by every request handled by this server process
+conversion_jobs = ConversionJobs()
@@ -1,139 +1,381 @@
 import os
+import json
 import time
+import numpy as np
 import pandas as pd
-import pickle
-from .app_config import cache
 import mne
 from ..mne_reader.fif_reader import  FIFReader
+from ..mne_reader.montage import Montage
+from ..mne_reader.display_filter import DisplayFilter
+from ..mne_reader.ingest_drivers import DRIVERS
+from ..mne_reader.edf_stream import EdfRecordDecoder
 
 from .app_config import logger
+from .sample_store import SampleStore, BLOCK_SAMPLES
+from .envelope_pyramid import EnvelopePyramid, envelope_from_samples
+from .eeg_reader import AgnosticReader
+from .block_cache import block_cache
+from .ingest_index import ingest_index
+from .request_metrics import stage
 
 
 class EegChunker:
     """This class is a stateless collection of functions
     designed to cache EDF data and retrieve chunks as requested
     by the frontend
+
+    Samples are cached under a store key, shared by every session
+    opening the same recording (see ingest_index), and read by sid.
+    Samples are cached as recorded; montages and display filters are
+    applied to the requested ranges only.
     """
-    def save_path(self, sid):
-        """Format for the save path"""
-        return '/tmp/'+'EEG_'+sid+'.pkl'
+    # Samples converted and written per block when caching a file
+    STORE_BLOCK_SIZE = 1 << 16
+    # Bytes of an EDF decoded at a time when caching it
+    EDF_READ_BYTES = 1 << 20
+    # Opening window of a recording published before the rest is cached
+    FIRST_SCREEN_SECONDS = 30
+
+    def __init__(self):
+        self.store = SampleStore(prefix='EEG_')
+        # Min/max levels of the stored recording for zoomed-out views
+        self.pyramid = EnvelopePyramid(self.store)
 
     def montage_save_path(self, sid):
-        """Format to save montaged files"""
-        return '/tmp/'+'MONTAGE_'+sid+'.pkl'
-
-    def cache_eeg_dataframe(self, sid, filepath, should_filter_body_motion):
-        # Convert fif to dataframe
-        fif = FIFReader(filepath)
-        if should_filter_body_motion:
-            fif.filter_body_motion()
-        df = fif.to_data_frame()
-
-        # pickle dataframe to file
-        df.to_pickle(self.save_path(sid))
-
-    # This cacheing line beings to use memory exponentially
-    # it is in fact faster and more memory safe (compared to this line)
-    # to simply read from pickle every time
-    # @cache.memoize(timeout=60)
-    def retrieve_from_pickle(self, sid):
-        """Cached method to retrieve dataframe from a keyed pattern"""
+        """Format to save montage reference matrices"""
+        return '/tmp/'+'MONTAGE_'+sid+'.json'
+
+    def filter_save_path(self, sid):
+        """Format to save display filters"""
+        return '/tmp/'+'FILTER_'+sid+'.json'
+
+    def cache_eeg_dataframe(self, key, filepath):
+        """Caches the samples of filepath, of any type eeg_reader reads,
+        under store key, and builds their pyramid
+
+        The first FIRST_SCREEN_SECONDS are published on their own so the
+        viewer can draw while the rest is cached (see
+        first_screen_available), and available_samples grows block by
+        block after that.
+        """
+        if filepath.endswith('.edf'):
+            # Kept as the integers the file holds
+            if self.cache_edf(key, filepath):
+                return
+
+        # Samples stay on disk until read
+        reader = AgnosticReader(filepath, preload=False)
+        sample_rate = reader.sample_rate
+        writer = self.create_cache(key, reader.raw.ch_names, sample_rate, reader.num_samples)
+
+        first = self.first_screen_samples(sample_rate, reader.num_samples)
+        writer.write(0, reader.preview_block(first))
+        writer.publish()
+
+        # A block at a time so the recording is never held twice
+        for start, block in reader.data_blocks(self.STORE_BLOCK_SIZE, start=first):
+            writer.write(start, block)
+            writer.publish()
+        self.finalize_cache(key, writer)
+
+    def cache_edf(self, key, filepath):
+        """Caches an EDF at source precision by decoding its records,
+        see cache_eeg_dataframe. A file ending short of the records its
+        header announced is cached as far as it goes.
+
+        returns: False if the file needs mne to be read, which is known
+            before any samples are published
+        """
+        decoder = EdfRecordDecoder()
+        writer = None
+        with open(filepath, 'rb') as f:
+            for data in iter(lambda: f.read(self.EDF_READ_BYTES), b''):
+                for start, block in decoder.feed(data, digital=True):
+                    if writer is None:
+                        writer = self.create_edf_cache(key, decoder)
+                    writer.write(start, block)
+                if decoder.header is not None and not decoder.supported:
+                    return False
+                if writer is not None:
+                    writer.publish()
+        if writer is None:
+            return False
+        if not decoder.complete:
+            # Clients may have read it already, it isn't cached again with mne
+            logger.info(f"{filepath} ends after {decoder.num_decoded} of {decoder.num_samples} samples")
+        self.finalize_cache(key, writer)
+        return True
+
+    def first_screen_samples(self, sample_rate, num_samples):
+        """Samples of the first screen, in whole store blocks"""
+        first = int(self.FIRST_SCREEN_SECONDS * sample_rate)
+        return min(num_samples, -(-first // BLOCK_SAMPLES) * BLOCK_SAMPLES)
+
+    def first_screen_available(self, key):
+        """Whether the first screen of the samples being cached under key
+        can be read yet
+        """
         try:
-            # Attempt to read from saved montage
-            return pd.read_pickle(self.montage_save_path(sid))
+            meta = self.store.read_meta(key)
         except FileNotFoundError:
-            # If montage doesn't exist, read from original
-            return pd.read_pickle(self.save_path(sid))
+            # Caching hasn't published anything yet
+            return False
+        first = self.first_screen_samples(meta['sample_rate'], meta['num_samples'])
+        return self.store.available_samples(key, meta) >= first
 
-    def retrieve_original(self, sid):
-        return pd.read_pickle(self.save_path(sid))
+    def create_cache(self, key, ch_names, sample_rate, num_samples, **encoding):
+        """Starts the sample store of a store key, returns the SampleWriter
+        to fill and publish it, to be handed to finalize_cache
+
+        encoding: see SampleStore.create
+        """
+        self.pyramid.delete(key)
+        return self.store.create(key, ch_names, sample_rate, num_samples, **encoding)
+
+    def create_edf_cache(self, key, decoder):
+        """create_cache for the digital samples of an EdfRecordDecoder"""
+        return self.create_cache(
+            key, decoder.ch_names, decoder.sample_rate, decoder.num_samples,
+            encoding='int16', scales=decoder.gains, offsets=decoder.offsets
+        )
+
+    def finalize_cache(self, key, writer):
+        """Makes a filled sample store readable and builds its pyramid"""
+        writer.close()
+        self.pyramid.build(key)
+
+    def attach_session(self, sid, key, filepath=None):
+        """Points the session at the samples stored under key
+
+        filepath: of the recording, shown with the display filter of
+            its format (see ingest_drivers), if it has one
+        returns: the recording the session was using before, if no
+            session uses it anymore; its samples are deleted here, its
+            files are the caller's to delete
+        """
+        # A fresh upload invalidates any montage or filter of the previous file
+        self.clear_montage(sid)
+        self.clear_filter(sid)
+        driver = DRIVERS.get((filepath or '').split('.')[-1])
+        if driver is not None and driver.display_filter is not None:
+            self.store_filter(driver.display_filter, sid)
+        return self._delete_orphan(ingest_index.attach(sid, key))
+
+    def _delete_orphan(self, orphan):
+        if orphan is None:
+            return None
+        key, recording = orphan
+        self.delete_samples(key)
+        return recording
+
+    def delete_samples(self, key):
+        """Removes the samples and pyramid stored under key"""
+        block_cache.forget_store(key)
+        self.pyramid.delete(key)
+        self.store.delete(key)
 
     def get_sample_rate(self, sid, filepath):
         """Return the samplerate of the chunked file"""
-        return FIFReader(filepath).sample_rate
+        return self.store.read_meta(ingest_index.store_key(sid))['sample_rate']
 
     def get_num_samples(self, sid, filepath):
         """Return the total number of samples (time stamps) of chunked file"""
-        return FIFReader(filepath).to_data_frame().shape[1]
+        return self.store.read_meta(ingest_index.store_key(sid))['num_samples']
 
-    def chunk_by_index(self, sid, i_start, i_end):
-        """Returns samples of data from i_start up to, not including, i_end
+    def get_available_samples(self, sid):
+        """Return how many samples from the start can be chunked already,
+        less than get_num_samples while the file is still being cached
         """
-        df = self.retrieve_from_pickle(sid)
-        chunk = df.iloc[:, i_start:i_end]
-        # Apply montage if it exists
-        # chunk = self.reorganize_by_montage(sid, chunk)
-        return chunk
+        return self.store.available_samples(ingest_index.store_key(sid))
+
+    def chunk_array_by_index(self, sid, i_start, i_end):
+        """Returns samples of data from i_start up to, not including, i_end
+        as a (#electrodes)x(#timesteps) matrix, montaged and filtered if
+        a montage or display filter is set
 
+        returns: samples, ch_names, i_start
+            where i_start is the first index actually returned
+        """
+        key = ingest_index.store_key(sid)
+        meta = self.store.read_meta(key)
+        # Resolve the range the same way DataFrame.iloc would
+        i_start, i_end, _ = slice(i_start, i_end).indices(meta['num_samples'])
+        i_end = max(i_start, i_end)
+        montage = self.load_montage(sid)
+        display_filter = self.load_filter(sid)
+        ch_names = meta['ch_names'] if montage is None else montage.labels
+        if i_end == i_start:
+            return np.empty((len(ch_names), 0), dtype=np.float32), ch_names, i_start
+
+        available = self.store.available_samples(key, meta)
+        sample_rate = meta['sample_rate']
+        pad = 0 if display_filter is None else display_filter.pad_samples(sample_rate)
+
+        def read(b_start, b_end):
+            if montage is None:
+                # Only the blocks of the requested range are decoded
+                with stage('read'):
+                    return self.store.read_range(key, b_start, b_end, meta=meta)
+            # Derive from just the channels and range the montage needs
+            with stage('read'):
+                picked = self.store.read_range(key, b_start, b_end, picks=montage.picks, meta=meta)
+            with stage('montage'):
+                return montage.derive(picked)
+
+        def load(b_start, b_end):
+            if display_filter is None:
+                return read(b_start, b_end)
+            # Filtered with the context its impulse response reaches
+            p_start = max(b_start - pad, 0)
+            p_end = max(min(b_end + pad, available), b_end)
+            samples = read(p_start, p_end)
+            with stage('filter'):
+                return display_filter.apply(
+                    samples, sample_rate, b_start - p_start, p_end - b_end
+                )
+
+        if available < meta['num_samples']:
+            # Filtered blocks change until the context after them is cached
+            available = max(available - pad, 0)
+        # Adjacent requests share blocks of the cache
+        with stage('slice'):
+            chunk = block_cache.read_range(
+                key, sid, i_start, i_end, meta['num_samples'], available, load,
+                derived=montage is not None or display_filter is not None
+            )
+        return chunk, ch_names, i_start
 
+    def chunk_by_index(self, sid, i_start, i_end):
+        """Returns samples of data from i_start up to, not including, i_end
+        """
+        samples, ch_names, i_start = self.chunk_array_by_index(sid, i_start, i_end)
+        columns = range(i_start, i_start + samples.shape[1])
+        return pd.DataFrame(samples, index=ch_names, columns=columns)
+
+    def envelope_array_by_index(self, sid, i_start, i_end, max_points=None, decimation=None):
+        """Returns a min/max envelope of samples i_start up to i_end,
+        from the coarsest pyramid level with at least max_points bins
+        (or no coarser than decimation). Falls back to raw samples when
+        the span is already too short to decimate.
+
+        The pyramid only covers recorded, unfiltered channels, so with a
+        montage or display filter set the envelope is reduced from the
+        derived samples of the range instead: cost grows with the span,
+        not with the recording.
+
+        returns: samples, ch_names, i_start, decimation
+            with decimation > 1, samples interleave each bin's min and max
+            and i_start is the sample index of the first bin
+        """
+        key = ingest_index.store_key(sid)
+        level = self.pyramid.choose_level(
+            key, i_end - i_start, max_points=max_points, decimation=decimation
+        )
+        if level is None:
+            samples, ch_names, i_start = self.chunk_array_by_index(sid, i_start, i_end)
+            return samples, ch_names, i_start, 1
+
+        d = level['decimation']
+        if self.load_montage(sid) is None and self.load_filter(sid) is None:
+            with stage('envelope'):
+                envelope, bin_start = self.pyramid.envelope(key, level, i_start, i_end)
+            return envelope, self.store.read_meta(key)['ch_names'], bin_start, d
+
+        # Widen to whole bins so they line up with the pyramid's
+        samples, ch_names, bin_start = self.chunk_array_by_index(
+            sid, (max(i_start, 0) // d) * d, -(-i_end // d) * d
+        )
+        with stage('envelope'):
+            return envelope_from_samples(samples, d), ch_names, bin_start, d
+
+    def envelope_by_index(self, sid, i_start, i_end, max_points=None, decimation=None):
+        """Dataframe form of envelope_array_by_index. Columns are the
+        sample index each point stands for: a bin's min at its start
+        and its max halfway through it
+        """
+        samples, ch_names, i_start, d = self.envelope_array_by_index(
+            sid, i_start, i_end, max_points=max_points, decimation=decimation
+        )
+        if d == 1:
+            columns = range(i_start, i_start + samples.shape[1])
+        else:
+            starts = i_start + d * np.arange(samples.shape[1] // 2)
+            columns = np.stack([starts, starts + d // 2], axis=1).ravel()
+        return pd.DataFrame(samples, index=ch_names, columns=columns), d
 
     def store_montage(self, montage, sid):
-        # Read original from pickle
-        # Reorganize into montage
-        # Store as pickle
-        df = self.retrieve_original(sid)
-        df = df.transpose()
-
-        # Build list of unique electrode names from montage
-        electrode_names = set()
-        for m in montage:
-            for el in m:
-                electrode_names.add(el)
-        # Remove empty string from set to prevent unversal matching
-        if '' in electrode_names:
-            electrode_names.remove('')
-        # Build renaming map, then rename
-        renaming_map = {}
-        for el in electrode_names:
-            for c in df.columns:
-                if el in c:
-                    # If simplified electrode name is contained
-                    # in column, rename the column to match it
-                    renaming_map[c] = el
-        # Apply rename
-        logger.info(f"Renaming Map: {renaming_map}")
-        df = df.rename(columns=renaming_map)
-
-        kept_columns = []
-        logger.info(f"Montage: {montage}")
-        logger.info(f"Columns: {df.columns}")
-        for m in montage:
-            #  For montage in montage list m: [e0, e1]
-            if len(m) == 0:
-                # Montage is empty, ignore
-                continue
+        """Resolves the montage against the recorded channels and stores
+        it as a sparse reference matrix. Samples are only derived when
+        chunks are requested, so this is instant for any file size.
+        """
+        ch_names = self.store.read_meta(ingest_index.store_key(sid))['ch_names']
+        engine = Montage.from_pairs(montage, ch_names)
+        logger.debug(f"Montage: {engine.labels}")
+
+        tmp_path = self.montage_save_path(sid) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(engine.to_dict(), f)
+        os.replace(tmp_path, self.montage_save_path(sid))
+        # Cached blocks were derived with the previous montage
+        block_cache.invalidate(sid)
+
+    def load_montage(self, sid):
+        """Returns the session's Montage, or None if none was set"""
+        try:
+            with open(self.montage_save_path(sid), 'r') as f:
+                return Montage.from_dict(json.load(f))
+        except FileNotFoundError:
+            return None
 
-            if len(m) == 1 or m[1] == '':
-                # Montage contains only one electrode
-                column_name = f'{m[0]}'
-                kept_columns.append(column_name)
-                continue
+    def clear_montage(self, sid):
+        try:
+            os.remove(self.montage_save_path(sid))
+        except FileNotFoundError:
+            pass
+        # Cached blocks may have been derived with the removed montage
+        block_cache.invalidate(sid)
 
-            if len(m) == 2 and m[0] == '':
-                # Montage second element contains the only electrode
-                if m[1] != '':
-                    column_name = f'{m[1]}'
-                    kept_columns.append(column_name)
-                    continue
-                else:
-                    continue
+    def store_filter(self, display_filter, sid):
+        """Stores the session's DisplayFilter, applied to chunks from
+        now on; a filter with no cutoff set clears it
+        """
+        if not display_filter.enabled:
+            self.clear_filter(sid)
+            return
+        tmp_path = self.filter_save_path(sid) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(display_filter.to_dict(), f)
+        os.replace(tmp_path, self.filter_save_path(sid))
+        # Cached blocks were filtered with the previous filter
+        block_cache.invalidate(sid)
+
+    def load_filter(self, sid):
+        """Returns the session's DisplayFilter, or None if none was set"""
+        try:
+            with open(self.filter_save_path(sid), 'r') as f:
+                return DisplayFilter.from_dict(json.load(f))
+        except FileNotFoundError:
+            return None
 
-            if not m[0] in df.columns or not m[1] in df.columns:
-                # Either electrode name is not contained in df
-                # Ignore
-                logger.info("passed")
-                continue
+    def clear_filter(self, sid):
+        try:
+            os.remove(self.filter_save_path(sid))
+        except FileNotFoundError:
+            pass
+        block_cache.invalidate(sid)
 
-            column_name = f'{m[0]}-{m[1]}'
-            kept_columns.append(column_name)
-            # Create the new bipolar columns
-            df[column_name] = df[m[0]] - df[m[1]]
-        # Keep only bipolar columns
-        df = df[kept_columns]
-        df = df.transpose()
+    def delete_cache(self, sid):
+        """Removes what was cached for the session, and its recording's
+        samples if no other session uses them
 
-        df.to_pickle(self.montage_save_path(sid))
-        
+        returns: the recording, if no session uses it anymore; its
+            files are the caller's to delete
+        """
+        self.clear_montage(sid)
+        self.clear_filter(sid)
+        # The session is gone, so is any trace of it in the block cache
+        block_cache.forget(sid)
+        return self._delete_orphan(ingest_index.release(sid))
 
     def reorganize_by_montage(self, sid, chunk_df):
         """Returns chunk reorganized into montage 
@@ -146,8 +388,8 @@ class EegChunker:
         # This calculation could be run once and cached to save
         # processing time
         df = chunk_df
-        logger.info("CHUNK BEFORE")
-        logger.info(chunk_df)
+        logger.debug("CHUNK BEFORE")
+        logger.debug(chunk_df)
         montage = self.grab_montage(sid)
 
         if montage == []:
@@ -155,10 +397,10 @@ class EegChunker:
             return chunk_df
 
         kept_columns = []
-        logger.info(f"Montage: {montage}")
-        logger.info(f"Columns: {df.columns}")
+        logger.debug(f"Montage: {montage}")
+        logger.debug(f"Columns: {df.columns}")
         for m in montage:
-            logger.info(m)
+            logger.debug(m)
             if len(m) == 0:
                 continue
 
@@ -176,19 +418,19 @@ class EegChunker:
                     continue
 
             if not m[0] in df.columns or not m[1] in df.columns:
-                logger.info("passed")
+                logger.debug("passed")
                 continue
 
             column_name = f'{m[0]}-{m[1]}'
             kept_columns.append(column_name)
             # Create the new bipolar columns
             df[column_name] = df[m[0]] - df[m[1]]
-            logger.info(m)
-            logger.info(df[column_name])
+            logger.debug(m)
+            logger.debug(df[column_name])
         # Keep only bipolar columns
         df = df[kept_columns]
-        logger.info("CHUNK AFTER")
-        logger.info(df)
+        logger.debug("CHUNK AFTER")
+        logger.debug(df)
         return df
 
 
@@ -206,22 +448,19 @@ class EegChunker:
         if n < 0 or n >= N:
             raise Exception("n chunk must be in range [0:N)")
 
-        # Might be the case that the og pickle isn't done writing yet
+        # Might be the case that the og samples aren't done writing yet
         # by the first chunk call. Check, and wait until it is
         if n == 0:
             timeout_counter = 10
-            while not os.path.isfile(self.save_path(sid)) and timeout_counter > 0:
+            while not self.store.exists(ingest_index.store_key(sid)) and timeout_counter > 0:
                 time.sleep(1)
                 timeout_counter -= 1
             if timeout_counter == 0:
-                raise Exception("Timeout waiting for fif dataframe to write to pickle")
+                raise Exception("Timeout waiting for fif samples to write to the store")
 
-        # Hypothetically the value of this should be cached after chunk #1
-        df = self.retrieve_from_pickle(sid)
         # Start and end indices
-        timesteps = len(df.columns)
+        timesteps = self.get_num_samples(sid, None)
         w_s = n*(int(timesteps / N))
         w_e = (n+1)*(int(timesteps / N)) - 1
 
-        chunk = df.iloc[:, w_s:w_e]
-        return chunk
\ No newline at end of file
+        return self.chunk_by_index(sid, w_s, w_e)
\ No newline at end of file
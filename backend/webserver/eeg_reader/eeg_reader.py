@@ -1,42 +1,35 @@
 """These methods allow you to read an EEG to an mne.io.RAW and access it later
 """
 
-import mne
 from ..app_config import logger
-from ...mne_reader import EDFReader
+from ...mne_reader.ingest_drivers import driver_for
+from ...mne_reader.mne_base_reader import MNEBaseReader
 
-def _read_to_raw(filepath):
+def _read_to_raw(filepath, preload=True):
   """Filetype agnostic method that reads to mne RAW type"""
-  read_methods = {
-    'edf': mne.io.read_raw_edf,
-    'EEG': mne.io.read_raw_nihon,
-    'cnt': mne.io.read_raw_cnt,
-    'fif': mne.io.read_raw_fif,
-  }
-  # Grab extension to determine
-  extension = filepath.split('.')[-1]
-  read_file = read_methods[extension]
-
-  logger.info(filepath)
+  # Each format is read by its driver: edf, nihon, cnt, fif
+  driver = driver_for(filepath)
+
+  logger.debug(filepath)
 
   # See MNEReader's read from raw note on preload's expensiveness
-  raw = read_file(filepath, preload=True)
+  raw = driver.read_raw(filepath, preload=preload)
   return raw
 
+class AgnosticReader(MNEBaseReader):
+  """MNEBaseReader of any file type _read_to_raw can read"""
+
+  def __init__(self, file_path, preload=True):
+    MNEBaseReader.__init__(self, file_path, preload=preload)
+
+  def read_raw(self, file_path, preload=True):
+    return _read_to_raw(file_path, preload=preload)
+
 def save_agnostic_to_fif(filepath):
-  """Saves an agnostic filetype to .edf to work with later
-  Returns the path to the edf
+  """Saves an agnostic filetype to .fif to work with later
+  Returns the path to the fif
+
+  Reads and writes the whole recording; the webserver has this done by
+  conversion_jobs' worker processes rather than on a request thread
   """
-  raw = _read_to_raw(filepath)
-  # raw.resample(200)
-  edf_path = '.'.join(filepath.split('.')[:-1]) + '_raw.fif'
-  raw.save(edf_path, overwrite=True)
-
-  # edf = EDFReader(edf_path)
-  # logger.info("READING AGNOSTICs")
-  # logger.info(raw.to_data_frame().shape)
-  # logger.info(raw.to_data_frame()[100:130,0:5])
-  # logger.info(edf.to_data_frame().shape)
-  # logger.info(edf.to_data_frame()[0:5,100:130])
-  return edf_path
-  
\ No newline at end of file
+  return driver_for(filepath).convert_to_fif(filepath)
@@ -0,0 +1,156 @@
+"""Multi-resolution min/max envelopes of a stored recording
+
+Level k of the pyramid summarises every FACTOR**k samples of a channel
+by their minimum and maximum, so a spike survives any amount of
+zooming out. Levels are built once at upload time, each from the level
+below, and stored next to the sample store as (#channels)x(#bins)x2
+float32 files. An overview request then reads about as many bins as
+the screen has pixels, whatever the length of the recording.
+"""
+import json
+import os
+import numpy as np
+
+# Each level merges this many bins of the level below
+FACTOR = 4
+# Stop adding levels once a level has fewer bins than this
+MIN_BINS = 256
+# Samples (or bins) processed per step while building, per channel
+BUILD_BLOCK = FACTOR ** 8
+
+
+def _reduce_block(block_min, block_max, factor):
+    """Min/max of every <factor> columns, the last bin may be partial"""
+    edges = np.arange(0, block_min.shape[1], factor)
+    return (
+        np.minimum.reduceat(block_min, edges, axis=1),
+        np.maximum.reduceat(block_max, edges, axis=1),
+    )
+
+
+def envelope_from_samples(samples, decimation):
+    """Min/max envelope of an in-memory (#channels)x(#samples) matrix,
+    in the same interleaved layout as EnvelopePyramid.envelope
+    """
+    if samples.shape[1] == 0:
+        return samples
+    bins_min, bins_max = _reduce_block(samples, samples, decimation)
+    return np.stack([bins_min, bins_max], axis=2).reshape(samples.shape[0], -1)
+
+
+class EnvelopePyramid:
+    """Builds and reads the min/max levels belonging to a SampleStore"""
+
+    def __init__(self, store):
+        self.store = store
+
+    def level_path(self, key, level):
+        return self.store.directory + self.store.prefix + key + f"_L{level}.dat"
+
+    def meta_path(self, key):
+        return self.store.directory + self.store.prefix + key + "_pyramid.json"
+
+    def exists(self, key):
+        return os.path.isfile(self.meta_path(key))
+
+    def read_meta(self, key):
+        """Returns dict with the level list, coarsest last"""
+        with open(self.meta_path(key), "r") as f:
+            return json.load(f)
+
+    def open_level(self, key, level):
+        """Read-only memmap of a level, shape (#channels)x(#bins)x2"""
+        return np.memmap(
+            self.level_path(key, level["level"]),
+            dtype="<f4", mode="r", shape=(level["num_channels"], level["num_bins"], 2),
+        )
+
+    def build(self, key):
+        """Builds every level for the samples stored under key"""
+        meta = self.store.read_meta(key)
+        num_channels, num_items = len(meta["ch_names"]), meta["num_samples"]
+        levels = []
+        level = 1
+
+        def read_samples(a, b):
+            # Level 1 reads raw samples, where min and max are the sample itself
+            samples = self.store.read_range(key, a, b, meta=meta)
+            return samples, samples
+        read_block = read_samples
+
+        while True:
+            num_bins = -(-num_items // FACTOR)
+            if num_bins < 1 or (levels and num_bins < MIN_BINS):
+                break
+            out = np.memmap(
+                self.level_path(key, level),
+                dtype="<f4", mode="w+", shape=(num_channels, num_bins, 2),
+            )
+            # Blocks are a multiple of FACTOR so no bin straddles two blocks
+            for start in range(0, num_items, BUILD_BLOCK):
+                stop = min(start + BUILD_BLOCK, num_items)
+                block_min, block_max = read_block(start, stop)
+                bins_min, bins_max = _reduce_block(block_min, block_max, FACTOR)
+                first = start // FACTOR
+                out[:, first : first + bins_min.shape[1], 0] = bins_min
+                out[:, first : first + bins_max.shape[1], 1] = bins_max
+            out.flush()
+            del out
+
+            levels.append({
+                "level": level,
+                "decimation": FACTOR ** level,
+                "num_bins": num_bins,
+                "num_channels": num_channels,
+            })
+            below = self.open_level(key, levels[-1])
+            read_block = lambda a, b, below=below: (below[:, a:b, 0], below[:, a:b, 1])
+            num_items = num_bins
+            level += 1
+
+        tmp_path = self.meta_path(key) + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"factor": FACTOR, "levels": levels}, f)
+        os.replace(tmp_path, self.meta_path(key))
+
+    def choose_level(self, key, span, max_points=None, decimation=None):
+        """Returns the coarsest level that still gives every one of
+        max_points pixels its own bin, or the finest level no coarser
+        than the requested decimation. None means raw samples.
+        """
+        if not self.exists(key):
+            return None
+        chosen = None
+        for level in self.read_meta(key)["levels"]:
+            if decimation is not None:
+                fits = level["decimation"] <= decimation
+            else:
+                fits = span / level["decimation"] >= max_points
+            if fits:
+                chosen = level
+        return chosen
+
+    def envelope(self, key, level, i_start, i_end):
+        """Returns the envelope covering samples i_start up to i_end
+
+        returns: envelope, bin_start
+            envelope is (#channels)x(2*#bins), min and max interleaved,
+            bin_start is the sample index where the first bin begins
+        """
+        d = level["decimation"]
+        b_start = max(i_start, 0) // d
+        b_end = min(-(-i_end // d), level["num_bins"])
+        b_end = max(b_start, b_end)
+        bins = np.array(self.open_level(key, level)[:, b_start:b_end, :])
+        return bins.reshape(bins.shape[0], -1), b_start * d
+
+    def delete(self, key):
+        """Removes every level file of key, if present"""
+        if not self.exists(key):
+            return
+        for level in self.read_meta(key)["levels"]:
+            try:
+                os.remove(self.level_path(key, level["level"]))
+            except FileNotFoundError:
+                pass
+        os.remove(self.meta_path(key))
@@ -0,0 +1,203 @@
+"""Recordings cached once per content, shared by the sessions opening them
+
+Ingesting a recording (caching its samples, building its pyramid,
+converting it to FIF) is keyed by the hash of the uploaded file, so a
+second session opening the same study, or a reviewer reconnecting with
+a new socket, is pointed at what was made for the first one instead of
+making it again.
+
+Sessions read their samples through a store key. A session may also
+have a store key of its own, with no recording behind it yet, while
+its upload is still being decoded. A store (and its recording) is
+referenced by every session pointed at it and is only deleted once
+none is.
+"""
+import sqlite3
+import threading
+from contextlib import closing, contextmanager
+
+# Shared by every session, lives next to the cached recordings
+INGEST_DB_FILENAME = '/tmp/ng_ingests.sqlite'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS recordings (
+    content_hash TEXT PRIMARY KEY,
+    store_key TEXT NOT NULL,
+    filepath TEXT NOT NULL,
+    fif_path TEXT,
+    ready INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS session_stores (
+    sid TEXT PRIMARY KEY,
+    store_key TEXT NOT NULL
+);
+"""
+
+
+class IngestIndex:
+    """content hash -> recording and sid -> store key, kept in memory
+    and written through to SQLite so they survive a restart
+    """
+
+    def __init__(self, path=INGEST_DB_FILENAME):
+        self.path = path
+        self._lock = threading.Lock()
+        with self._connect() as db:
+            db.executescript(_SCHEMA)
+            # content_hash -> {store_key, filepath, fif_path, ready}
+            self._recordings = {
+                row[0]: {
+                    'content_hash': row[0], 'store_key': row[1], 'filepath': row[2],
+                    'fif_path': row[3], 'ready': bool(row[4])
+                }
+                for row in db.execute("SELECT * FROM recordings")
+            }
+            self._keys = dict(db.execute("SELECT sid, store_key FROM session_stores"))
+
+    @contextmanager
+    def _connect(self):
+        """A connection per call, so any request thread can use the
+        index. Commits on exit, rolls back on an exception, and closes.
+        """
+        with closing(sqlite3.connect(self.path, timeout=10)) as db:
+            with db:
+                yield db
+
+    def _save_recording(self, db, recording):
+        db.execute(
+            "INSERT OR REPLACE INTO recordings VALUES (?, ?, ?, ?, ?)",
+            (recording['content_hash'], recording['store_key'], recording['filepath'],
+             recording['fif_path'], int(recording['ready']))
+        )
+
+    def store_key(self, sid):
+        """Key the session's samples are stored under
+
+        Raises KeyError for sessions with no store
+        """
+        with self._lock:
+            return self._keys[sid]
+
+    def claim(self, content_hash, store_key, filepath):
+        """Returns the recording of content_hash, registering one stored
+        under store_key from filepath if there is none
+
+        returns: recording dict, whether it was just registered
+        """
+        with self._lock:
+            recording = self._recordings.get(content_hash)
+            if recording is not None:
+                return dict(recording), False
+            recording = {
+                'content_hash': content_hash, 'store_key': store_key,
+                'filepath': filepath, 'fif_path': None, 'ready': False
+            }
+            self._recordings[content_hash] = recording
+            with self._connect() as db:
+                self._save_recording(db, recording)
+            return dict(recording), True
+
+    def update(self, content_hash, **changes):
+        """Sets fields (fif_path, ready) of a recording"""
+        with self._lock:
+            recording = self._recordings.get(content_hash)
+            if recording is None:
+                return
+            recording.update(changes)
+            with self._connect() as db:
+                self._save_recording(db, recording)
+
+    def recording_of(self, store_key):
+        """The recording stored under store_key, None if there is none"""
+        with self._lock:
+            for recording in self._recordings.values():
+                if recording['store_key'] == store_key:
+                    return dict(recording)
+        return None
+
+    def sessions_of(self, store_key):
+        """sids pointed at store_key"""
+        with self._lock:
+            return [sid for sid, key in self._keys.items() if key == store_key]
+
+    def attach(self, sid, store_key):
+        """Points the session at store_key
+
+        returns: see release, for the key the session was pointed at
+        """
+        with self._lock:
+            previous = self._keys.get(sid)
+            self._keys[sid] = store_key
+            with self._connect() as db:
+                db.execute(
+                    "INSERT OR REPLACE INTO session_stores VALUES (?, ?)", (sid, store_key)
+                )
+            if previous is None or previous == store_key:
+                return None
+            return self._orphan(previous)
+
+    def release(self, sid):
+        """Forgets the session's store key
+
+        returns: (store key, recording dict or None) when no session is
+            left using the key, whose files are then the caller's to
+            delete, otherwise None
+        """
+        with self._lock:
+            key = self._keys.pop(sid, None)
+            with self._connect() as db:
+                db.execute("DELETE FROM session_stores WHERE sid = ?", (sid,))
+            if key is None:
+                return None
+            return self._orphan(key)
+
+    def _orphan(self, store_key):
+        """Drops store_key's recording if no session uses it, under the lock"""
+        if store_key in self._keys.values():
+            return None
+        recording = None
+        for content_hash, r in list(self._recordings.items()):
+            if r['store_key'] == store_key:
+                recording = self._recordings.pop(content_hash)
+                with self._connect() as db:
+                    db.execute(
+                        "DELETE FROM recordings WHERE content_hash = ?", (content_hash,)
+                    )
+        return store_key, recording
+
+    def discard_unfinished(self):
+        """Drops the recordings a previous server process was still
+        ingesting when it stopped, and the sessions pointed at them.
+        Nothing finishes them anymore, so once this has run a recording
+        that isn't ready is one this process is ingesting. Called once
+        when the server starts.
+
+        returns: list of (store key, recording dict) whose files are
+            the caller's to delete
+        """
+        with self._lock:
+            unfinished = [
+                (r['store_key'], self._recordings.pop(content_hash))
+                for content_hash, r in list(self._recordings.items()) if not r['ready']
+            ]
+            keys = {key for key, _ in unfinished}
+            sids = [sid for sid, key in self._keys.items() if key in keys]
+            for sid in sids:
+                del self._keys[sid]
+            with self._connect() as db:
+                db.execute("DELETE FROM recordings WHERE ready = 0")
+                db.executemany("DELETE FROM session_stores WHERE sid = ?", [(s,) for s in sids])
+        return unfinished
+
+    def forget(self, content_hash):
+        """Drops a recording whose ingestion failed; its sessions keep
+        their store key until they move on or expire
+        """
+        with self._lock:
+            self._recordings.pop(content_hash, None)
+            with self._connect() as db:
+                db.execute("DELETE FROM recordings WHERE content_hash = ?", (content_hash,))
+
+
+# Shared by every request handled by this server process
+ingest_index = IngestIndex()
@@ -0,0 +1,38 @@
+"""Entry points of ingestion jobs, run in worker processes
+
+Each job reads a whole recording, so none of them runs in the server
+process (see conversion_jobs). Samples cached here are written to the
+on-disk sample store and published as they are, so the server reads
+them while the job is still running. Jobs return a dict of their
+result and of when they started and finished, in seconds since the
+epoch.
+"""
+import time
+
+from .classification_jobs import file_content_hash
+from .eeg_chunker import EegChunker
+
+
+def hash_file(filepath):
+    """Content hash of filepath, see ingest_index"""
+    started = time.time()
+    content_hash = file_content_hash(filepath)
+    return {'content_hash': content_hash, 'started': started, 'finished': time.time()}
+
+
+def cache_samples(filepath, key):
+    """Caches the samples of filepath under store key and builds their
+    pyramid, publishing the first screen before the rest
+    """
+    started = time.time()
+    EegChunker().cache_eeg_dataframe(key, filepath)
+    return {'started': started, 'finished': time.time()}
+
+
+def build_pyramid(filepath, key):
+    """Builds the pyramid of samples already cached under store key,
+    decoded from filepath while it was uploaded
+    """
+    started = time.time()
+    EegChunker().pyramid.build(key)
+    return {'started': started, 'finished': time.time()}
@@ -0,0 +1,308 @@
+"""Per-request latency, payload and memory metrics, kept in process
+
+Every request is timed by endpoint, along with the bytes it answered
+with and how much the server's resident memory grew while it ran
+(process wide, so concurrent requests share their growth). Code on the
+request path times its stages (reading samples, filtering, encoding the
+response...) with
+
+    with stage('read'):
+        ...
+
+Stage times include any stage nested in them. Stages timed outside a
+request, on prefetch threads or when a background job finishes, are
+recorded under the 'background' endpoint. A request's record is kept on
+flask.g, so requests served as greenlets of one thread (under eventlet)
+each keep their own.
+
+Everything is summed into fixed-bucket histograms, served as JSON by
+GET /metrics. Requests matching no route are all counted under
+UNMATCHED. With PROFILE_REQUESTS set in the app config, a request sent
+with an 'X-Profile' header is also sampled by SamplingProfiler; its id
+comes back in the 'X-Profile-Id' header and the profile from GET
+/metrics/profile.
+"""
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+from flask import g, has_app_context
+
+try:
+    import greenlet
+except ImportError:
+    # Only there when serving with eventlet
+    greenlet = None
+
+# Upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf')
+)
+# Upper bounds of the payload buckets, in bytes
+BYTE_BUCKETS = tuple(256 * 4 ** i for i in range(10)) + (float('inf'),)
+# Profiles of X-Profile requests kept for GET /metrics/profile
+MAX_PROFILES = 16
+# Time between two stack samples of a profiled request, in seconds
+PROFILE_INTERVAL_SECONDS = 0.005
+# Stacks reported per profile, most sampled first
+PROFILE_TOP_STACKS = 30
+# Endpoint of stages timed outside any request
+BACKGROUND = 'background'
+# Endpoint of requests matching no route, whatever their path
+UNMATCHED = 'unmatched'
+# Of the pages /proc/self/statm counts
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def resident_bytes():
+    """Resident memory of this process, None where /proc isn't there"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class Histogram:
+    """Counts of observations per bucket, with their sum and maximum"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Upper bound of the bucket the q-th quantile falls in"""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else None,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            # Bounds as strings, 'inf' being no valid JSON number
+            'buckets': {str(b): c for b, c in zip(self.buckets, self.counts) if c},
+        }
+
+
+class SamplingProfiler:
+    """Samples the stack of the request that started it at a fixed
+    interval, from a thread of its own, and counts how often each stack
+    was seen
+
+    A request served as a greenlet shares its thread with others; its
+    own frame is sampled while it is suspended, and the thread's while
+    it runs.
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL_SECONDS):
+        self.thread_id = threading.get_ident()
+        self.greenlet = None
+        if greenlet is not None and greenlet.getcurrent().parent is not None:
+            self.greenlet = greenlet.getcurrent()
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.seconds = time.perf_counter() - self.started
+
+    def _frame(self):
+        """Frame the sampled request is at"""
+        if self.greenlet is not None and self.greenlet.gr_frame is not None:
+            # Suspended, another greenlet has the thread
+            return self.greenlet.gr_frame
+        return sys._current_frames().get(self.thread_id)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = self._frame()
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_filename}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            # Outermost call first, like flame graph input
+            self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def to_dict(self):
+        return {
+            'seconds': self.seconds,
+            'samples': self.samples,
+            'interval_seconds': self.interval,
+            'stacks': [
+                {'stack': stack.split(';'), 'samples': count}
+                for stack, count in self.stacks.most_common(PROFILE_TOP_STACKS)
+            ],
+        }
+
+
+class RequestMetrics:
+    """Histograms of request and stage latencies, payload bytes and
+    memory growth, by endpoint
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # endpoint -> {'latency', 'bytes', 'memory', 'stages': {stage -> Histogram}}
+        self._endpoints = {}
+        self._statuses = Counter()
+        self._profiles = OrderedDict()
+        self.started = time.time()
+
+    def _endpoint(self, endpoint):
+        """Histograms of an endpoint, under the lock"""
+        metrics = self._endpoints.get(endpoint)
+        if metrics is None:
+            metrics = self._endpoints[endpoint] = {
+                'latency': Histogram(LATENCY_BUCKETS),
+                'bytes': Histogram(BYTE_BUCKETS),
+                'memory': Histogram(BYTE_BUCKETS),
+                'stages': {},
+            }
+        return metrics
+
+    def observe(self, endpoint, stage, seconds):
+        """Records one run of a stage of endpoint"""
+        with self._lock:
+            stages = self._endpoint(endpoint)['stages']
+            if stage not in stages:
+                stages[stage] = Histogram(LATENCY_BUCKETS)
+            stages[stage].observe(seconds)
+
+    @contextmanager
+    def stage(self, name):
+        """Times the block as stage name of the current request"""
+        request = self._request()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            if request is None:
+                self.observe(BACKGROUND, name, seconds)
+            else:
+                request['stages'].append((name, seconds))
+
+    def _request(self):
+        """Record of the request being handled, None outside of one"""
+        if not has_app_context():
+            return None
+        return g.get('request_metrics')
+
+    def begin(self, endpoint, profile=False):
+        """Starts timing the current request"""
+        g.request_metrics = {
+            'endpoint': endpoint,
+            'start': time.perf_counter(),
+            'rss': resident_bytes(),
+            'stages': [],
+            'profiler': SamplingProfiler().start() if profile else None,
+        }
+
+    def end(self, status, payload_bytes=None):
+        """Records the current request, returns its profile id if it
+        was profiled
+        """
+        request = self._request()
+        if request is None:
+            return None
+        g.request_metrics = None
+        seconds = time.perf_counter() - request['start']
+        rss = resident_bytes()
+        profile_id = None
+        if request['profiler'] is not None:
+            request['profiler'].stop()
+            profile_id = uuid.uuid4().hex
+
+        with self._lock:
+            metrics = self._endpoint(request['endpoint'])
+            metrics['latency'].observe(seconds)
+            if payload_bytes is not None:
+                metrics['bytes'].observe(payload_bytes)
+            if rss is not None and request['rss'] is not None:
+                # Growth only, memory handed back isn't this request's
+                metrics['memory'].observe(max(rss - request['rss'], 0))
+            for name, stage_seconds in request['stages']:
+                if name not in metrics['stages']:
+                    metrics['stages'][name] = Histogram(LATENCY_BUCKETS)
+                metrics['stages'][name].observe(stage_seconds)
+            self._statuses[status] += 1
+            if profile_id is not None:
+                profile = request['profiler'].to_dict()
+                profile['endpoint'] = request['endpoint']
+                profile['stages'] = request['stages']
+                self._profiles[profile_id] = profile
+                while len(self._profiles) > MAX_PROFILES:
+                    self._profiles.popitem(last=False)
+        return profile_id
+
+    def profile(self, profile_id):
+        """The profile of an X-Profile request, None if unknown"""
+        with self._lock:
+            return self._profiles.get(profile_id)
+
+    def stats(self):
+        """Every histogram, by endpoint, and the responses by status"""
+        with self._lock:
+            return {
+                'uptime_seconds': time.time() - self.started,
+                'resident_bytes': resident_bytes(),
+                'statuses': {str(s): c for s, c in self._statuses.items()},
+                'endpoints': {
+                    endpoint: {
+                        'latency_seconds': m['latency'].to_dict(),
+                        'payload_bytes': m['bytes'].to_dict(),
+                        'memory_growth_bytes': m['memory'].to_dict(),
+                        'stages_seconds': {
+                            name: h.to_dict() for name, h in m['stages'].items()
+                        },
+                    }
+                    for endpoint, m in self._endpoints.items()
+                },
+                'profiles': list(self._profiles),
+            }
+
+
+# Shared by every request handled by this server process
+request_metrics = RequestMetrics()
+stage = request_metrics.stage
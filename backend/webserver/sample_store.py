@@ -0,0 +1,221 @@
+"""On-disk sample store for ingested recordings
+
+Each recording is kept as a sequence of blocks of BLOCK_SAMPLES samples,
+channel-contiguous within a block, next to a small JSON sidecar holding
+the channel names, sample rate and encoding. Samples are kept at the
+precision of their source: int16 with a per-channel scale and offset
+when the source is integer (EDF), float32 otherwise. Blocks may be zlib
+compressed, so an index file records where each one starts. Reads only
+decode the blocks a range touches, so slicing a few seconds out of a
+multi-hour recording stays cheap.
+"""
+import json
+import os
+import zlib
+import numpy as np
+
+# Encoding name -> dtype of the stored samples, little-endian regardless of host
+ENCODINGS = {"float32": "<f4", "int16": "<i2"}
+# Samples per channel in a block, the unit of reading and compression
+BLOCK_SAMPLES = 1 << 12
+# zlib level of compressed blocks, favouring speed over size
+COMPRESSION_LEVEL = 1
+
+
+class SampleWriter:
+    """Appends the samples of one recording to a store, in order
+
+    Samples become readable as whole blocks get written and publish is
+    called, and all of them once close is called.
+    """
+
+    def __init__(self, store, key, meta):
+        self.store = store
+        self.key = key
+        self.meta = meta
+        self.dtype = ENCODINGS[meta["encoding"]]
+        self.block_samples = meta["block_samples"]
+        # Samples in blocks already written
+        self.written = 0
+        self._pending = []
+        self._pending_samples = 0
+        self._offset = 0
+        self._data = open(store.data_path(key), "wb")
+        self._index = open(store.index_path(key), "wb")
+
+    def write(self, start, block):
+        """Appends a (#channels)x(#samples) block starting at sample start
+
+        block: float samples, or for int16 stores the integers to keep
+        """
+        if start != self.written + self._pending_samples:
+            raise ValueError(
+                f"Samples are written in order, expected {self.written + self._pending_samples} got {start}"
+            )
+        self._pending.append(np.asarray(block).astype(self.dtype))
+        self._pending_samples += block.shape[1]
+        if self._pending_samples < self.block_samples:
+            return
+        pending = np.concatenate(self._pending, axis=1)
+        whole = (pending.shape[1] // self.block_samples) * self.block_samples
+        for b_start in range(0, whole, self.block_samples):
+            self._write_block(pending[:, b_start:b_start + self.block_samples])
+        self._pending = [pending[:, whole:]]
+        self._pending_samples = pending.shape[1] - whole
+
+    def _write_block(self, block):
+        data = np.ascontiguousarray(block).tobytes()
+        if self.meta["compression"] == "zlib":
+            data = zlib.compress(data, COMPRESSION_LEVEL)
+        self._data.write(data)
+        self._index.write(np.array([self._offset, len(data)], dtype="<i8").tobytes())
+        self._offset += len(data)
+        self.written += block.shape[1]
+
+    def publish(self):
+        """Makes the blocks written so far readable"""
+        self._data.flush()
+        self._index.flush()
+        self.store.write_meta(self.key, dict(self.meta, available_samples=self.written))
+
+    def discard(self):
+        """Closes the files of a recording that won't be finished,
+        without making anything more readable
+        """
+        self._data.close()
+        self._index.close()
+
+    def close(self):
+        """Writes what is left and makes every sample readable"""
+        if self._pending_samples:
+            self._write_block(np.concatenate(self._pending, axis=1))
+            self._pending, self._pending_samples = [], 0
+        self._data.close()
+        self._index.close()
+        # A source can end short of the length its header announced
+        self.meta["num_samples"] = self.written
+        self.store.write_meta(self.key, dict(self.meta, available_samples=self.written))
+
+
+class SampleStore:
+    """Writes and reads channel-major sample arrays keyed by a string,
+    the store key of a recording (see ingest_index)
+    """
+
+    def __init__(self, prefix="EEG_", directory="/tmp/", compression="zlib"):
+        """compression: 'zlib' or None, for stores written from now on"""
+        self.prefix = prefix
+        self.directory = directory
+        self.compression = compression
+
+    def data_path(self, key):
+        """Format for the raw sample file"""
+        return self.directory + self.prefix + key + ".dat"
+
+    def index_path(self, key):
+        """Format for the (offset, length) pairs of each block"""
+        return self.directory + self.prefix + key + ".idx"
+
+    def meta_path(self, key):
+        """Format for the metadata sidecar"""
+        return self.directory + self.prefix + key + ".json"
+
+    def exists(self, key):
+        return os.path.isfile(self.meta_path(key))
+
+    def create(self, key, ch_names, sample_rate, num_samples,
+               encoding="float32", scales=None, offsets=None):
+        """Starts storing a recording, returns the SampleWriter to fill it
+
+        encoding: 'float32', or 'int16' for integer sources whose channel
+            i reads as int * scales[i] + offsets[i]
+        """
+        # Whatever was stored under key before is no longer readable
+        try:
+            os.remove(self.meta_path(key))
+        except FileNotFoundError:
+            pass
+        meta = {
+            "ch_names": list(ch_names),
+            "sample_rate": float(sample_rate),
+            "num_samples": int(num_samples),
+            "encoding": encoding,
+            "dtype": ENCODINGS[encoding],
+            "block_samples": BLOCK_SAMPLES,
+            "compression": self.compression,
+        }
+        if encoding == "int16":
+            meta["scales"] = [float(s) for s in scales]
+            meta["offsets"] = [float(o) for o in offsets]
+        return SampleWriter(self, key, meta)
+
+    def write_meta(self, key, meta):
+        """Writes the sidecar that makes stored samples readable
+
+        meta: dict of ch_names, sample_rate, num_samples, encoding,
+            block_samples, compression and available_samples: how many
+            samples from the start are written already
+        """
+        # Sidecar written after the samples it covers so a reader never
+        # sees metadata describing a partially written range
+        tmp_path = self.meta_path(key) + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self.meta_path(key))
+
+    def available_samples(self, key, meta=None):
+        """Samples from the start that can be read, see write_meta"""
+        meta = self.read_meta(key) if meta is None else meta
+        return meta["available_samples"]
+
+    def read_meta(self, key):
+        """Returns the sidecar dict, see write_meta"""
+        with open(self.meta_path(key), "r") as f:
+            return json.load(f)
+
+    def read_range(self, key, i_start, i_end, picks=None, meta=None):
+        """Returns samples from i_start up to, not including, i_end
+        as an in-memory float32 matrix. Indices are clamped to the
+        recording like a normal slice.
+
+        picks: optional list of row indices to read, defaults to all
+        """
+        if meta is None:
+            meta = self.read_meta(key)
+        num_channels = len(meta["ch_names"])
+        rows = slice(None) if picks is None else picks
+        i_start, i_end, _ = slice(i_start, i_end).indices(meta["num_samples"])
+        if i_end <= i_start:
+            return np.empty((len(range(num_channels)[rows]), 0), dtype=np.float32)
+
+        b = meta["block_samples"]
+        first, last = i_start // b, (i_end - 1) // b
+        index = np.fromfile(
+            self.index_path(key), dtype="<i8", count=2 * (last + 1)
+        ).reshape(-1, 2)
+        blocks = []
+        with open(self.data_path(key), "rb") as f:
+            for offset, length in index[first:last + 1]:
+                f.seek(offset)
+                data = f.read(length)
+                if meta["compression"] == "zlib":
+                    data = zlib.decompress(data)
+                block = np.frombuffer(data, dtype=meta["dtype"]).reshape(num_channels, -1)
+                blocks.append(block[rows])
+        samples = blocks[0] if len(blocks) == 1 else np.concatenate(blocks, axis=1)
+        samples = samples[:, i_start - first * b:i_end - first * b].astype(np.float32)
+
+        if meta["encoding"] == "int16":
+            scales = np.asarray(meta["scales"], dtype=np.float32)[rows]
+            offsets = np.asarray(meta["offsets"], dtype=np.float32)[rows]
+            samples *= scales[:, None]
+            samples += offsets[:, None]
+        return samples
+
+    def delete(self, key):
+        """Removes the files backing a key, if present"""
+        for path in (self.data_path(key), self.index_path(key), self.meta_path(key)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
@@ -1,32 +1,161 @@
 """Using client-given SID as an identifier, this session manager points
 the server to the actively edited file and handles accidental disconnections
+
+Sessions live in an in-process dict guarded by a lock, so lookups don't
+touch the disk. Changes are written behind to SQLite by a background
+thread, which also expires idle sessions along with their /tmp files,
+and uploads abandoned half way.
 """
-import json
+import atexit
+import sqlite3
+import threading
+import time
 
 ## Constants
-# Points to a file in /tmp/ that fills with key/val pairs
-SID_FILE_MAP_FILENAME = '/tmp/sid_to_file_map.json'
+# Sessions persisted here survive a server restart
+SESSION_DB_FILENAME = '/tmp/ng_sessions.sqlite'
+# Sessions idle for longer than this are expired
+SESSION_TTL_SECONDS = 24 * 60 * 60
+# How often pending changes are written and sessions expired
+FLUSH_INTERVAL_SECONDS = 5
+EXPIRE_INTERVAL_SECONDS = 10 * 60
+
+# sid -> {'filename': str, 'last_access': float}
+_sessions = {}
+# sids changed since the last flush; None values mean deleted
+_pending = {}
+_lock = threading.Lock()
+_flusher = None
+
+def _connect():
+  db = sqlite3.connect(SESSION_DB_FILENAME, timeout=10)
+  db.execute(
+    "CREATE TABLE IF NOT EXISTS sessions "
+    "(sid TEXT PRIMARY KEY, filename TEXT NOT NULL, last_access REAL NOT NULL)"
+  )
+  return db
 
-def _getMapFromFile():
-  try:
-    f = open(SID_FILE_MAP_FILENAME, 'r')
-    sf_map = json.load(f)
-  except:
-    sf_map = {}
-  return sf_map
+def _loadSessions():
+  """Fills the dict from disk once, and starts the write-behind thread"""
+  global _flusher
+  if _flusher is not None:
+    return
+  db = _connect()
+  for sid, filename, last_access in db.execute("SELECT * FROM sessions"):
+    _sessions[sid] = {'filename': filename, 'last_access': last_access}
+  db.close()
+  _flusher = threading.Thread(target=_flushForever, daemon=True)
+  _flusher.start()
+  # Don't lose the last few changes on a clean shutdown
+  atexit.register(flushSessions)
 
-def _saveMapToFile(sf_map):
-  f = open(SID_FILE_MAP_FILENAME, 'w')
-  json.dump(sf_map, f)
+def _flushForever():
+  last_expiry = time.time()
+  while True:
+    time.sleep(FLUSH_INTERVAL_SECONDS)
+    flushSessions()
+    if time.time() - last_expiry > EXPIRE_INTERVAL_SECONDS:
+      expireSessions()
+      last_expiry = time.time()
+
+def flushSessions():
+  """Writes changed sessions to disk"""
+  with _lock:
+    pending = dict(_pending)
+    _pending.clear()
+  if not pending:
+    return
+  db = _connect()
+  with db:
+    for sid, session in pending.items():
+      if session is None:
+        db.execute("DELETE FROM sessions WHERE sid = ?", (sid,))
+      else:
+        db.execute(
+          "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)",
+          (sid, session['filename'], session['last_access'])
+        )
+  db.close()
 
 def saveFilenameToSession(sid, filename):
-  sf_map = _getMapFromFile()
-  sf_map[sid] = filename
-  _saveMapToFile(sf_map)
+  with _lock:
+    _loadSessions()
+    session = {'filename': filename, 'last_access': time.time()}
+    _sessions[sid] = session
+    _pending[sid] = session
 
 def getFilenameBySid(sid):
-  sf_map = _getMapFromFile()
-  return sf_map[sid]
+  with _lock:
+    _loadSessions()
+    session = _sessions[sid]
+    # Updated in place, persisted with the next flush
+    session['last_access'] = time.time()
+    _pending[sid] = session
+    return session['filename']
+
+def touchSession(sid):
+  """Marks the session as used now, so reading it keeps it from
+  expiring. Unknown sids are ignored.
+  """
+  with _lock:
+    _loadSessions()
+    session = _sessions.get(sid)
+    if session is None:
+      return
+    session['last_access'] = time.time()
+    _pending[sid] = session
+
+def filenameInUse(filename):
+  """Whether any live session points at filename"""
+  with _lock:
+    _loadSessions()
+    return any(session['filename'] == filename for session in _sessions.values())
+
+def _deleteSessionFiles(sid, filename, filename_in_use):
+  """Removes what the server cached in /tmp for a session"""
+  # Deferred, these pull in mne and pandas
+  from .eeg_chunker import EegChunker
+  from .annotation_store import annotation_store
+  from .chunked_upload import remove_file
+
+  recording = EegChunker().delete_cache(sid)
+  annotation_store.forget(sid)
+  # Caches of older versions of the server
+  paths = ['/tmp/EEG_' + sid + '.pkl', '/tmp/MONTAGE_' + sid + '.pkl']
+  if not filename_in_use:
+    paths.append(filename)
+  if recording is not None:
+    # No session uses the recording anymore, nor its upload or FIF
+    for path in (recording['filepath'], recording['fif_path']):
+      if path is not None and not filenameInUse(path):
+        paths.append(path)
+  for path in paths:
+    remove_file(path)
+
+def expireSessions(ttl=SESSION_TTL_SECONDS):
+  """Forgets sessions idle for longer than ttl seconds and deletes
+  their files. Recordings still used by a live session are kept.
+
+  returns: expired sids
+  """
+  now = time.time()
+  with _lock:
+    _loadSessions()
+    expired = {
+      sid: session['filename'] for sid, session in _sessions.items()
+      if now - session['last_access'] > ttl
+    }
+    for sid in expired:
+      del _sessions[sid]
+      _pending[sid] = None
+    in_use = {session['filename'] for session in _sessions.values()}
+  for sid, filename in expired.items():
+    _deleteSessionFiles(sid, filename, filename in in_use)
+  flushSessions()
+  # Uploads abandoned half way have no session file to expire with
+  from .chunked_upload import chunked_uploads
+  chunked_uploads.expire()
+  return list(expired)
 
 
 
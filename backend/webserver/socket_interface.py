@@ -9,5 +9,9 @@ class SocketInterface:
   def establish_connection(self, sid):
     socketio.emit('establish', {'sid': sid}, room=sid)
 
-  def emit_percentage(self, perc):
-    socketio.emit('loading', {'percent': perc}, room=sid)
\ No newline at end of file
+  def emit_percentage(self, sid, perc, stage=None):
+    """Reports progress as a fraction, optionally naming the stage"""
+    payload = {'percent': perc}
+    if stage is not None:
+      payload['stage'] = stage
+    socketio.emit('loading', payload, room=sid)
\ No newline at end of file
@@ -6,21 +6,72 @@ $ flask run
 from flask import request, make_response, jsonify, send_from_directory
 from .app_config import app, socketio, logger
 
-from .classifier_interface import ClassifierInterface
+from .classifier_interface import (
+    ClassifierInterface, UnknownModel, resolve_model, stored_models, stored_models_dir
+)
+from .classification_jobs import JobQueueFull, classification_jobs
 from .eeg_chunker import EegChunker
+from .chunk_encoding import encode_chunk, ENCODINGS
+from .block_cache import block_cache
 from .socket_interface import SocketInterface
-from .session_manager import saveFilenameToSession, getFilenameBySid
-from .eeg_reader import save_agnostic_to_fif
-from ..mne_reader.fif_reader import FIFReader
+from .session_manager import saveFilenameToSession, getFilenameBySid, touchSession
+from .chunked_upload import chunked_uploads, ingest_file, UploadOffsetError
+from .conversion_jobs import conversion_jobs, IngestQueueFull
+from .annotation_store import annotation_store
+from .request_metrics import request_metrics, stage, UNMATCHED
+from ..mne_reader.display_filter import DisplayFilter
 
-from threading import Thread
 import json
+import os
+
+@app.before_request
+def start_request_metrics():
+    # Sampled as well when the client asks for a profile, if allowed
+    profile = app.config.get('PROFILE_REQUESTS', False) and 'X-Profile' in request.headers
+    request_metrics.begin(request.endpoint or UNMATCHED, profile=profile)
+
+
+@app.after_request
+def record_request_metrics(response):
+    profile_id = request_metrics.end(response.status_code, response.content_length)
+    if profile_id is not None:
+        response.headers['X-Profile-Id'] = profile_id
+    return response
+
+
+@app.teardown_request
+def drop_request_metrics(error):
+    # Requests that raised never reach after_request
+    if error is not None:
+        request_metrics.end(500)
+
 
 @socketio.on('connect')
 def establish_connection():
     # Handshake to verify connection
     SocketInterface().establish_connection(request.sid)
 
+@socketio.on('disconnect')
+def drop_connection():
+    # Nobody is left to receive results, free the workers
+    ClassifierInterface(request.sid).cancel()
+
+def _upload_response(sid, chunker, job_id):
+    """Tells the client its samples can be requested, and which job
+    converts its file (see /ingest-job)
+    """
+    # Tell client we're ready for it to request data chunks
+    socketio.emit('edf uploaded', {}, room=sid)
+
+    # Respond with sample rate
+    response_data = {
+        "sample_rate": chunker.get_sample_rate(sid, None),
+        "num_samples": chunker.get_num_samples(sid, None),
+        "conversion_job": job_id
+    }
+    return make_response(jsonify(response_data))
+
+
 @app.route("/eeg-upload", methods=["POST"])
 def upload_anytype_eeg():
     """Handles file upload of any supported type. Caches
@@ -31,53 +82,205 @@ def upload_anytype_eeg():
 
     # Save to tmp
     og_filepath = "/tmp/" + f.filename
-    f.save(og_filepath)
-    # Convert file to RAW
-    #   Read from main 3 types: edf, nihon, , fif
-    # Path contains '/tmp/'
-    should_bipolar_preprocess = og_filepath.endswith('.EEG')
-    fif_path = save_agnostic_to_fif(og_filepath)
+    with stage('save'):
+        f.save(og_filepath)
+    # Convert file to RAW and cache its samples
+    try:
+        with stage('ingest'):
+            chunker, job_id = ingest_file(sid, og_filepath)
+    except IngestQueueFull as e:
+        return make_response(jsonify({"error": str(e)}), 503)
+    return _upload_response(sid, chunker, job_id)
+
+
+@app.route("/eeg-upload-start", methods=["POST"])
+def start_chunked_upload():
+    """Starts (or resumes) a chunked upload of a file of 'size' bytes
+
+    Responds with the upload_id to send chunks to and the number of
+    bytes already received, where the next chunk has to start
+
+    upload_token: optional, chosen by the client; sending it again
+        resumes the upload even from a new socket
+    """
+    sid = request.form['sid']
+    size = request.form.get('size', type=int)
+    if size is None or size < 0:
+        return make_response(jsonify({"error": "Missing or invalid size"}), 400)
+    try:
+        upload = chunked_uploads.start(
+            sid, request.form['filename'], size, request.form.get('upload_token') or None
+        )
+    except ValueError as e:
+        return make_response(jsonify({"error": str(e)}), 400)
+    return make_response(jsonify({
+        "upload_id": upload.upload_id,
+        "received": upload.received
+    }))
+
+
+@app.route("/eeg-upload-chunk", methods=["POST"])
+def receive_upload_chunk():
+    """Appends the 'chunk' file part at byte 'offset' of an upload"""
+    try:
+        upload = chunked_uploads.get(request.form['upload_id'])
+    except KeyError:
+        return make_response(jsonify({"error": "Unknown upload"}), 404)
+    offset = request.form.get('offset', type=int)
+    if offset is None or offset < 0 or 'chunk' not in request.files:
+        return make_response(jsonify({"error": "Missing or invalid offset or chunk"}), 400)
+    try:
+        with stage('write'):
+            received = upload.write(offset, request.files['chunk'].stream)
+    except UploadOffsetError as e:
+        # The client resends from where the upload actually is
+        return make_response(jsonify({"error": str(e), "received": e.received}), 409)
+    return make_response(jsonify({"received": received}))
+
+
+@app.route("/eeg-upload-finish", methods=["POST"])
+def finish_chunked_upload():
+    """Completes an upload once every byte was received, responding like
+    /eeg-upload. While the ingestion pool is full it responds with a 503
+    and the upload can be finished later.
+    """
+    try:
+        upload = chunked_uploads.get(request.form['upload_id'])
+    except KeyError:
+        return make_response(jsonify({"error": "Unknown upload"}), 404)
+    if not upload.complete:
+        return make_response(jsonify({
+            "error": "Upload incomplete",
+            "received": upload.received
+        }), 409)
+    try:
+        with stage('ingest'):
+            upload, chunker, job_id = chunked_uploads.finish(upload.upload_id)
+    except IngestQueueFull as e:
+        return make_response(jsonify({"error": str(e)}), 503)
+    return _upload_response(upload.sid, chunker, job_id)
+
+
+@app.route("/ingest-job", methods=["GET"])
+def get_ingest_job():
+    """Status of the conversion job 'job_id' of an upload, or of any
+    other ingestion job
+    """
+    return make_response(jsonify(conversion_jobs.status(request.args.get('job_id'))))
 
-    # Tell session manager where .edf is
-    saveFilenameToSession(sid, fif_path)
 
-    # Cache the edf as a dataframe
-    chunker = EegChunker()
-    # WARNING: This cache_eeg_dataframe method contains
-    # code that manipulates the data retrieved from the file
-    chunker.cache_eeg_dataframe(sid, fif_path, should_bipolar_preprocess)
+@app.route("/ingest-stats", methods=["GET"])
+def get_ingest_stats():
+    """Depth of the ingestion queue, and job times per kind and format"""
+    return make_response(jsonify(conversion_jobs.stats()))
 
-    # Tell client we're ready for it to request data chunks
-    socketio.emit('edf uploaded', {}, room=sid)
 
-    # Respond with sample rate
+@app.route("/classify", methods=["POST"])
+def classify_eeg():
+    """Queues the session's file for classification. Progress is sent
+    over the 'loading' event and annotations over 'classification complete'
+
+    model: optional name or version of the stored model to use, see
+        GET /models
+    """
+    sid = request.form['sid']
+    filename = getFilenameBySid(sid)
+    try:
+        interface = ClassifierInterface(sid, request.form.get('model'))
+        job_id, status = interface.initiate_classifier(filename)
+    except UnknownModel as e:
+        return make_response(jsonify({"error": str(e)}), 404)
+    except JobQueueFull as e:
+        return make_response(jsonify({"error": str(e)}), 503)
+
     response_data = {
-        "sample_rate": chunker.get_sample_rate(sid, fif_path),
-        "num_samples": chunker.get_num_samples(sid, fif_path)
+        "job_id": job_id,
+        "status": status,
+        "model": interface.model_name
     }
-
     return make_response(jsonify(response_data))
 
 
+@app.route("/models", methods=["GET"])
+def get_models():
+    """Stored models /classify can use, and the one it uses by default"""
+    return make_response(jsonify({
+        "models": stored_models(),
+        "default": resolve_model()
+    }))
+
+
+def warm_classifier():
+    """Starts the classification workers with the default model loaded,
+    called once when the server starts
+    """
+    classification_jobs.warm([stored_models_dir() + resolve_model()])
+
+
+def _session_annotations(sid):
+    """Loads the session's annotations from its file on first use"""
+    filename = getFilenameBySid(sid)
+    # Uploads load them already; the session's file may also be replaced
+    # by its FIF conversion, which keeps them
+    if annotation_store.session_filepath(sid) is None:
+        annotation_store.load_from_file(sid, filename)
+    return filename
+
+
+def _annotation_fields(form):
+    """Parses comma separated onsets, durations, descriptions of a form"""
+    onsets = list(map(float, form['onsets'].split(',')))
+    durations = list(map(float, form['durations'].split(',')))
+    # TODO: Clean this up for descriptions with commas
+    descriptions = form['descriptions'].split(',')
+    return onsets, durations, descriptions
+
+
 @app.route("/set-annotations", methods=["POST"])
 def save_annotations_to_file():
-    """Processes annotations and saves to relevant file
+    """Replaces the session's annotations. They are written into the
+    file itself when it is downloaded
     """
     sid = request.form['sid']
-    onsets = list(map(float, request.form['onsets'].split(',')))
-    durations = list(map(float, request.form['durations'].split(',')))
-    # TODO: Clean this up for descriptions with commas
-    descriptions = request.form['descriptions'].split(',')
-    # Find file
-    filename = getFilenameBySid(sid)
-    # Load as raw
-    fif = FIFReader(filename)
-    # Set annotations
-    fif.set_annotations(onsets, durations, descriptions)
-    # Save back to file
-    fif.save()
+    _session_annotations(sid)
+    annotation_store.replace(sid, *_annotation_fields(request.form))
     # Return the saved annotations
-    return fif.get_annotations_as_df().to_json()
+    return annotation_store.as_data_frame(sid).to_json()
+
+
+@app.route("/add-annotations", methods=["POST"])
+def add_annotations():
+    """Adds annotations to the session's, responds with their ids"""
+    sid = request.form['sid']
+    _session_annotations(sid)
+    ids = annotation_store.add(sid, *_annotation_fields(request.form))
+    return make_response(jsonify({"ids": ids}))
+
+
+@app.route("/update-annotation", methods=["POST"])
+def update_annotation():
+    """Changes any of onset, duration, description of one annotation"""
+    sid = request.form['sid']
+    _session_annotations(sid)
+    onset = request.form.get('onset', type=float)
+    duration = request.form.get('duration', type=float)
+    description = request.form.get('description')
+    found = annotation_store.update(
+        sid, request.form.get('id', type=int), onset, duration, description
+    )
+    if not found:
+        return make_response(jsonify({"error": "No such annotation"}), 404)
+    return make_response(jsonify({"updated": True}))
+
+
+@app.route("/delete-annotation", methods=["POST"])
+def delete_annotation():
+    """Removes one annotation by id"""
+    sid = request.form['sid']
+    _session_annotations(sid)
+    if not annotation_store.delete(sid, request.form.get('id', type=int)):
+        return make_response(jsonify({"error": "No such annotation"}), 404)
+    return make_response(jsonify({"deleted": True}))
 
 
 @app.route("/get-annotations", methods=["POST"])
@@ -85,9 +288,8 @@ def get_annotations_from_file():
     """Grabs annotations already stored in file
     """
     sid = request.form['sid']
-    filename = getFilenameBySid(sid)
-    fif = FIFReader(filename)
-    return fif.get_annotations_as_df().to_json()
+    _session_annotations(sid)
+    return annotation_store.as_data_frame(sid).to_json()
 
 
 @app.route("/eeg-download", methods=["POST"])
@@ -95,28 +297,111 @@ def download_eeg():
     """Returns a file saved in /tmp/ if associated with keymap"""
     # TODO: Change to file-download endpoint
     sid = request.form['sid']
-    filename = getFilenameBySid(sid).lstrip('/tmp/')
+    filepath = _session_annotations(sid)
+    # The session's edits go out in a FIF copy of its own: the recording
+    # may be shared with other sessions, or not converted to FIF yet
+    copy_path = annotation_store.materialize(sid, filepath)
+    if copy_path is not None:
+        filepath = copy_path
+    filename = os.path.relpath(filepath, '/tmp/')
     logger.info(f'Returning {filename}')
-    return send_from_directory(directory="/tmp/", filename=filename)
+    # Positional, the keyword was renamed by Flask 2.0
+    return send_from_directory("/tmp/", filename)
 
 
 @app.route("/eeg-chunk", methods=["POST"])
 def retrieve_samples_by_index():
     """Grab a chunk of the data for the server to render by index
     Retrieves samples from i_start up to, not including, i_end
+
+    Optional 'format' field: 'json' (default) or one of the binary
+    encodings in chunk_encoding ('float32', 'int16')
+
+    Optional 'max_points' (target pixel width) or 'decimation' fields
+    ask for a min/max envelope instead of raw samples, see
+    EegChunker.envelope_array_by_index
+
+    Ranges past what is cached so far get a 202 with status 'pending'
+    and the number of available samples instead
     """
     # grab sid, n and N
     sid = request.form['sid']
     i_start = int(request.form['i_start'])
     i_end = int(request.form['i_end'])
-    # Retrieve cached dataframe and grab a chunk from it
+    chunk_format = request.form.get('format', 'json')
+    max_points = request.form.get('max_points', type=int)
+    decimation = request.form.get('decimation', type=int)
+    # Zoomed-out views are served from the envelope pyramid
+    decimate = max_points is not None or decimation is not None
     chunker = EegChunker()
-    chunk_df = chunker.chunk_by_index(sid, i_start, i_end)
+    # A session being scrolled through is in use, whatever else it requests
+    touchSession(sid)
+
+    # The file may still be cached in the background, from the start on
+    available = chunker.get_available_samples(sid)
+    if min(i_end, chunker.get_num_samples(sid, None)) > available:
+        # Not yet: the client asks again later
+        response_data = {
+            "status": "pending",
+            "available_samples": available
+        }
+        return make_response(jsonify(response_data), 202)
+
+    if chunk_format in ENCODINGS:
+        # Binary mode: raw samples behind a small header, no JSON
+        if decimate:
+            samples, ch_names, i_start, d = chunker.envelope_array_by_index(
+                sid, i_start, i_end, max_points=max_points, decimation=decimation
+            )
+        else:
+            samples, ch_names, i_start = chunker.chunk_array_by_index(sid, i_start, i_end)
+            d = 1
+        with stage('serialise'):
+            body = encode_chunk(
+                samples, ch_names, chunker.get_sample_rate(sid, None), i_start,
+                encoding=chunk_format, decimation=d
+            )
+        response = make_response(body)
+        response.mimetype = "application/octet-stream"
+        return response
+
+    # Retrieve cached dataframe and grab a chunk from it
+    if decimate:
+        chunk_df, d = chunker.envelope_by_index(
+            sid, i_start, i_end, max_points=max_points, decimation=decimation
+        )
+    else:
+        chunk_df, d = chunker.chunk_by_index(sid, i_start, i_end), 1
+
+    with stage('serialise'):
+        response_data = {
+            "eeg_chunk": chunk_df.to_json(),
+            "decimation": d
+        }
+        return make_response(jsonify(response_data))
+
+@app.route("/cache-stats", methods=["GET"])
+def get_cache_stats():
+    """Hit rate and memory use of the chunk block cache"""
+    return make_response(jsonify(block_cache.stats()))
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    """Latency, payload and memory histograms of every endpoint and of
+    the stages of their requests, see request_metrics
+    """
+    return make_response(jsonify(request_metrics.stats()))
+
+
+@app.route("/metrics/profile", methods=["GET"])
+def get_profile():
+    """Sampled stacks of the request answered with X-Profile-Id 'id'"""
+    profile = request_metrics.profile(request.args.get('id'))
+    if profile is None:
+        return make_response(jsonify({"error": "Unknown profile"}), 404)
+    return make_response(jsonify(profile))
 
-    response_data = {
-        "eeg_chunk": chunk_df.to_json()
-    }
-    return make_response(jsonify(response_data))
 
 @app.route("/set-montage", methods=["POST"])
 def set_montage():
@@ -124,11 +409,12 @@ def set_montage():
     """
     sid = request.form['sid']
     montage_list = json.loads(request.form['montage_json'])
-    logger.info(montage_list)
+    logger.debug(montage_list)
 
     # Store montage to file
     chunker = EegChunker()
-    chunker.store_montage(montage_list, sid)
+    with stage('montage'):
+        chunker.store_montage(montage_list, sid)
 
     # Return reset signal
     response_data = {
@@ -137,10 +423,35 @@ def set_montage():
     return make_response(jsonify(response_data))
 
 
+@app.route("/set-filter", methods=["POST"])
+def set_filter():
+    """Sets the display filter chunks are returned with, from optional
+    'highpass', 'lowpass' and 'notch' fields in Hz; leaving them all
+    out shows the samples as recorded
+
+    Only the requested ranges are ever filtered, so this is instant for
+    any file size
+    """
+    sid = request.form['sid']
+    display_filter = DisplayFilter(
+        highpass=request.form.get('highpass', type=float),
+        lowpass=request.form.get('lowpass', type=float),
+        notch=request.form.get('notch', type=float)
+    )
+    EegChunker().store_filter(display_filter, sid)
+
+    # Return reset signal
+    response_data = {
+        "reset": True,
+        "filter": display_filter.to_dict()
+    }
+    return make_response(jsonify(response_data))
+
+
 @app.route("/", methods=["GET"])
 def sanity_check():
     """Just a ping"""
-    logger.info('ping')
+    logger.debug('ping')
     response = make_response("pong", 200)
     response.mimetype = "text/plain"
     return response
@@ -5,6 +5,13 @@ import netface from '../common/network_interface';
 import store from '../common/reducers';
 import styled from 'styled-components';
 
+// Wait before asking again for samples the server hasn't cached yet,
+// doubled on every retry up to PENDING_MAX_RETRY_MS
+const PENDING_RETRY_MS = 500
+const PENDING_MAX_RETRY_MS = 5000
+// Retries before giving up on samples that never get cached
+const PENDING_MAX_RETRIES = 30
+
 class ElectrogramDisplay extends React.Component {
 
   constructor(props) {
@@ -47,7 +54,8 @@ class ElectrogramDisplay extends React.Component {
     
     this.state = {
       isRenderIntitialized: false,
-      eegData: {}
+      eegData: {},
+      samplesError: null
     }
   }
 
@@ -554,6 +562,7 @@ class ElectrogramDisplay extends React.Component {
         this.refreshOptions()
         this.blockScrollMovement = false;
       })
+      .catch(this.onSamplesError)
   }
 
   rollDataRight = () => {
@@ -586,6 +595,7 @@ class ElectrogramDisplay extends React.Component {
         this.refreshOptions()
         this.blockScrollMovement = false;
       })
+      .catch(this.onSamplesError)
   }
 
   onScrollBarClick = (percentage) => {
@@ -632,6 +642,7 @@ class ElectrogramDisplay extends React.Component {
         echart.hideLoading()
         this.blockScrollMovement = false;
       })
+      .catch(this.onSamplesError)
   }
 
   refreshOptions = () => {
@@ -671,9 +682,10 @@ class ElectrogramDisplay extends React.Component {
               .then(this.networkAnnotationsToMarkArea)
           })
       })
+      .catch(this.onSamplesError)
   }
 
-  requestSamplesByIndex = (i_start, i_end) => {
+  requestSamplesByIndex = (i_start, i_end, retries = 0) => {
     // Returns a promise representing a JSON of the data
     if (i_start < 0) {
       i_start = 0
@@ -684,6 +696,26 @@ class ElectrogramDisplay extends React.Component {
     console.log(`Requesting samples [ ${i_start} : ${i_end}] `)
     return netface.requestSamplesByIndex(i_start, i_end)
       .then((data) => data.json())
+      .then((data) => {
+        if (data.status === 'pending') {
+          // Server is still caching the file past available_samples
+          if (retries >= PENDING_MAX_RETRIES) {
+            throw new Error(`Samples [ ${i_start} : ${i_end}] still aren't available`)
+          }
+          let wait = Math.min(PENDING_RETRY_MS * 2 ** retries, PENDING_MAX_RETRY_MS)
+          return new Promise((resolve) => setTimeout(resolve, wait))
+            .then(() => this.requestSamplesByIndex(i_start, i_end, retries + 1))
+        }
+        return data
+      })
+  }
+
+  onSamplesError = (error) => {
+    // Stop waiting on samples that won't come, and tell the user
+    console.error(error)
+    this.blockScrollMovement = false
+    this.echartRef.getEchartsInstance().hideLoading()
+    this.setState({samplesError: 'Could not load the recording\'s samples, try reloading the page.'})
   }
 
   pushDataToSeries = (data) => {
@@ -1070,6 +1102,7 @@ class ElectrogramDisplay extends React.Component {
 
     return (
       <EDParent>
+        {this.state.samplesError && <SamplesError>{this.state.samplesError}</SamplesError>}
         <ReactECharts
           ref={(ref) => { this.echartRef = ref }}
           option={this.getOptions()}
@@ -1095,6 +1128,11 @@ const EDParent = styled.div`
   overflow-y: scroll;
 `;
 
+const SamplesError = styled.div`
+  color: #b00020;
+  padding: 5px;
+`;
+
 class PositionBar extends React.Component {
   // Handles position and sends big jump zoom events to the
   // data zoom
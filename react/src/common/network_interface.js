@@ -2,6 +2,10 @@ import io from 'socket.io-client';
 import store from './reducers';
 
 const BASE_URL = process.env.REACT_APP_BACKEND_URL;
+// Bytes sent per request when uploading a file
+const UPLOAD_CHUNK_BYTES = 8 * 1024 * 1024;
+// Times an upload the server lost (say, restarting) is started over
+const MAX_UPLOAD_RESTARTS = 3;
 
 class ClassifierInterface {
   constructor() {
@@ -16,6 +20,10 @@ class ClassifierInterface {
     // used to identify socket connection for all requests
     this.edf_uploaded = false;
 
+    // Token of each file being uploaded, so its upload resumes after
+    // a reconnection (under a new sid) but is never anyone else's
+    this.uploadTokens = {};
+
     this.registerSocketEvents()
   }
 
@@ -39,28 +47,101 @@ class ClassifierInterface {
    * All request are made by POST with 'sid': session_id in the formdata
    */
   uploadFile(file) {
-    let formData = new FormData();
-    formData.append('sid', this.sid)
-    formData.append('file', file)
-
+    // Sent in chunks so an interrupted upload resumes where it stopped
+    // and the server can start decoding before the file is complete
     store.dispatch({
       type: 'server/upload_file'
     })
 
-    fetch(BASE_URL + '/eeg-upload', {
-      method: 'POST',
-      body: formData,
-      headers: {
-        "accepts":"application/json"
-      }
-    })
-      .then(response => response.json())
+    const fileKey = `${file.name}:${file.size}:${file.lastModified}`
+    if (!(fileKey in this.uploadTokens)) {
+      this.uploadTokens[fileKey] = Math.random().toString(36).slice(2) + Date.now().toString(36)
+    }
+
+    return this.startUpload(file, this.uploadTokens[fileKey])
+      .then(data => this.uploadChunksFrom(file, data.upload_id, data.received, this.uploadTokens[fileKey], 0))
+      .then(uploadId => {
+        let finishData = new FormData()
+        finishData.append('upload_id', uploadId)
+        return this.postForm('/eeg-upload-finish', finishData)
+      })
+      .then(response => this.checkResponse(response))
       .then(data => {
+        delete this.uploadTokens[fileKey]
         store.dispatch({
           type: 'server/upload_successful',
           payload: data,
         })
       })
+      .catch(error => {
+        console.error(`Uploading ${file.name} failed: ${error.message}`)
+        store.dispatch({
+          type: 'server/error',
+          payload: error.message,
+        })
+      })
+  }
+
+  startUpload(file, token) {
+    // Resolves with the upload_id and the bytes the server already has
+    let startData = new FormData()
+    startData.append('sid', this.sid)
+    startData.append('filename', file.name)
+    startData.append('size', file.size)
+    startData.append('upload_token', token)
+
+    return this.postForm('/eeg-upload-start', startData)
+      .then(response => this.checkResponse(response))
+  }
+
+  uploadChunksFrom(file, uploadId, offset, token, restarts) {
+    // Resolves with uploadId once every byte was received
+    if (offset >= file.size) {
+      return Promise.resolve(uploadId)
+    }
+    let chunkData = new FormData()
+    chunkData.append('upload_id', uploadId)
+    chunkData.append('offset', offset)
+    chunkData.append('chunk', file.slice(offset, offset + UPLOAD_CHUNK_BYTES))
+
+    return this.postForm('/eeg-upload-chunk', chunkData)
+      .then(response => {
+        if (response.status === 404 && restarts < MAX_UPLOAD_RESTARTS) {
+          // Uploads are held in memory, the server may have restarted
+          return this.startUpload(file, token)
+            .then(data => this.uploadChunksFrom(file, data.upload_id, data.received, token, restarts + 1))
+        }
+        // On 409 the server answers with where to continue from
+        const check = response.status === 409 ? response.json() : this.checkResponse(response)
+        return check.then(data => {
+          if (typeof data.received !== 'number') {
+            throw new Error('The server did not say where to continue from')
+          }
+          return this.uploadChunksFrom(file, uploadId, data.received, token, restarts)
+        })
+      })
+  }
+
+  checkResponse(response) {
+    // Resolves with the JSON of a successful response, rejects otherwise
+    if (response.ok) {
+      return response.json()
+    }
+    return response.json()
+      .catch(() => ({}))
+      .then(data => {
+        throw new Error(data.error || `${response.status} ${response.statusText}`)
+      })
+  }
+
+  postForm(route, formData) {
+    return fetch(BASE_URL + route, {
+      method: 'POST',
+      body: formData,
+      headers: {
+        "accepts":"application/json"
+      }
+    })
   }
 
   uploadAnnotations(onsets, durations, descriptions) {
@@ -115,7 +196,7 @@ class ClassifierInterface {
     })
   }
 
-  requestSamplesByIndex(i_start, i_end) {
+  requestSamplesByIndex(i_start, i_end, maxPoints) {
     if (store.getState().serverStatus != 'UPLOADED') {
       throw 'EDF must be uploaded before requesting a chunk'
     }
@@ -123,6 +204,11 @@ class ClassifierInterface {
     formData.append('sid', this.sid)
     formData.append('i_start', i_start)
     formData.append('i_end', i_end)
+    if (maxPoints !== undefined) {
+      // Zoomed out: server answers with a min/max envelope
+      // of about maxPoints bins instead of every sample
+      formData.append('max_points', maxPoints)
+    }
 
     return fetch(BASE_URL + '/eeg-chunk', {
       method: 'POST',
@@ -146,6 +232,23 @@ class ClassifierInterface {
     })
   }
 
+  setFilter(highpass, lowpass, notch) {
+    // Cutoffs in Hz; null leaves that filter off
+    let formData = new FormData();
+    formData.append('sid', this.sid)
+    if (highpass != null) formData.append('highpass', highpass)
+    if (lowpass != null) formData.append('lowpass', lowpass)
+    if (notch != null) formData.append('notch', notch)
+
+    return fetch(BASE_URL + '/set-filter', {
+      method: 'POST',
+      body: formData,
+      headers: {
+        "accepts":"application/json",
+      }
+    })
+  }
+
   setMontage(montageJson) {
     let formData = new FormData();
     formData.append('sid', this.sid)